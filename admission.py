@@ -0,0 +1,206 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+
+# ----------------書き込みリクエストの流量制御----------------
+# 一部の端末が大量に在庫の追加や販売を送ると、SQLiteの書き込みロックの前に
+# リクエストが溜まり、全ての端末のレイテンシが数秒になってから失敗し始める
+# そうならないように、書き込みのリクエスト(POST/PUT/PATCH/DELETE)を処理する前に
+# 次の2段階で受け付けるかどうかを決め、受け付けない場合はすぐにエラーを返す
+#
+#  1. 端末ごとの流量制限 (トークンバケット)
+#     端末ごとにRATE_LIMIT_PER_SECOND件/秒、最大RATE_LIMIT_BURST件まで連続して受け付ける
+#     超えた場合は429を返す (RATE_LIMIT_PER_SECONDが0の場合は制限しない)
+#     端末はRATE_LIMIT_CLIENT_HEADERのヘッダー (ない場合は接続元のIPアドレス) で区別する
+#  2. 同時に処理する書き込みの数の制限
+#     同時に処理する書き込みをWRITE_MAX_IN_FLIGHT件までにし、それ以上は空くまで待たせる
+#     (WRITE_MAX_IN_FLIGHTが0の場合は制限しない)
+#     WRITE_MAX_IN_FLIGHTを指定しない場合は、同時に実行できる書き込みの数に合わせる
+#     SQLiteはDBファイルごとに1件ずつしか書き込めないためDBファイル(シャード)の数、
+#     それ以外のDBはシャードの数 × コネクションプールの大きさ(pool_size)とする
+#     販売の遅延書き込み(SALE_WRITE_BEHIND)が有効な場合は、販売をメモリ上で受け付け、
+#     DBへの書き込みは1つのスレッドがまとめて行うため制限しない
+#     待ち時間がWRITE_LATENCY_BUDGET秒を超える場合は503を返す
+#     (待っている件数と最近の処理時間から待ち時間を見積もり、超える見込みの場合は待たずに返す)
+#  どちらもRetry-Afterヘッダーに再送までの秒数を付ける
+#  受け付けなかった件数は /metrics の admission_shed_total に理由ごとに出力する
+#
+# 制限はワーカープロセスごとに行う (gunicornで複数のワーカーを起動した場合は合計が上限になる)
+# GET/HEADのリクエストは制限しない (参照はレプリカや在庫のキャッシュで処理できるため)
+#
+# トークンバケットについては下記ページなどを参照
+# https://en.wikipedia.org/wiki/Token_bucket
+
+# 制限の対象とするHTTPメソッド
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+# 処理時間の移動平均の重み
+SERVICE_TIME_WEIGHT = 0.2
+
+# SQLAlchemyのコネクションプールの大きさの既定値
+DEFAULT_POOL_SIZE = 5
+
+
+# 同時に処理する書き込みの数の既定値 (DBに同時に書き込める数)
+def default_max_in_flight(app):
+    shards = max(1, app.config.get("DB_SHARDS") or 0)
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+    if shards > 1 and app.config.get("SHARD_DATABASE_URI"):
+        uri = app.config["SHARD_DATABASE_URI"]
+    if uri and make_url(uri).get_backend_name() == "sqlite":
+        return shards
+    options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}
+    return shards * options.get("pool_size", DEFAULT_POOL_SIZE)
+
+
+class AdmissionController:
+
+    def __init__(self):
+        self.rate = 0.0
+        self.burst = 1.0
+        self.client_header = "X-Client-Id"
+        self.max_clients = 10000
+        self.max_in_flight = 1
+        self.latency_budget = 0.5
+        self._lock = threading.Lock()
+        # 端末 → [トークンの数, 最後に補充した時刻]
+        self._buckets = OrderedDict()
+        self._slots = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # 書き込み1件の処理時間の移動平均(秒)
+        self.service_time = 0.0
+        self.admitted = 0
+        self.shed = {"rate_limited": 0, "queue_full": 0, "timeout": 0}
+
+    # Flaskアプリケーションの設定を読み込み、リクエストの前後に制限の処理を登録する
+    def init_app(self, app):
+        app.config.setdefault("ADMISSION_ENABLED", True)
+        app.config.setdefault("RATE_LIMIT_PER_SECOND", 0.0)
+        app.config.setdefault("RATE_LIMIT_BURST", None)
+        app.config.setdefault("RATE_LIMIT_CLIENT_HEADER", "X-Client-Id")
+        app.config.setdefault("RATE_LIMIT_MAX_CLIENTS", 10000)
+        app.config.setdefault("WRITE_MAX_IN_FLIGHT", None)
+        app.config.setdefault("WRITE_LATENCY_BUDGET", 0.5)
+        self.rate = app.config["RATE_LIMIT_PER_SECOND"]
+        # バースト数を省略した場合は1秒分とする
+        self.burst = app.config["RATE_LIMIT_BURST"] or max(1.0, self.rate)
+        self.client_header = app.config["RATE_LIMIT_CLIENT_HEADER"]
+        self.max_clients = app.config["RATE_LIMIT_MAX_CLIENTS"]
+        self.max_in_flight = app.config["WRITE_MAX_IN_FLIGHT"]
+        if app.config.get("SALE_WRITE_BEHIND"):
+            self.max_in_flight = 0
+        elif self.max_in_flight is None:
+            self.max_in_flight = default_max_in_flight(app)
+        self.latency_budget = app.config["WRITE_LATENCY_BUDGET"]
+        with self._lock:
+            self._buckets.clear()
+
+        if app.config["ADMISSION_ENABLED"]:
+            app.before_request(self._admit)
+            app.teardown_request(self._release)
+
+    # 書き込みのリクエストを受け付けるかどうかを決める
+    # 受け付けない場合は429または503のエラーにする
+    def _admit(self):
+        if request.method not in WRITE_METHODS or request.endpoint is None:
+            return
+        if self.rate > 0:
+            self.take_token(request.headers.get(self.client_header) or request.remote_addr)
+        if self.max_in_flight:
+            self.acquire()
+            g.admission_start = time.perf_counter()
+
+    # 処理が終わった書き込みの枠を空け、待っているリクエストを再開する
+    def _release(self, error):
+        start = g.pop("admission_start", None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        with self._slots:
+            self.in_flight -= 1
+            self.service_time += (seconds - self.service_time) * SERVICE_TIME_WEIGHT
+            self._slots.notify()
+
+    # 端末のトークンを1つ使う (足りない場合は429)
+    def take_token(self, client):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = [self.burst, now]
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            self.shed["rate_limited"] += 1
+            retry_after = (1 - bucket[0]) / self.rate
+        raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+    # 書き込みの枠を1つ確保する
+    # 空いていない場合はWRITE_LATENCY_BUDGET秒まで待ち、確保できない場合は503
+    def acquire(self):
+        with self._slots:
+            if self.in_flight < self.max_in_flight and not self.waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                return
+
+            # 前に待っている件数と処理時間から、枠が空くまでの時間を見積もる
+            estimate = (self.waiting + 1) * self.service_time / self.max_in_flight
+            if estimate > self.latency_budget:
+                self.shed["queue_full"] += 1
+                raise ServiceUnavailable(retry_after=math.ceil(estimate))
+
+            deadline = time.monotonic() + self.latency_budget
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed["timeout"] += 1
+                        raise ServiceUnavailable(retry_after=math.ceil(self.latency_budget))
+                    self._slots.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        with self._slots:
+            in_flight, waiting, service_time = self.in_flight, self.waiting, self.service_time
+            shed = dict(self.shed)
+        return [
+            ("admission_admitted_total", "counter", "Write requests admitted.", [
+                ({}, self.admitted),
+            ]),
+            ("admission_shed_total", "counter", "Write requests rejected by admission control.", [
+                ({"reason": reason}, count) for reason, count in sorted(shed.items())
+            ]),
+            ("admission_in_flight", "gauge", "Write requests being processed.", [
+                ({}, in_flight),
+            ]),
+            ("admission_waiting", "gauge", "Write requests waiting for a slot.", [
+                ({}, waiting),
+            ]),
+            ("admission_service_seconds", "gauge", "Moving average of write request time.", [
+                ({}, service_time),
+            ]),
+        ]
+
+
+# AdmissionControllerインスタンスの作成
+admission = AdmissionController()
@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask, Blueprint
 from flask_sqlalchemy import SQLAlchemy
 
@@ -7,21 +9,185 @@ from flask_migrate import Migrate
 # https://flask-migrate.readthedocs.io/en/latest/
 
 import controller
+import db_profiles
+import json_provider
+import reset_engine
+import stock_import
+from admission import admission
+from cache import stock_cache
+from compression import response_compressor
+from change_feed import change_notifier
+from idempotency import idempotency_store
+from low_stock import low_stock_notifier
+from metrics import metrics
 from models import db
+from replicas import read_replica
+from sharding import shard_router
+from write_behind import sale_coalescer
 
-def create_app():
+def create_app(config=None):
 
     # Flask applicationインスタンスの作成
     app = Flask(__name__)
 
-    # 使用するDBの指定 (SQLiteでdata.dbファイルを使用する) 
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///data.db"
+    # 使用するDBの指定
+    # DB_PROFILEで選択したプロファイルの設定を使う (省略時はSQLiteでdata.dbファイルを使用する)
+    # プロファイルについてはdb_profiles.pyを参照
+    profile = (config or {}).get("DB_PROFILE")
+    app.config.update(db_profiles.load_profile(profile))
+
+    # まとめて販売(/v1/sales/batch)で1リクエストに指定できる明細数の上限
+    app.config["SALES_BATCH_MAX_ITEMS"] = 1000
+
+    # 時間単位ごとの売上チェック(/v1/sales?bucket=...)で1回に返す件数の上限
+    app.config["SALES_ROLLUP_MAX_BUCKETS"] = 1000
+
+    # 在庫チェック(/v1/stocks)のページングで1回に返す件数の上限と
+    # ストリーミングでDBから1回に読み込む件数
+    app.config["STOCKS_PAGE_MAX_LIMIT"] = 1000
+    app.config["STOCKS_STREAM_BATCH_SIZE"] = 1000
+
+    # 在庫の一括登録(/v1/stocks/bulk)で1回のトランザクションで登録する件数
+    app.config["STOCK_IMPORT_CHUNK_SIZE"] = stock_import.DEFAULT_CHUNK_SIZE
+
+    # 在庫データのキャッシュの設定 (上限件数とTTL(秒))
+    # キャッシュはプロセスごとに持ち、他のワーカーでの更新はTTLが切れるまで反映されないため、
+    # 既定ではキャッシュしない (0)
+    # 1プロセスで動かす場合や、TTL秒までの古い在庫数を返してよい場合に
+    # 環境変数 STOCK_CACHE_TTL で秒数を指定して有効にする。詳細はcache.pyを参照
+    app.config["STOCK_CACHE_SIZE"] = 10000
+    app.config["STOCK_CACHE_TTL"] = float(os.environ.get("STOCK_CACHE_TTL", "0"))
+
+    # 変更履歴(/v1/changes)で1回に返す件数の上限とロングポーリングで待つ秒数の上限
+    # 他のプロセスの変更を確認する間隔(秒)
+    app.config["CHANGES_PAGE_MAX_LIMIT"] = 1000
+    app.config["CHANGES_MAX_WAIT"] = 10
+    app.config["CHANGES_POLL_INTERVAL"] = 0.5
+
+    # 変更履歴のServer-Sent Eventsで、変更がない間に接続を維持するために送る間隔(秒)と
+    # 1回の接続を終了するまでの秒数
+    app.config["CHANGES_HEARTBEAT"] = 15
+    app.config["CHANGES_STREAM_SECONDS"] = 60
+
+    # 変更履歴のロングポーリングとServer-Sent Eventsで、プロセスごとに同時に待てるリクエストの数
+    # 待っている間はワーカーのスレッドを占有するため、serve.pyの1ワーカーあたりのスレッド数(4)より
+    # 少なくし、超えた場合は503を返す (0の場合は制限しない)
+    app.config["CHANGES_MAX_STREAMS"] = 2
+
+    # Idempotency-Keyごとに保存したレスポンスのキャッシュの上限件数と、
+    # キーを有効とする秒数
+    app.config["IDEMPOTENCY_CACHE_SIZE"] = 10000
+    app.config["IDEMPOTENCY_TTL"] = 86400
+
+    # 販売の遅延書き込み (環境変数 SALE_WRITE_BEHIND=1 で有効にする)
+    # 販売をジャーナルファイルに書き込んでからレスポンスを返し、
+    # SALE_FLUSH_INTERVAL秒ごとにまとめてDBに反映する
+    # 1プロセスで動かす必要がある。詳細はwrite_behind.pyを参照
+    app.config["SALE_WRITE_BEHIND"] = os.environ.get("SALE_WRITE_BEHIND") == "1"
+    app.config["SALE_FLUSH_INTERVAL"] = 0.005
+
+    # 在庫データを商品名のハッシュ値でDB_SHARDS個のDBファイルに分ける
+    # (環境変数 DB_SHARDS で指定する。0または1の場合は分けない。詳細はsharding.pyを参照)
+    app.config["DB_SHARDS"] = int(os.environ.get("DB_SHARDS", "0"))
+
+    # GET/HEADリクエストの参照に使うDB (環境変数 READ_REPLICA_URI で指定する。省略時は使わない)
+    # "primary"を指定した場合は同じSQLiteファイルに参照専用のコネクションプールを作る
+    # レプリカの遅れをREPLICA_LAG_CHECK_INTERVAL秒ごとに確認し、
+    # REPLICA_MAX_LAG秒より遅れている間は書き込み用のDBで参照する。詳細はreplicas.pyを参照
+    app.config["READ_REPLICA_URI"] = os.environ.get("READ_REPLICA_URI")
+    app.config["REPLICA_MAX_LAG"] = 5.0
+    app.config["REPLICA_LAG_CHECK_INTERVAL"] = 1.0
+
+    # 在庫数が発注点を下回ったときと戻ったときに通知を送るURL
+    # (環境変数 LOW_STOCK_WEBHOOK_URL で指定する。省略時は通知しない)
+    # 送信に失敗した場合に送り直す回数と、送信のタイムアウト(秒)
+    app.config["LOW_STOCK_WEBHOOK_URL"] = os.environ.get("LOW_STOCK_WEBHOOK_URL")
+    app.config["LOW_STOCK_WEBHOOK_RETRIES"] = 3
+    app.config["LOW_STOCK_WEBHOOK_TIMEOUT"] = 5.0
+
+    # jsonify()などに使うJSONの処理 (環境変数 JSON_PROVIDER で指定する)
+    # auto: orjsonがインストールされていれば使う。詳細はjson_provider.pyを参照
+    app.config["JSON_PROVIDER"] = os.environ.get("JSON_PROVIDER", "auto")
+
+    # COMPRESS_MIN_SIZEバイト以上のレスポンスをAccept-Encodingに合わせて
+    # brotliまたはgzipで圧縮する。詳細はcompression.pyを参照
+    app.config["COMPRESS_ENABLED"] = True
+    app.config["COMPRESS_MIN_SIZE"] = 1024
+
+    # 書き込みのリクエストの流量制御。詳細はadmission.pyを参照
+    # 端末(X-Client-Idヘッダー、ない場合はIPアドレス)ごとに1秒あたりの件数を制限する
+    # (環境変数 RATE_LIMIT_PER_SECOND で指定する。0の場合は制限しない)
+    # 同時に処理する書き込みをWRITE_MAX_IN_FLIGHT件までにし、
+    # 空くまでの待ち時間がWRITE_LATENCY_BUDGET秒を超える場合は503を返す
+    # WRITE_MAX_IN_FLIGHTを指定しない場合はDBに同時に書き込める数とする
+    # (SQLiteはDBファイルの数、それ以外はコネクションプールの大きさ。遅延書き込みの場合は制限しない)
+    app.config["ADMISSION_ENABLED"] = True
+    app.config["RATE_LIMIT_PER_SECOND"] = float(os.environ.get("RATE_LIMIT_PER_SECOND", "0"))
+    app.config["RATE_LIMIT_BURST"] = None
+    app.config.setdefault("WRITE_MAX_IN_FLIGHT", None)
+    app.config["WRITE_LATENCY_BUDGET"] = 0.5
+
+    # スナップショット(flask snapshot-stocks / restore-stocks)の保存先
+    # 環境変数 SNAPSHOT_API=1 の場合は /v1/snapshots でも保存と復元ができる (負荷試験の環境用)
+    app.config["SNAPSHOT_DIR"] = os.path.join(app.instance_path, "snapshots")
+    app.config["SNAPSHOT_API_ENABLED"] = os.environ.get("SNAPSHOT_API") == "1"
+
+    # 引数で指定された設定で上書きする (テストやベンチマークで別のDBを使う場合など)
+    if config is not None:
+        app.config.update(config)
+
+    # GETリクエストの参照を参照用のDBに振り分ける (READ_REPLICA_URIを指定した場合)
+    # 参照用のDBをSQLALCHEMY_BINDSに追加するため、db.init_app()より前に呼び出す
+    read_replica.init_app(app)
+
+    # JSONの処理を設定する
+    json_provider.init_app(app)
 
     # アプリケーションとデータベースを関連付ける
     db.init_app(app)
+    db_profiles.init_app(app, db)
+
+    # アプリケーションとキャッシュを関連付ける
+    stock_cache.init_app(app)
+
+    # 在庫データのシャーディングを有効にする (DB_SHARDSが2以上の場合)
+    # シャードのエンジンのSQLも計測するため、計測(metrics)より前に呼び出す
+    shard_router.init_app(app)
+
+    # リクエストの計測を有効にする
+    # 遅いリクエストをログに出力する場合はSLOW_REQUEST_SECONDSに秒数を指定する
+    metrics.init_app(app, db, shard_router.engines)
+    metrics.add_collector(stock_cache.collect_metrics)
+    metrics.add_collector(read_replica.collect_metrics)
+
+    # 書き込みのリクエストの流量制御を有効にする
+    # 計測(metrics)より後に登録し、受け付けなかったリクエストも計測する
+    admission.init_app(app)
+    metrics.add_collector(admission.collect_metrics)
+
+    # レスポンスを圧縮する
+    # 計測(metrics)より後に登録し、計測には圧縮後のサイズを記録する
+    response_compressor.init_app(app)
+
+    # Idempotency-Keyによるリクエストの重複排除を有効にする
+    idempotency_store.init_app(app)
+    metrics.add_collector(idempotency_store.collect_metrics)
+
+    # コミット時に変更履歴を待っているリクエストに通知する
+    change_notifier.init_app(app)
+    metrics.add_collector(change_notifier.collect_metrics)
+
+    # 在庫数が発注点をまたいだ場合に、コミット後に通知を送る
+    low_stock_notifier.init_app(app)
+    metrics.add_collector(low_stock_notifier.collect_metrics)
+
+    # 販売の遅延書き込みを有効にする (SALE_WRITE_BEHINDがTrueの場合)
+    sale_coalescer.init_app(app)
+    metrics.add_collector(sale_coalescer.collect_metrics)
 
     # Flask-Migrateを使用するためMigrateインスタンスを作成
-    migrate = Migrate(app, db)
+    # SQLiteはALTER TABLEの機能が限られるため、batchモードでマイグレーションを作成する
+    migrate = Migrate(app, db, render_as_batch=True)
 
     # APIのバージョン管理のためにBlueprintを作成
     v1 = Blueprint('v1', __name__, url_prefix='/v1')
@@ -29,14 +195,33 @@ def create_app():
     # URLルールを追加し、それぞれのURLに対応するコントローラの関数を指定
     v1.add_url_rule('/stocks', 'retrieve_stocks_v1', controller.retrieve_stocks_v1, methods=['GET'])
     v1.add_url_rule('/stocks/<string:name>', 'retrieve_stock_v1', controller.retrieve_stock_v1, methods=['GET'])
+    v1.add_url_rule('/stocks/<string:name>/threshold', 'set_threshold_v1', controller.set_threshold_v1, methods=['PUT'])
+    v1.add_url_rule('/stocks/<string:name>/threshold', 'delete_threshold_v1', controller.delete_threshold_v1, methods=['DELETE'])
     v1.add_url_rule('/stocks', 'add_stocks_v1', controller.add_stocks_v1, methods=['POST'])
+    v1.add_url_rule('/stocks/bulk', 'add_stocks_bulk_v1', controller.add_stocks_bulk_v1, methods=['POST'])
     v1.add_url_rule('/sales', 'sale_stocks_v1', controller.sale_stocks_v1, methods=['POST'])
     v1.add_url_rule('/sales', 'check_sales_v1', controller.check_sales_v1, methods=['GET'])
+    v1.add_url_rule('/sales/batch', 'sale_stocks_batch_v1', controller.sale_stocks_batch_v1, methods=['POST'])
     v1.add_url_rule('/stocks', 'remove_stocks_v1', controller.remove_stocks_v1, methods=['DELETE'])
+    v1.add_url_rule('/snapshots/<string:name>', 'snapshot_stocks_v1', controller.snapshot_stocks_v1, methods=['POST'])
+    v1.add_url_rule('/snapshots/<string:name>/restore', 'restore_stocks_v1', controller.restore_stocks_v1, methods=['POST'])
+    v1.add_url_rule('/changes', 'changes_v1', controller.changes_v1, methods=['GET'])
+    v1.add_url_rule('/cache', 'cache_stats_v1', controller.cache_stats_v1, methods=['GET'])
 
     # 作成したBlueprintをアプリケーションに登録
     app.register_blueprint(v1)
 
+    # 計測結果をPrometheus形式で返す
+    app.add_url_rule('/metrics', 'export_metrics', controller.export_metrics, methods=['GET'])
+
+    # CLIコマンドを登録
+    # flask import-stocks FILE で在庫データを一括登録する
+    app.cli.add_command(stock_import.import_stocks_command)
+    # flask reset-stocks / snapshot-stocks NAME / restore-stocks NAME で全削除とスナップショット
+    app.cli.add_command(reset_engine.reset_stocks_command)
+    app.cli.add_command(reset_engine.snapshot_stocks_command)
+    app.cli.add_command(reset_engine.restore_stocks_command)
+
     # ERROR 処理
     # エラーハンドラーについては下記ページなどを参照
     # https://flask.palletsprojects.com/en/3.0.x/errorhandling/
@@ -57,4 +242,14 @@ def create_app():
     def method_not_allowed(error):
         return controller.method_not_allowed_v1(error)
 
+    # 端末ごとの流量制限を超えた
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return controller.too_many_requests_v1(error)
+
+    # 書き込みが混雑していて受け付けられない
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return controller.service_unavailable_v1(error)
+
     return app
@@ -0,0 +1,305 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import BadRequest, HTTPException
+
+import change_feed
+import db_profiles
+import queries
+import reset_engine
+import sale_engine
+import validation
+from models import db, Stock
+
+
+# ----------------ASGI版のv1 API----------------
+# 非同期のDBドライバ (SQLiteはaiosqlite、PostgreSQLはasyncpg) を使うASGIアプリケーション
+# 待ち時間の間スレッドを占有しないため、キープアライブで接続したままの端末が多くても
+# 1プロセスで多数の接続を保持できる
+#
+# 対象のエンドポイントは controller.py の次の関数と同じ動作をする
+#   GET    /v1/stocks           retrieve_stocks_v1 (クエリパラメータなし)
+#   GET    /v1/stocks/<name>    retrieve_stock_v1
+#   POST   /v1/stocks           add_stocks_v1
+#   POST   /v1/sales            sale_stocks_v1
+#   POST   /v1/sales/batch      sale_stocks_batch_v1
+#   GET    /v1/sales            check_sales_v1 (クエリパラメータなし)
+#   DELETE /v1/stocks           remove_stocks_v1
+# 値チェックと販売処理は validation と sale_engine を
+# 非同期セッションの run_sync() から呼び出して共有する
+# (プロセス内のキャッシュと計測、販売の遅延書き込み、シャーディング、レスポンスの圧縮、
+#  Idempotency-Keyによる重複排除(idempotency.py)、書き込みの流量制御(admission.py)はFlask版のみ)
+#
+# Idempotency-Keyには対応していないため、ヘッダーを指定したリクエストは処理せずに501を返す
+# (重複排除されると思って再送した販売が2回処理されないようにする)
+# 流量制御が必要な場合は、リバースプロキシなどASGI版の手前で制限すること
+#
+# 実行例 (uvicorn、aiosqlite、greenletのインストールが必要)
+# $ uvicorn asgi:app --workers 4 --timeout-keep-alive 75
+# $ python serve.py --asgi
+#
+# SQLAlchemyの非同期APIについては下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+# ASGIについては下記ページなどを参照
+# https://asgi.readthedocs.io/en/latest/specs/www.html
+
+# 同期ドライバに対応する非同期ドライバ
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+# create_app()と同じ設定(DB_PROFILEなど)で使用するDBのURLを求め、非同期ドライバに置き換える
+def async_database_url():
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        url = db.engine.url
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    pragmas = app.config.get("SQLITE_PRAGMAS")
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]), options, pragmas
+
+
+# Content-TypeがJSONかどうか (Flaskのrequest.is_jsonと同じ判定)
+def is_json(content_type):
+    mimetype = content_type.split(";", 1)[0].strip().lower()
+    return mimetype == "application/json" or (
+        mimetype.startswith("application/") and mimetype.endswith("+json")
+    )
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1")
+            for key, value in scope.get("headers", [])
+        }
+        self.body = body
+        host = self.headers.get("host", "localhost")
+        self.base_url = "{}://{}{}".format(scope.get("scheme", "http"), host, self.path)
+
+    # リクエストボディのJSON
+    # Content-TypeがJSONでない場合、JSONとして解釈できない場合は400エラーとする
+    def get_json(self):
+        if not is_json(self.headers.get("content-type", "")):
+            raise BadRequest()
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise BadRequest() from None
+        if data is None:
+            raise BadRequest()
+        return data
+
+
+class Response:
+
+    def __init__(self, data, status=200, headers=None):
+        # Flaskのjsonifyと同じくキーをソートした空白なしのJSONにする
+        self.body = json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8") + b"\n"
+        self.status = status
+        self.headers = headers or {}
+
+    async def send(self, send):
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(self.body)).encode("latin-1")),
+        ]
+        headers += [
+            (key.encode("latin-1"), value.encode("latin-1"))
+            for key, value in self.headers.items()
+        ]
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+def error(status):
+    return Response({"message": "ERROR"}, status)
+
+
+class AsgiApp:
+
+    def __init__(self, url=None, engine_options=None, sqlite_pragmas=None,
+                 batch_max_items=1000):
+        self.url = url
+        self.engine_options = engine_options or {}
+        self.sqlite_pragmas = sqlite_pragmas
+        # まとめて販売で1リクエストに指定できる明細数の上限 (Flask版のSALES_BATCH_MAX_ITEMSと同じ)
+        self.batch_max_items = batch_max_items
+        self.engine = None
+        self.sessionmaker = None
+        self._startup_lock = asyncio.Lock()
+
+    # DBの非同期エンジンを作成する (ワーカープロセスごとに起動時に作成する)
+    async def startup(self):
+        async with self._startup_lock:
+            if self.engine is None:
+                await self._create_engine()
+
+    async def _create_engine(self):
+        if self.url is None:
+            self.url, options, pragmas = async_database_url()
+            options.update(self.engine_options)
+            self.engine_options = options
+            if self.sqlite_pragmas is None:
+                self.sqlite_pragmas = pragmas
+        self.engine = create_async_engine(self.url, **self.engine_options)
+        if self.sqlite_pragmas:
+            db_profiles.listen_sqlite_pragmas(self.engine.sync_engine, self.sqlite_pragmas)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def shutdown(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if self.engine is None:
+            await self.startup()
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        request = Request(scope, body)
+        try:
+            response = await self.dispatch(request)
+        except HTTPException as e:
+            response = error(e.code or 400)
+        await response.send(send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # URLとメソッドに対応する関数を呼び出す
+    async def dispatch(self, request):
+        parts = request.path.rstrip("/").split("/")
+        if parts[:2] != ["", "v1"] or len(parts) < 3:
+            return error(404)
+        route = parts[2:]
+
+        if route == ["stocks"]:
+            handlers = {"GET": self.retrieve_stocks, "POST": self.add_stocks,
+                        "DELETE": self.remove_stocks}
+            args = ()
+        elif len(route) == 2 and route[0] == "stocks":
+            handlers = {"GET": self.retrieve_stock}
+            args = (route[1],)
+        elif route == ["sales"]:
+            handlers = {"GET": self.check_sales, "POST": self.sale_stocks}
+            args = ()
+        elif route == ["sales", "batch"]:
+            handlers = {"POST": self.sale_stocks_batch}
+            args = ()
+        else:
+            return error(404)
+
+        handler = handlers.get(request.method)
+        if handler is None:
+            return error(405)
+        if "idempotency-key" in request.headers:
+            return error(501)
+        return await handler(request, *args)
+
+    # ----------------エンドポイント----------------
+
+    # 在庫チェック
+    async def retrieve_stocks(self, request):
+        async with self.sessionmaker() as session:
+            rows = await session.execute(
+                select(Stock.name, Stock.amount).order_by(Stock.name)
+            )
+            return Response(dict(rows.all()))
+
+    async def retrieve_stock(self, request, name):
+        if not name.isalpha() or len(name) > 8:
+            return error(400)
+        async with self.sessionmaker() as session:
+            amount = await session.scalar(queries.SELECT_AMOUNT, {"name": name})
+        # 在庫がない場合はamountを0として返す
+        return Response({name: amount or 0})
+
+    # 在庫の更新、作成
+    async def add_stocks(self, request):
+        data = request.get_json()
+        name, amount = validation.validate(validation.STOCK, data)
+
+        def upsert(session):
+            queries.add_amount(name, amount, session)
+            change_feed.record_changes("stock", [(name, amount, 0)], session)
+            session.commit()
+
+        async with self.sessionmaker() as session:
+            await session.run_sync(upsert)
+        return Response(data, headers={"Location": request.base_url + "/" + name})
+
+    # 販売
+    async def sale_stocks(self, request):
+        data = request.get_json()
+        name, amount, price = validation.validate(validation.SALE, data)
+        async with self.sessionmaker() as session:
+            ok = await session.run_sync(
+                lambda s: sale_engine.sell(name, amount, price, session=s)
+            )
+        if not ok:
+            return error(400)
+        return Response(data, headers={"Location": request.base_url + "/" + name})
+
+    # まとめて販売
+    async def sale_stocks_batch(self, request):
+        items, lines = validation.validate_items(
+            validation.SALE, request.get_json(), self.batch_max_items
+        )
+
+        async with self.sessionmaker() as session:
+            results = await session.run_sync(
+                lambda s: sale_engine.sell_batch(lines, session=s)
+            )
+
+        response_data = []
+        for item, ok in zip(items, results):
+            line = dict(item)
+            line["result"] = "OK" if ok else "ERROR"
+            response_data.append(line)
+        return Response({"items": response_data})
+
+    # 売上チェック
+    async def check_sales(self, request):
+        async with self.sessionmaker() as session:
+            cents = await session.scalar(queries.SELECT_TOTAL)
+        return Response({"sales": (cents or 0) / 100})
+
+    # 全削除
+    async def remove_stocks(self, request):
+        async with self.sessionmaker() as session:
+            await session.run_sync(reset_engine.reset)
+            await session.commit()
+        return Response({})
+
+
+# ASGIアプリケーションインスタンスの作成
+app = AsgiApp()
@@ -0,0 +1,3 @@
+# ----------------ベンチマーク----------------
+# v1 APIの性能を計測するためのスクリプトをまとめたパッケージ
+# リポジトリのルートディレクトリから python -m benchmarks.<モジュール名> で実行する
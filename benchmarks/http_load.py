@@ -0,0 +1,316 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from app import create_app
+from models import db
+
+
+# ----------------v1 APIの負荷テスト----------------
+# 一時ディレクトリのSQLiteファイルを使ってcreate_app()でアプリケーションを起動し、
+# HTTPリクエストを並列に送信して、エンドポイントごとのレイテンシ(p50/p95/p99)、
+# スループット、エラー率をJSONで出力する
+#
+# 実行例
+# $ python -m benchmarks.http_load --workload mixed --concurrency 8 --requests 2000
+# $ python -m benchmarks.http_load --config STOCK_CACHE_TTL=5 --output result.json
+#
+# ワークロード
+#  - read:       在庫チェック(1商品)が中心の参照のみの負荷
+#  - sale:       price指定なしの販売の連続
+#  - sale-price: price指定ありの販売の連続
+#  - bulk-add:   在庫の追加(1件ずつ)と一括登録の連続
+#  - reset:      全削除 (毎回在庫を投入し直してから計測する)
+#  - mixed:      上記を組み合わせた負荷 (全削除を除く)
+#
+# 流量制御(admission.py)で受け付けられなかったリクエスト(429/503)はエラーに含め、
+# shedとしても数える。--honor-retry-after を指定した場合は、端末と同じように
+# Retry-Afterヘッダーの秒数だけ待ってから次のリクエストを送る
+# $ python -m benchmarks.http_load --workload sale --concurrency 32 --honor-retry-after
+
+WORKLOADS = ["read", "sale", "sale-price", "bulk-add", "reset", "mixed"]
+
+
+# ランダムな商品名を作成する
+def random_names(count, seed=0):
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        names.add("".join(rng.choice(string.ascii_letters) for _ in range(8)))
+    return sorted(names)
+
+# 一括登録用のNDJSONを作成する
+def ndjson(names, amount):
+    return "\n".join(
+        json.dumps({"name": name, "amount": amount}) for name in names
+    ).encode("utf-8")
+
+
+# ----------------リクエストの作成----------------
+# (計測上のエンドポイント名, メソッド, パス, ボディ) を返す
+
+def read_request(rng, names):
+    if rng.random() < 0.9:
+        return ("GET /v1/stocks/<name>", "GET",
+                "/v1/stocks/" + rng.choice(names), None)
+    return ("GET /v1/stocks", "GET", "/v1/stocks", None)
+
+def sale_request(rng, names, with_price):
+    body = {"name": rng.choice(names[:16]), "amount": rng.randint(1, 3)}
+    if with_price:
+        body["price"] = rng.choice([100, 80, 12.5])
+    return ("POST /v1/sales", "POST", "/v1/sales", body)
+
+def add_request(rng, names):
+    if rng.random() < 0.9:
+        body = {"name": rng.choice(names), "amount": rng.randint(1, 10)}
+        return ("POST /v1/stocks", "POST", "/v1/stocks", body)
+    return ("POST /v1/stocks/bulk", "POST", "/v1/stocks/bulk",
+            ndjson(rng.sample(names, min(100, len(names))), 1))
+
+def mixed_request(rng, names):
+    x = rng.random()
+    if x < 0.70:
+        return read_request(rng, names)
+    if x < 0.80:
+        return ("GET /v1/sales", "GET", "/v1/sales", None)
+    if x < 0.88:
+        return sale_request(rng, names, False)
+    if x < 0.96:
+        return sale_request(rng, names, True)
+    return add_request(rng, names)
+
+def make_request(workload, rng, names):
+    if workload == "read":
+        return read_request(rng, names)
+    if workload == "sale":
+        return sale_request(rng, names, False)
+    if workload == "sale-price":
+        return sale_request(rng, names, True)
+    if workload == "bulk-add":
+        return add_request(rng, names)
+    return mixed_request(rng, names)
+
+
+# ----------------HTTPリクエストの送信----------------
+
+# 受け付けられなかったことを表すステータス
+SHED_STATUSES = (429, 503)
+
+# 1リクエストを送信し、(成功したかどうか, 経過時間(秒)) を返す
+# 2xx以外のステータスと例外はエラーとして数える
+def send(port, method, path, body):
+    ok, seconds, _, _ = send_request(port, method, path, body)
+    return ok, seconds
+
+# 1リクエストを送信し、(成功したかどうか, 経過時間(秒), ステータス, Retry-Afterの秒数) を返す
+# 例外の場合のステータスはNone
+def send_request(port, method, path, body):
+    headers = {}
+    if isinstance(body, dict):
+        body = json.dumps(body).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    elif body is not None:
+        headers["Content-Type"] = "application/x-ndjson"
+
+    start = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        status = response.status
+        retry_after = response.getheader("Retry-After")
+    except (OSError, http.client.HTTPException):
+        status = None
+        retry_after = None
+    seconds = time.perf_counter() - start
+    ok = status is not None and 200 <= status < 300
+    return ok, seconds, status, float(retry_after) if retry_after else None
+
+# パーセンタイル値 (最近傍法)
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1,
+                   int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+# エンドポイントごとの計測結果を集計する
+# samplesは (エンドポイント名, 成功したかどうか, 経過時間(秒)[, 受け付けられなかったかどうか])
+def summarize(samples, elapsed):
+    endpoints = {}
+    for endpoint, ok, seconds, *shed in samples:
+        endpoints.setdefault(endpoint, []).append((ok, seconds, bool(shed and shed[0])))
+
+    result = {}
+    for endpoint, values in sorted(endpoints.items()):
+        latencies = sorted(seconds * 1000 for _, seconds, _ in values)
+        ok_latencies = sorted(seconds * 1000 for ok, seconds, _ in values if ok)
+        errors = sum(1 for ok, _, _ in values if not ok)
+        result[endpoint] = {
+            "requests": len(values),
+            "errors": errors,
+            "error_rate": errors / len(values),
+            "shed": sum(1 for _, _, shed in values if shed),
+            "throughput_rps": len(values) / elapsed if elapsed else None,
+            # 成功したリクエストの数とレイテンシ
+            "goodput_rps": len(ok_latencies) / elapsed if elapsed else None,
+            "ok_latency_ms": {
+                "p50": percentile(ok_latencies, 50),
+                "p99": percentile(ok_latencies, 99),
+            },
+            "latency_ms": {
+                "mean": sum(latencies) / len(latencies),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1],
+            },
+        }
+    return result
+
+
+# ----------------ワークロードの実行----------------
+
+# 在庫を投入し直す
+# 販売でエラーにならないよう十分な在庫数を登録する
+def seed(port, names):
+    send(port, "DELETE", "/v1/stocks", None)
+    ok, _ = send(port, "POST", "/v1/stocks/bulk", ndjson(names, 10 ** 9))
+    if not ok:
+        raise RuntimeError("failed to seed stocks")
+
+def run_workload(port, workload, names, concurrency, requests, seed_value,
+                 honor_retry_after=False):
+    seed(port, names)
+
+    # 全削除は直前に在庫を投入し直す必要があるため1並列で計測する
+    if workload == "reset":
+        samples = []
+        measured = 0.0
+        for _ in range(requests):
+            seed(port, names)
+            ok, seconds = send(port, "DELETE", "/v1/stocks", None)
+            samples.append(("DELETE /v1/stocks", ok, seconds))
+            measured += seconds
+        return summarize(samples, measured), measured
+
+    rng = random.Random(seed_value)
+    planned = [make_request(workload, rng, names) for _ in range(requests)]
+    samples = []
+    lock = threading.Lock()
+
+    def worker(item):
+        endpoint, method, path, body = item
+        ok, seconds, status, retry_after = send_request(port, method, path, body)
+        shed = status in SHED_STATUSES
+        with lock:
+            samples.append((endpoint, ok, seconds, shed))
+        if shed and honor_retry_after and retry_after:
+            time.sleep(retry_after)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, planned))
+    elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed), elapsed
+
+# KEY=VALUE形式の設定をJSONとして解釈できる場合は解釈する
+def parse_config(items):
+    config = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="v1 APIの負荷テスト")
+    parser.add_argument("--workload", action="append", choices=WORKLOADS,
+                        help="実行するワークロード (複数指定可、省略時は全て)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="並列数")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="ワークロードごとのリクエスト数")
+    parser.add_argument("--products", type=int, default=1000,
+                        help="投入する商品数")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="乱数のシード")
+    parser.add_argument("--config", action="append", default=[],
+                        metavar="KEY=VALUE",
+                        help="create_app()に渡す設定 (複数指定可)")
+    parser.add_argument("--honor-retry-after", action="store_true",
+                        help="429/503の場合はRetry-Afterの秒数だけ待ってから次のリクエストを送る")
+    parser.add_argument("--output", help="結果を書き込むJSONファイル")
+    args = parser.parse_args(argv)
+
+    workloads = args.workload or WORKLOADS
+    names = random_names(args.products, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "bench.db"),
+        }
+        config.update(parse_config(args.config))
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+
+        # リクエストごとのアクセスログは計測の妨げになるため出力しない
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        report = {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "products": args.products,
+            "config": parse_config(args.config),
+            "workloads": {},
+        }
+        try:
+            for workload in workloads:
+                endpoints, elapsed = run_workload(
+                    server.port, workload, names,
+                    args.concurrency, args.requests, args.seed,
+                    args.honor_retry_after,
+                )
+                total = sum(e["requests"] for e in endpoints.values())
+                errors = sum(e["errors"] for e in endpoints.values())
+                report["workloads"][workload] = {
+                    "elapsed_seconds": elapsed,
+                    "throughput_rps": total / elapsed if elapsed else None,
+                    "error_rate": errors / total if total else None,
+                    "endpoints": endpoints,
+                }
+        finally:
+            server.shutdown()
+            with app.app_context():
+                db.engine.dispose()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from sqlalchemy import insert, select, update
+
+import queries
+from app import create_app
+from models import db, Stock, Sales
+
+
+# ----------------在庫と売上の読み書きの計測----------------
+# queries.py の作成済みのSQL文(Core)による処理と、変更前のORMによる処理を
+# 一時ディレクトリのSQLiteファイルで繰り返し実行し、1回あたりの時間を比較する
+# 1回ごとにリクエストの終了と同じくロールバックし、
+# トランザクションの開始とロールバックだけの時間を差し引いた値を出力する
+#
+# 実行例
+# $ python -m benchmarks.queries
+# $ python -m benchmarks.queries --number 20000 --products 100000
+
+# 計測に使う商品名
+NAME = "apple"
+
+
+# 変更前の在庫チェック (比較用)
+def legacy_get_amount():
+    stock = Stock.query.filter_by(name=NAME).first()
+    return stock.amount if stock else None
+
+# 変更前の在庫の追加
+def legacy_add_amount():
+    stock = Stock.query.filter_by(name=NAME).first()
+    if stock:
+        stock.amount += 1
+    else:
+        db.session.add(Stock(name=NAME, amount=1))
+    db.session.flush()
+
+# 変更前の販売の在庫の減算
+def legacy_decrement_amount():
+    result = db.session.execute(
+        update(Stock)
+        .where(Stock.name == NAME, Stock.amount >= 1)
+        .values(amount=Stock.amount - 1)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+# 変更前の売上チェック
+def legacy_get_total():
+    return db.session.scalar(select(Sales.cents).where(Sales.name == "sales")) or 0
+
+# 変更前の売上の加算
+def legacy_add_total():
+    result = db.session.execute(
+        update(Sales)
+        .where(Sales.name == "sales")
+        .values(cents=Sales.cents + 100)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.add(Sales(name="sales", cents=100))
+    db.session.flush()
+
+
+# (計測名, 変更前の処理, 変更後の処理) のリスト
+CASES = [
+    ("lookup", legacy_get_amount, lambda: queries.get_amount(NAME)),
+    ("upsert", legacy_add_amount, lambda: queries.add_amount(NAME, 1)),
+    ("decrement", legacy_decrement_amount, lambda: queries.decrement_amount(NAME, 1)),
+    ("total", legacy_get_total, queries.get_total),
+    ("add_total", legacy_add_total, lambda: queries.add_total(100)),
+]
+
+def populate(products):
+    db.session.execute(insert(Stock), [
+        {"name": "p{:07d}".format(i), "amount": 10} for i in range(products)
+    ])
+    db.session.execute(insert(Stock), [{"name": NAME, "amount": 10 ** 9}])
+    db.session.execute(insert(Sales), [{"name": "sales", "cents": 0}])
+    db.session.commit()
+
+# 1回ごとにロールバックして処理を実行する時間(マイクロ秒)
+def measure(handler, number, repeat):
+    def run():
+        handler()
+        db.session.rollback()
+
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best / number * 1e6
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在庫と売上の読み書きの計測")
+    parser.add_argument("--number", type=int, default=5000,
+                        help="1回の計測で実行する回数")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="計測の繰り返し回数 (最も速い結果を使う)")
+    parser.add_argument("--products", type=int, default=10000,
+                        help="登録しておく商品数")
+    args = parser.parse_args(argv)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "bench.db"),
+            "METRICS_ENABLED": False,
+        })
+        with app.app_context():
+            db.create_all()
+            populate(args.products)
+
+            baseline = measure(db.session.connection, args.number, args.repeat)
+            for name, legacy, current in CASES:
+                before = measure(legacy, args.number, args.repeat) - baseline
+                after = measure(current, args.number, args.repeat) - baseline
+                report[name] = {
+                    "orm_us": round(before, 2),
+                    "queries_us": round(after, 2),
+                    "speedup": round(before / after, 2),
+                }
+            db.session.remove()
+            db.engine.dispose()
+
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from flask import jsonify
+from sqlalchemy import insert
+
+import controller
+import json_provider
+from app import create_app
+from compression import response_compressor
+from models import db, Stock
+
+
+# ----------------在庫一覧のJSON化と圧縮の計測----------------
+# 一時ディレクトリのSQLiteファイルに指定した件数の商品を登録し、
+# GET /v1/stocks (全商品の在庫一覧) のレスポンスボディの作成時間を比較する
+#  - legacy:  変更前の処理 (ORMで全件を読み込み、行ごとのformat()のdictでupdate()する)
+#  - current: controller.build_stocks_v1() (行からそのまま1つのdictを作る)
+# それぞれをJSONプロバイダ(json_provider.py)ごとに計測し、
+# 作成したボディの圧縮(gzip、brotliがインストールされている場合はbrも)の時間とサイズも出力する
+# 在庫のキャッシュ(stock_cache.py)は使わず、毎回DBから読み込む
+#
+# 実行例
+# $ python -m benchmarks.serialization
+# $ python -m benchmarks.serialization --sizes 10000,100000,1000000 --repeat 1
+
+# 登録する際の1回のINSERTの件数
+CHUNK_SIZE = 10000
+
+
+# 変更前の在庫一覧の作成 (比較用)
+def legacy_build_stocks():
+    all_stocks = Stock.query.order_by(Stock.name).all()
+    response_data = {}
+    for stock in all_stocks:
+        response_data.update(stock.format())
+    return jsonify(response_data)
+
+# 商品名 (nameは英字8文字以内のため、数字を英字に置き換える)
+def product_name(i):
+    return "p" + "".join(chr(ord("a") + int(c)) for c in "{:07d}".format(i))
+
+def populate(size):
+    db.session.execute(db.delete(Stock))
+    for start in range(0, size, CHUNK_SIZE):
+        db.session.execute(insert(Stock), [
+            {"name": product_name(i), "amount": i % 1000}
+            for i in range(start, min(start + CHUNK_SIZE, size))
+        ])
+    db.session.commit()
+
+# build()を繰り返し実行し、最も速い時間(ミリ秒)とレスポンスボディを返す
+def measure(app, build, repeat):
+    best = None
+    body = None
+    for _ in range(repeat):
+        with app.test_request_context("/v1/stocks"):
+            start = time.perf_counter()
+            body = build().get_data()
+            seconds = time.perf_counter() - start
+            db.session.remove()
+        if best is None or seconds < best:
+            best = seconds
+    return best * 1000, body
+
+# bodyを圧縮する時間(ミリ秒)とサイズ
+def measure_compression(body, repeat):
+    result = {}
+    for encoding in response_compressor.encodings():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            compressed = response_compressor.encode(body, encoding)
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+        result[encoding] = {
+            "ms": round(best * 1000, 1),
+            "bytes": len(compressed),
+        }
+    return result
+
+def providers():
+    if json_provider.orjson is None:
+        return ["default"]
+    return ["default", "orjson"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在庫一覧のJSON化と圧縮の計測")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="商品数 (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="計測の繰り返し回数 (最も速い結果を使う)")
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(tmpdir, "bench.db"),
+            "METRICS_ENABLED": False,
+        })
+        with app.app_context():
+            db.create_all()
+
+            for size in sizes:
+                populate(size)
+                result = {}
+                for name in providers():
+                    app.json = json_provider.PROVIDERS[name](app)
+                    legacy_ms, legacy_body = measure(app, legacy_build_stocks, args.repeat)
+                    current_ms, body = measure(app, controller.build_stocks_v1, args.repeat)
+                    if json.loads(legacy_body) != json.loads(body):
+                        raise RuntimeError("response bodies differ")
+                    result[name] = {
+                        "legacy_ms": round(legacy_ms, 1),
+                        "current_ms": round(current_ms, 1),
+                        "speedup": round(legacy_ms / current_ms, 2),
+                    }
+                result["bytes"] = len(body)
+                result["compression"] = measure_compression(body, args.repeat)
+                report[str(size)] = result
+
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
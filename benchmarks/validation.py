@@ -0,0 +1,136 @@
+import argparse
+import json
+import sys
+import timeit
+
+from flask import Flask, abort, request
+
+import validation
+
+
+# ----------------リクエストボディの値チェックの計測----------------
+# validation.py のスキーマによる値チェックと、変更前の各エンドポイントの処理
+# (request.get_json()を項目ごとに呼び出し、条件を個別にチェックする) を
+# 同じリクエストボディで繰り返し実行し、1リクエストあたりの時間を比較する
+# DBへのアクセスは含まない
+# 結果はリクエストコンテキストの作成にかかる時間(何もしない処理の時間)を差し引いた値
+#
+# 実行例
+# $ python -m benchmarks.validation
+# $ python -m benchmarks.validation --number 20000 --items 100
+
+# 変更前の販売の値チェック (比較用)
+def legacy_sale(data):
+    if not isinstance(data, dict):
+        abort(400)
+
+    name = data.get('name')
+    amount = data.get('amount')
+    price = data.get('price')
+
+    if amount is None:
+        amount = 1
+    if name is None or not isinstance(name, str) or\
+    not name.isalpha() or len(name) > 8:
+        abort(400)
+    if not isinstance(amount, int) or not amount > 0:
+        abort(400)
+    if price is not None:
+        if not isinstance(price, int):
+            price = float(price)
+        if not price > 0:
+            abort(400)
+
+    return name, amount, price
+
+# 変更前の在庫の追加
+def legacy_add_stocks():
+    name = request.get_json().get('name')
+    amount = request.get_json().get('amount')
+    if name is None or not isinstance(name, str) or\
+       not name.isalpha() or len(name) > 8:
+        abort(400)
+    if amount is None:
+        amount = 1
+    if not isinstance(amount, int) or not amount > 0:
+        abort(400)
+    return request.get_json()
+
+# 変更前の販売
+def legacy_sale_stocks():
+    name, amount, price = legacy_sale(request.get_json())
+    return request.get_json()
+
+# 変更前のまとめて販売
+def legacy_sale_stocks_batch(max_items):
+    items = request.get_json().get('items')
+    if not isinstance(items, list) or not items or\
+       len(items) > max_items:
+        abort(400)
+    return [legacy_sale(item) for item in items]
+
+def add_stocks():
+    data = validation.json_body()
+    validation.validate(validation.STOCK, data)
+    return data
+
+def sale_stocks():
+    data = validation.json_body()
+    validation.validate(validation.SALE, data)
+    return data
+
+def sale_stocks_batch(max_items):
+    return validation.validate_items(validation.SALE, validation.json_body(), max_items)
+
+
+# (計測名, リクエストボディ, 変更前の処理, 変更後の処理) のリスト
+def cases(items):
+    batch = {"items": [{"name": "apple", "amount": 2, "price": 1.25}] * items}
+    return [
+        ("POST /v1/stocks", {"name": "apple", "amount": 10},
+         legacy_add_stocks, add_stocks),
+        ("POST /v1/sales", {"name": "apple", "amount": 2, "price": 1.25},
+         legacy_sale_stocks, sale_stocks),
+        ("POST /v1/sales/batch", batch,
+         lambda: legacy_sale_stocks_batch(items), lambda: sale_stocks_batch(items)),
+    ]
+
+# 1リクエストごとに新しいリクエストコンテキストを作成して処理を実行する時間(マイクロ秒)
+# リクエストボディのJSONの解釈を含めるため、コンテキストは毎回作り直す
+def measure(app, body, handler, number, repeat):
+    data = json.dumps(body)
+
+    def run():
+        with app.test_request_context("/", method="POST", data=data,
+                                      content_type="application/json"):
+            handler()
+
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best / number * 1e6
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="リクエストボディの値チェックの計測")
+    parser.add_argument("--number", type=int, default=5000,
+                        help="1回の計測で実行する回数")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="計測の繰り返し回数 (最も速い結果を使う)")
+    parser.add_argument("--items", type=int, default=50,
+                        help="まとめて販売の明細数")
+    args = parser.parse_args(argv)
+
+    app = Flask(__name__)
+    report = {}
+    for name, body, legacy, current in cases(args.items):
+        baseline = measure(app, body, lambda: None, args.number, args.repeat)
+        before = measure(app, body, legacy, args.number, args.repeat) - baseline
+        after = measure(app, body, current, args.number, args.repeat) - baseline
+        report[name] = {
+            "legacy_us": round(before, 2),
+            "validation_us": round(after, 2),
+            "speedup": round(before / after, 2),
+        }
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
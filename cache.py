@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# ----------------在庫データのキャッシュ----------------
+# 在庫の参照(GET /v1/stocks, GET /v1/stocks/<name>)は更新に比べて非常に多いため、
+# DBの手前にプロセス内のキャッシュを置く
+#  - 商品ごとの在庫数: LRU (上限件数を超えた場合は最も古く参照されたものから削除) + TTL
+#  - 全商品の在庫一覧と売上の合計: JSON化済みのレスポンスボディ + TTL
+# 在庫を更新する処理(在庫の追加、販売、全削除)はコミット後に該当する商品を無効化する
+#
+# レスポンスボディは作成したときの在庫と売上のバージョン(変更履歴の最新のseq)と合わせて持ち、
+# バージョンが変わっている場合は使わない (他のプロセスで更新された場合も古いボディを返さない)
+#
+# キャッシュはプロセスごとに持つため、複数プロセスで動かす場合は
+# 他のプロセスでの更新はTTLが切れるまで反映されない
+# (あるワーカーで在庫を追加した直後に、別のワーカーがTTL秒まで古い在庫数を返す)
+# serve.py は既定で複数のワーカーを起動するため、TTLの既定値は0 (キャッシュしない) とし、
+# 1プロセスで動かす場合などにSTOCK_CACHE_TTLを指定して有効にする
+class StockCache:
+
+    def __init__(self, maxsize=10000, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # レスポンスボディ (キー → [ボディ, バージョン, 期限])
+        # キーは "listing" (在庫一覧) と "sales" (売上の合計)
+        self._bodies = {}
+        # 無効化のたびに増やす世代番号 (在庫と売上のバージョン)
+        # DBから読み込んでいる間に更新があった場合に古い値をキャッシュしないために使う
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.body_hits = {}
+        self.body_misses = {}
+
+    # Flaskアプリケーションの設定からキャッシュの上限件数とTTL(秒)を読み込む
+    # TTLに0を指定した場合はキャッシュしない
+    def init_app(self, app):
+        app.config.setdefault("STOCK_CACHE_SIZE", 10000)
+        app.config.setdefault("STOCK_CACHE_TTL", 0)
+        self.maxsize = app.config["STOCK_CACHE_SIZE"]
+        self.ttl = app.config["STOCK_CACHE_TTL"]
+        self.clear()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    # 商品の在庫数を取得する
+    # キャッシュにない、または期限切れの場合はNoneを返す
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry[0]
+
+    # 商品の在庫数をキャッシュする
+    # generationは読み込み前に取得した世代番号で、その後に無効化があった場合は保存しない
+    def set(self, name, amount, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[name] = (amount, time.monotonic() + self.ttl)
+            self._entries.move_to_end(name)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # バージョンがversionのレスポンスボディを取得する
+    # キャッシュにない、期限切れ、またはバージョンが異なる場合はNoneを返す
+    def get_body(self, key, version):
+        with self._lock:
+            entry = self._bodies.get(key)
+            if entry is None or entry[1] != version or entry[2] < time.monotonic():
+                self.body_misses[key] = self.body_misses.get(key, 0) + 1
+                return None
+            self.body_hits[key] = self.body_hits.get(key, 0) + 1
+            return entry[0]
+
+    # レスポンスボディをバージョンと合わせてキャッシュする
+    # versionはボディを作成する前に取得したバージョン
+    def set_body(self, key, body, version):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._bodies[key] = [body, version, time.monotonic() + self.ttl]
+
+    # 指定した商品と在庫一覧、売上の合計を無効化する
+    def invalidate(self, *names):
+        with self._lock:
+            self._generation += 1
+            for name in names:
+                self._entries.pop(name, None)
+            for entry in self._bodies.values():
+                entry[2] = 0
+
+    # 全て無効化する
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bodies.clear()
+
+    # ヒット数・ミス数などの統計情報
+    def stats(self):
+        with self._lock:
+            return {
+                "stocks": {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries),
+                },
+                "listing": {
+                    "hits": self.body_hits.get("listing", 0),
+                    "misses": self.body_misses.get("listing", 0),
+                },
+                "sales": {
+                    "hits": self.body_hits.get("sales", 0),
+                    "misses": self.body_misses.get("sales", 0),
+                },
+            }
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        stats = self.stats()
+        return [
+            ("stock_cache_hits_total", "counter", "Stock cache hits.", [
+                ({"cache": "stocks"}, stats["stocks"]["hits"]),
+                ({"cache": "listing"}, stats["listing"]["hits"]),
+                ({"cache": "sales"}, stats["sales"]["hits"]),
+            ]),
+            ("stock_cache_misses_total", "counter", "Stock cache misses.", [
+                ({"cache": "stocks"}, stats["stocks"]["misses"]),
+                ({"cache": "listing"}, stats["listing"]["misses"]),
+                ({"cache": "sales"}, stats["sales"]["misses"]),
+            ]),
+            ("stock_cache_entries", "gauge", "Cached stock entries.", [
+                ({}, stats["stocks"]["size"]),
+            ]),
+        ]
+
+
+# StockCacheインスタンスの作成
+stock_cache = StockCache()
@@ -0,0 +1,197 @@
+import threading
+import time
+
+from sqlalchemy import delete, event, func, insert, select, text
+from werkzeug.exceptions import ServiceUnavailable
+from sqlalchemy.orm import Session
+from models import db, Stock, StockChange
+import low_stock
+
+
+# ----------------変更履歴 (change feed)----------------
+# 在庫と売上を変更する処理(在庫の追加、一括登録、販売、全削除)は、
+# 変更と同じトランザクションでstock_changesテーブルに変更内容を1行追加する
+# GET /v1/changes?since=<seq> はseqがsinceより大きい変更だけを返すため、
+# 参照側は全商品の在庫を取得し直さずに、変更された分だけを受け取れる
+#
+# 変更の種類(kind)
+#  - stock: 在庫の追加 (amountは増えた数)
+#  - sale:  販売 (amountは減った数を負の値で、centsは売上の増加分)
+#  - reset: 全削除 (これより前の変更と状態は全て破棄する)
+# stockには変更後の在庫数を記録するため、同じ変更を2回適用しても結果は変わらない
+# 全削除のときは、それより前の変更履歴を削除する
+#
+# 同じプロセスの変更はコミット後にすぐ待っているリクエストに通知し、
+# 他のプロセスの変更はCHANGES_POLL_INTERVAL秒ごとにDBを確認して検出する
+#
+# 変更を待つリクエスト(ロングポーリング、Server-Sent Events)は待っている間も
+# ワーカーのスレッドを1つ占有する (serve.pyの既定は1ワーカーあたり4スレッド)
+# 待つリクエストだけでスレッドが埋まり、在庫チェックや販売を処理できなくならないように、
+# 同時に待つリクエストをプロセスごとにCHANGES_MAX_STREAMS件までにし、
+# それ以上は503 (Retry-Afterヘッダー付き) を返す
+
+
+# 変更を記録する
+# deltasは (name, 在庫数の増減, 売上の増減(セント)) のリスト
+# 変更後の在庫数は同じトランザクションの中で読み込む
+# 読み込んだ在庫数で発注点(low_stock.py)も確認する
+def record_changes(kind, deltas, session=None):
+    if session is None:
+        session = db.session
+    if not deltas:
+        return
+
+    names = {name for name, _, _ in deltas}
+    stocks = dict(
+        session.execute(
+            select(Stock.name, Stock.amount).where(Stock.name.in_(names))
+        ).all()
+    )
+    low_stock.track({name: stocks.get(name, 0) for name in names}, session)
+    lock_changes(session)
+    changed_at = int(time.time())
+    session.execute(
+        insert(StockChange),
+        [
+            {"kind": kind, "name": name, "amount": amount,
+             "stock": stocks.get(name, 0), "cents": cents, "changed_at": changed_at}
+            for name, amount, cents in deltas
+        ],
+    )
+    session.info["stock_changes"] = True
+
+# 全削除を記録し、それより前の変更履歴を削除する
+# (最新の行は残すため、削除後もseqは小さくならない)
+def record_reset(session=None):
+    if session is None:
+        session = db.session
+
+    lock_changes(session)
+    result = session.execute(
+        insert(StockChange).values(
+            kind="reset", name="", amount=0, stock=0, cents=0,
+            changed_at=int(time.time()),
+        )
+    )
+    seq = result.inserted_primary_key[0]
+    session.execute(delete(StockChange).where(StockChange.seq < seq))
+    session.info["stock_changes"] = True
+
+# PostgreSQLではseqの採番順とコミット順が入れ替わると、参照側が先にコミットされた
+# 大きいseqを受け取った後で小さいseqの変更を取りこぼすため、
+# 変更履歴への書き込みをテーブルロックでコミットまで1つずつにする
+# (参照はブロックしない。SQLiteは書き込みが常に1つずつのため不要)
+def lock_changes(session):
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("LOCK TABLE stock_changes IN SHARE ROW EXCLUSIVE MODE"))
+
+# 最新のseq (変更がない場合は0)
+def latest_seq(session=None):
+    if session is None:
+        session = db.session
+    return session.scalar(select(func.max(StockChange.seq))) or 0
+
+# 最新の変更の (seq, 変更日時(UNIX時間)) (変更がない場合は (0, None))
+def latest_change(session=None):
+    if session is None:
+        session = db.session
+    row = session.execute(
+        select(StockChange.seq, StockChange.changed_at)
+        .order_by(StockChange.seq.desc())
+        .limit(1)
+    ).first()
+    if row is None:
+        return 0, None
+    return row.seq, row.changed_at
+
+# seqがsinceより大きい変更を古い順にlimit件まで返す
+def fetch_changes(since, limit, session=None):
+    if session is None:
+        session = db.session
+    return session.scalars(
+        select(StockChange)
+        .where(StockChange.seq > since)
+        .order_by(StockChange.seq)
+        .limit(limit)
+    ).all()
+
+
+class ChangeNotifier:
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self._lock = threading.Lock()
+        self.max_streams = 2
+        self.streams = 0
+        self.rejected = 0
+
+    # Flaskアプリケーションの設定を読み込み、コミット時に変更を通知するイベントを登録する
+    def init_app(self, app):
+        app.config.setdefault("CHANGES_PAGE_MAX_LIMIT", 1000)
+        app.config.setdefault("CHANGES_MAX_WAIT", 10)
+        app.config.setdefault("CHANGES_POLL_INTERVAL", 0.5)
+        app.config.setdefault("CHANGES_HEARTBEAT", 15)
+        app.config.setdefault("CHANGES_STREAM_SECONDS", 60)
+        app.config.setdefault("CHANGES_MAX_STREAMS", 2)
+        self.max_streams = app.config["CHANGES_MAX_STREAMS"]
+
+        if not event.contains(Session, "after_commit", _after_commit):
+            event.listen(Session, "after_commit", _after_commit)
+            event.listen(Session, "after_rollback", _after_rollback)
+
+    # 通知を受け取るたびに増える番号
+    @property
+    def version(self):
+        return self._version
+
+    # 変更を待っているリクエストに通知する
+    def notify(self):
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+
+    # versionから変わる(通知がある)まで最大timeout秒待つ
+    def wait(self, version, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+
+    # 変更を待つリクエストの枠を1つ確保する
+    # CHANGES_MAX_STREAMS件を超える場合は503にする (0の場合は制限しない)
+    def open_stream(self):
+        with self._lock:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.rejected += 1
+                raise ServiceUnavailable(retry_after=1)
+            self.streams += 1
+
+    # 変更を待つリクエストの枠を空ける
+    def close_stream(self):
+        with self._lock:
+            self.streams -= 1
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        return [
+            ("changes_streams", "gauge", "Long-poll and event-stream requests waiting for changes.", [
+                ({}, self.streams),
+            ]),
+            ("changes_streams_rejected_total", "counter",
+             "Long-poll and event-stream requests rejected because the limit was reached.", [
+                ({}, self.rejected),
+            ]),
+        ]
+
+
+# ----------------SQLAlchemyのイベント----------------
+
+def _after_commit(session):
+    if session.info.pop("stock_changes", False):
+        change_notifier.notify()
+
+def _after_rollback(session):
+    session.info.pop("stock_changes", None)
+
+
+# ChangeNotifierインスタンスの作成
+change_notifier = ChangeNotifier()
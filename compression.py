@@ -0,0 +1,112 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# ----------------レスポンスの圧縮----------------
+# 全商品の在庫一覧などの大きいレスポンスは、リクエストのAccept-Encodingヘッダーに合わせて
+# brotli (br) またはgzipで圧縮して返す (どちらも受け付ける場合はbrotliを優先する)
+#  - COMPRESS_MIN_SIZEバイト未満のレスポンスは圧縮しない (圧縮しても小さくならないため)
+#  - 対象はCOMPRESS_MIMETYPESのレスポンスで、ステータスが200のもののみ
+#    ストリーミングのレスポンス(stream=1、Server-Sent Events)は少しずつ送るため圧縮しない
+#  - ETagのあるレスポンスは、同じ内容を何度も圧縮しないように圧縮結果を
+#    (ETag, 圧縮形式) ごとにCOMPRESS_CACHE_SIZE件までキャッシュする
+#    圧縮したレスポンスのETagは弱いETag(W/"...")にする (If-None-Matchは弱い比較のため304を返せる)
+#  - brotliは brotli パッケージがインストールされている場合のみ使う
+#
+# Content-Encodingについては下記ページなどを参照
+# https://developer.mozilla.org/ja/docs/Web/HTTP/Headers/Content-Encoding
+
+
+class ResponseCompressor:
+
+    def __init__(self):
+        self.min_size = 1024
+        self.gzip_level = 6
+        self.brotli_quality = 5
+        self.mimetypes = set()
+        self.cache_size = 16
+        self._lock = threading.Lock()
+        # (ETag, 圧縮形式) → 圧縮したボディ
+        self._cache = OrderedDict()
+
+    # Flaskアプリケーションの設定を読み込み、レスポンスを圧縮する処理を登録する
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_ENABLED", True)
+        app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+        app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+        app.config.setdefault("COMPRESS_MIMETYPES", [
+            "application/json", "application/x-ndjson", "text/csv", "text/plain",
+        ])
+        app.config.setdefault("COMPRESS_CACHE_SIZE", 16)
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        self.gzip_level = app.config["COMPRESS_GZIP_LEVEL"]
+        self.brotli_quality = app.config["COMPRESS_BROTLI_QUALITY"]
+        self.mimetypes = set(app.config["COMPRESS_MIMETYPES"])
+        self.cache_size = app.config["COMPRESS_CACHE_SIZE"]
+        with self._lock:
+            self._cache.clear()
+
+        if app.config["COMPRESS_ENABLED"]:
+            app.after_request(self._compress)
+
+    # 使える圧縮形式 (優先する順)
+    def encodings(self):
+        return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def _compress(self, response):
+        if response.status_code != 200 or response.direct_passthrough or\
+           response.is_streamed or "Content-Encoding" in response.headers or\
+           response.mimetype not in self.mimetypes:
+            return response
+
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        # Accept-Encodingによってレスポンスが変わることを中間のキャッシュに伝える
+        response.vary.add("Accept-Encoding")
+
+        encoding = request.accept_encodings.best_match(self.encodings())
+        if encoding is None:
+            return response
+
+        etag, _ = response.get_etag()
+        response.set_data(self.encode(data, encoding, etag))
+        response.headers["Content-Encoding"] = encoding
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
+    # dataを圧縮する
+    # etagを指定した場合は圧縮結果をキャッシュする
+    def encode(self, data, encoding, etag=None):
+        if etag is not None:
+            with self._lock:
+                body = self._cache.get((etag, encoding))
+                if body is not None:
+                    self._cache.move_to_end((etag, encoding))
+                    return body
+
+        if encoding == "br":
+            body = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            body = gzip.compress(data, self.gzip_level, mtime=0)
+
+        if etag is not None and self.cache_size > 0:
+            with self._lock:
+                self._cache[(etag, encoding)] = body
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return body
+
+
+# ResponseCompressorインスタンスの作成
+response_compressor = ResponseCompressor()
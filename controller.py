@@ -1,5 +1,25 @@
-from flask import jsonify, request, abort, make_response
-from models import db, Stock, Sales
+import json
+import time
+from datetime import datetime, timezone
+from itertools import islice
+
+from flask import jsonify, request, abort, make_response, current_app, stream_with_context
+from sqlalchemy import select
+from werkzeug.http import is_resource_modified
+from models import db, Stock, Sales, ProductSales, SalesRollup
+import change_feed
+import low_stock
+import queries
+import reset_engine
+import sale_engine
+import stock_import
+import validation
+from cache import stock_cache
+from change_feed import change_notifier
+from idempotency import idempotency_store
+from metrics import metrics
+from sharding import shard_router
+from write_behind import sale_coalescer
 
 
 # ----------------API のエンドポイントを定義----------------
@@ -11,20 +31,170 @@ from models import db, Stock, Sales
 
 
 # 在庫チェック
+# クエリパラメータを指定しない場合は全商品の在庫を1つのJSONで返す
+#  - limit: 1回に返す件数 (nameの昇順)
+#  - after: 前回のレスポンスの最後のname (この商品より後ろの商品を返す)
+#  - stream=1: 全商品の在庫をDBから少しずつ読み込みながらJSONを返す
+#              (afterと一緒に指定できる。limitと一緒に指定した場合は400エラーとする)
+#  - low=1: 発注点を下回っている商品だけを返す (retrieve_low_stocks_v1)
+# limitを指定した場合、続きがあるときは次のafterの値をX-Next-Cursorヘッダーと
+# Linkヘッダーで返す
 def retrieve_stocks_v1():
-    if request.method == 'GET':
-        # nameをキーにして昇順ソートする
-        all_stocks = Stock.query.order_by(Stock.name).all()
-        
-        # stocksテーブルの全てのデータをリストとしてJSON化してレスポンスとして返す
-        # レスポンス ステータスを200に設定
-        response_data = {}
-        for stock in all_stocks:
-            response_data.update(stock.format())
-        return jsonify(response_data), 200
+    if request.method in ('GET', 'HEAD'):
+        if "low" in request.args:
+            if request.args["low"] != "1":
+                abort(400)
+            return retrieve_low_stocks_v1()
+
+        if "limit" in request.args or "after" in request.args or\
+           "stream" in request.args:
+            return retrieve_stocks_page_v1()
+
+        return cached_json_response("listing", build_stocks_v1)
+
+# 全商品の在庫一覧のレスポンスを作成する
+def build_stocks_v1():
+    # nameをキーにして昇順ソートする
+    # シャーディングしている場合は各シャードの結果をマージする
+    all_stocks = shard_router.merged(
+        select(Stock.name, Stock.amount).order_by(Stock.name)
+    )
+    
+    # stocksテーブルの全てのデータをJSON化する
+    # (name, amount)の行からそのまま1つのdictを作り、行ごとのdictは作らない
+    return jsonify(dict(iter(all_stocks)))
+
+# 在庫と売上のJSONレスポンスボディを返す
+# 在庫と売上のバージョン(inventory_version())からETagとLast-Modifiedヘッダーを付け、
+# リクエストのIf-None-Match (またはIf-Modified-Since) が一致する場合は
+# ボディを作成せずにボディなしの304を返す
+# 一致しない場合は、キャッシュに同じバージョンのボディがあればそれを返し、
+# なければbuild()でレスポンスを作成してキャッシュする
+# バージョンは全てのプロセスで共有するDBから読み込むため、どのワーカーでも同じETagになる
+# ボディはバージョンを読み込んだ後に作成するため、ETagのバージョン以降の内容になる
+# ETagは圧縮(compression.py)したレスポンスと同じく常に弱いETag(W/"...")にする
+# 条件付きリクエストについては下記ページなどを参照
+# https://developer.mozilla.org/ja/docs/Web/HTTP/Conditional_requests
+def cached_json_response(key, build):
+    version, last_modified = inventory_version()
+    etag = "{}-{}".format(key, version)
+
+    response = current_app.response_class(mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # クライアントのキャッシュは毎回ETagで確認してから使わせる
+    response.cache_control.no_cache = True
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    body = stock_cache.get_body(key, version)
+    if body is None:
+        body = build().get_data()
+        stock_cache.set_body(key, body, version)
+    response.set_data(body)
+    return response
+
+# 在庫と売上のバージョン
+# 在庫と売上を変更する処理は必ず変更履歴(change_feed.py)に1行追加するため、
+# 変更履歴の最新のseqをバージョンとする
+# シャーディングしている場合は各シャードのseqを"."でつなげる
+# (バージョン, 最新の変更の日時) を返す (変更がない場合の日時はNone)
+def inventory_version():
+    seqs = []
+    changed_at = None
+    for session in shard_router.sessions():
+        seq, changed = change_feed.latest_change(session)
+        seqs.append(str(seq))
+        if changed is not None and (changed_at is None or changed > changed_at):
+            changed_at = changed
+    if changed_at is not None:
+        changed_at = datetime.fromtimestamp(changed_at, timezone.utc)
+    return ".".join(seqs), changed_at
+
+# 在庫チェック (ページング、ストリーミング)
+# nameは主キーのため、"name > after" の条件で検索すれば
+# OFFSETのように読み飛ばす行を数えることなくインデックスで続きから取得できる
+def retrieve_stocks_page_v1():
+    after = request.args.get("after")
+    limit = request.args.get("limit")
+    stream = request.args.get("stream") == "1"
+
+    # afterの値チェック
+    # 商品名と同じ条件でチェックし、ERRORとなる場合は400エラーとする
+    if after is not None and\
+       (not after.isalpha() or len(after) > 8):
+        abort(400)
+
+    # limitの値チェック
+    # 1以上、STOCKS_PAGE_MAX_LIMIT以下の整数であること
+    if limit is not None:
+        if not limit.isdigit() or\
+           not 0 < int(limit) <= current_app.config["STOCKS_PAGE_MAX_LIMIT"]:
+            abort(400)
+        limit = int(limit)
+
+    # ストリーミングは全件を返すため、件数の指定とは一緒に使えない
+    if stream and limit is not None:
+        abort(400)
+
+    query = select(Stock.name, Stock.amount).order_by(Stock.name)
+    if after is not None:
+        query = query.where(Stock.name > after)
+
+    if stream:
+        return stream_stocks_v1(query)
+
+    # limitを省略した場合は最大件数まで返す
+    if limit is None:
+        limit = current_app.config["STOCKS_PAGE_MAX_LIMIT"]
+
+    # 続きがあるかどうか判定するため1件多く取得する
+    rows = list(islice(shard_router.merged(query.limit(limit + 1)), limit + 1))
+    response = jsonify(dict(rows[:limit]))
+
+    if len(rows) > limit:
+        cursor = rows[limit - 1][0]
+        response.headers["X-Next-Cursor"] = cursor
+        response.headers["Link"] = '<{}?limit={}&after={}>; rel="next"'.format(
+            request.base_url, limit, cursor
+        )
+    return response, 200
+
+# 在庫チェック (ストリーミング)
+# サーバーサイドカーソルから一定件数ずつ読み込み、JSONを少しずつ返す
+# レスポンス全体をメモリに持たないため、商品数が多くてもメモリ使用量は一定になる
+# ストリーミングについては下記ページなどを参照
+# https://flask.palletsprojects.com/en/3.0.x/patterns/streaming/
+def stream_stocks_v1(query):
+    batch_size = current_app.config["STOCKS_STREAM_BATCH_SIZE"]
+    dumps = json.dumps
+
+    def generate():
+        result = iter(shard_router.merged(
+            query.execution_options(yield_per=batch_size)
+        ))
+        yield "{"
+        first = True
+        while True:
+            rows = list(islice(result, batch_size))
+            if not rows:
+                break
+            chunk = ",".join(
+                dumps(name) + ":" + str(amount) for name, amount in rows
+            )
+            if not first:
+                chunk = "," + chunk
+            first = False
+            yield chunk
+        yield "}"
+
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype="application/json"
+    ), 200
 
 def retrieve_stock_v1(name):
-    if request.method == 'GET':
+    if request.method in ('GET', 'HEAD'):
 
         # nameの値チェック
         # ERRORとなる場合は400エラーとする
@@ -32,176 +202,490 @@ def retrieve_stock_v1(name):
            not name.isalpha() or len(name) > 8:
             abort(400)
         
-        # URLの<name>部分で指定した名前の商品をstocksテーブルから探す
-        stock = Stock.query.filter_by(name=name).first()
-        if stock:
-            # 在庫がある場合
-            # テーブルから見つけたデータをJSONレスポンスとして返す
+        # キャッシュにある場合はDBを参照せずに返す
+        amount = stock_cache.get(name)
+        if amount is not None:
             return jsonify(
-                stock.format()
-            ), 200
-        else:
-            # 在庫がない場合
-            # amountを0としてJSONレスポンスを返す
-            return jsonify(
-                {name: 0}
+                {name: amount}
             ), 200
+        generation = stock_cache.generation
+
+        # URLの<name>部分で指定した名前の商品の在庫数をstocksテーブルから探す
+        # 在庫がない場合はamountを0としてJSONレスポンスを返す
+        amount = queries.get_amount(name, shard_router.session_for(name)) or 0
+        stock_cache.set(name, amount, generation)
+        return jsonify(
+            {name: amount}
+        ), 200
+
+# 発注点を下回っている商品の在庫チェック
+# 商品ごとの在庫数と発注点を返す
+# 下回っている商品だけをインデックスで読み込むため、在庫の全件は読み込まない
+# (GET /v1/stocks?low=1 で呼び出す。/v1/stocks/<name>の商品名と重ならないようにクエリパラメータにする)
+def retrieve_low_stocks_v1():
+    response_data = {}
+    for session in shard_router.sessions():
+        for name, amount, threshold in low_stock.low_stocks(session):
+            response_data[name] = {"amount": amount or 0, "threshold": threshold}
+    return jsonify(response_data), 200
+
+# 発注点の設定
+# リクエストボディの"threshold"(1以上の整数)を発注点とし、在庫数がそれを下回ると
+# GET /v1/stocks?low=1 に含まれる (LOW_STOCK_WEBHOOK_URLを指定した場合は通知も送る)
+def set_threshold_v1(name):
+    if not name.isalpha() or len(name) > 8:
+        abort(400)
+    (threshold,) = validation.validate(validation.THRESHOLD, validation.json_body())
+
+    session = shard_router.session_for(name)
+    amount, low = low_stock.set_threshold(name, threshold, session)
+    session.commit()
+    return jsonify(
+        {"name": name, "threshold": threshold, "amount": amount, "low": low}
+    ), 200
+
+# 発注点の設定の削除
+# 設定されていない場合は404エラーとする
+def delete_threshold_v1(name):
+    if not name.isalpha() or len(name) > 8:
+        abort(400)
+
+    session = shard_router.session_for(name)
+    if not low_stock.delete_threshold(name, session):
+        abort(404)
+    session.commit()
+    return jsonify(
+        {}
+    ), 200
 
 # 在庫の更新、作成
 def add_stocks_v1():
     if request.method == 'POST':
         
-        # リクエストボディからnameとamountの値を取得する
-        name = request.get_json().get('name')
-        amount = request.get_json().get('amount')
-        
-        # nameの値チェック
-        # ERRORとなる場合は400エラーとする
-        if name is None or not isinstance(name, str) or\
-           not name.isalpha() or len(name) > 8:
-            abort(400)
-        
-        # amountの値チェック
+        # リクエストボディからnameとamountの値を取得して値をチェックする
         # amountがリクエストボディに含まれない場合amount = 1とする
-        if amount is None:
-            amount = 1
-        # ERRORとなる場合400エラーとする
-        if not isinstance(amount, int) or not amount > 0:
-            abort(400)
-            
-        # 指定した名前の商品をstocksテーブルから探す
-        stock = Stock.query.filter_by(name=name).first()
-        if stock:
-            # 存在する場合更新する
-            # amountをプラスする
-            stock.amount += amount
-
-        else:
-            # 存在しない場合作成する
-            # 指定したamountでテーブルにデータを追加する
-            stock = Stock(name=name, amount=amount)
-            db.session.add(stock)
-        # DBテーブルの更新を実行
-        db.session.commit()
-        
+        # ERRORとなる場合は400エラーとする
+        data = validation.json_body()
+        name, amount = validation.validate(validation.STOCK, data)
+
         # responseインスタンスをつくる
         # リクエストボディのJSONと同じデータに設定する
         response = make_response(
-            request.get_json()
+            data
         )
         
         # レスポンスヘッダの設定
         response.headers["Location"] = request.base_url + "/" + name
+
+        # Idempotency-Keyが処理済みの場合は保存したレスポンスを返す
+        # 未処理の場合はDBテーブルの更新と同じコミットでresponseを保存する
+        session = shard_router.session_for(name)
+        replayed = idempotency_store.begin(response, session)
+        if replayed is not None:
+            return replayed
+            
+        # 指定した名前の商品が存在する場合はamountをプラスし、
+        # 存在しない場合は指定したamountでテーブルにデータを追加する
+        queries.add_amount(name, amount, session)
+        # 変更履歴を追加してDBテーブルの更新を実行
+        change_feed.record_changes("stock", [(name, amount, 0)], session)
+        session.commit()
+        stock_cache.invalidate(name)
+        sale_coalescer.forget(name)
         return response
 
+# 在庫の一括登録
+# リクエストボディのNDJSON (Content-Type: application/x-ndjson) または
+# CSV (Content-Type: text/csv) を1行ずつ読み込んでまとめて登録する
+# 値チェックでERRORとなった行は登録せず、件数だけをレスポンスで返す
+def add_stocks_bulk_v1():
+    fmt = "csv" if request.mimetype == "text/csv" else "ndjson"
+    imported, rejected = stock_import.import_stocks(
+        request.stream, fmt, current_app.config["STOCK_IMPORT_CHUNK_SIZE"]
+    )
+    # 登録した商品は多数になるためキャッシュは全て無効化する
+    stock_cache.clear()
+    sale_coalescer.forget_all()
+    return jsonify(
+        {"imported": imported, "rejected": rejected}
+    ), 200
+
 # 販売
 def sale_stocks_v1():
-    
-    # リクエストボディからname, amount, priceのデータを取得
-    name = request.get_json().get('name')
-    amount = request.get_json().get('amount')
-    price = request.get_json().get('price')
-    
-    # amountが指定されていない場合は1に設定する
-    if amount is None:
-        amount = 1
-    
-    # nameの値の条件チェック
-    # 商品名は8文字以内であること、アルファベット小文字または大文字のみを含むこと
-    if name is None or not isinstance(name, str) or\
-    not name.isalpha() or len(name) > 8:
-        abort(400)
-    
-    # amountの値の条件チェック
-    # 整数であること、0より大きいこと
-    if not isinstance(amount, int) or not amount > 0:
-        abort(400)
-    
-    # 指定商品の在庫があるかどうかチェック
-    # 在庫数が不足の場合400エラー
-    stock = Stock.query.filter_by(name=name).first()
-    if stock is None or stock.amount < amount:
-        abort(400)
 
-    # priceが指定されていない場合
-    if price is None:
-        # 販売分だけ在庫を減らす    
-        stock.amount -= amount
-        db.session.commit()
-        
-        # レスポンスのボディをリクエストボディと同じ内容にする
-        response = make_response(
-            request.get_json()
-        )
-        # ヘッダーを指定してレスポンスを返す
-        response.headers["Location"] = request.base_url + "/" + name
-        return response
-    else:
-        price = float(price)
-        
-    # priceの値の条件チェック
-    # floatタイプであること、0より大きいこと
-    if not isinstance(price, float) or not price > 0:
-        abort(400)
-        
-    # 販売分だけ在庫を減らす    
-    stock.amount -= amount
-    db.session.commit()
-    
-    # salesテーブルの"sales"データの取得
-    sales = Sales.query.filter_by(name="sales").first()
-    
-    # データがない場合はテーブルに追加する
-    if sales is None:
-        sales = Sales(name="sales")
-        db.session.add(sales)
-        db.session.commit()
-    
-    # 売上に販売価格 x 数量 を加算
-    sales.sales += price * amount
-    db.session.commit()
-    
+    # リクエストボディからname, amount, priceのデータを取得して値をチェックする
+    # ERRORとなる場合は400エラーとする
+    data = validation.json_body()
+    name, amount, price = validation.validate(validation.SALE, data)
+
     # レスポンスのボディをリクエストボディと同じ内容にする
     response = make_response(
-        request.get_json()
+        data
     )
-    
+
     # レスポンスヘッダーの設定
     response.headers["Location"] = request.base_url + "/" + name
+
+    # Idempotency-Keyが処理済みの場合は保存したレスポンスを返す
+    # 未処理の場合は在庫の減算と同じコミットでresponseを保存する
+    session = shard_router.session_for(name)
+    replayed = idempotency_store.begin(response, session)
+    if replayed is not None:
+        return replayed
+
+    # 在庫の減算と売上の加算を1トランザクションで実行する
+    # 遅延書き込みが有効な場合はジャーナルに書き込み、DBにはまとめて反映する
+    # 在庫が存在しない、または在庫数が不足の場合400エラー
+    if sale_coalescer.enabled:
+        if not sale_coalescer.submit([(name, amount, price)])[0]:
+            abort(400)
+        idempotency_store.commit()
+    else:
+        if not sale_engine.sell(name, amount, price, session):
+            abort(400)
+        stock_cache.invalidate(name)
     return response
 
+# まとめて販売
+# リクエストボディの"items"に複数の販売データを指定する
+# 全ての明細の値チェックを行い、1つでも不正な明細がある場合は400エラーとする
+# 在庫の取得は1回のIN検索、在庫の減算と売上の加算は1トランザクションで行い、
+# 明細ごとの結果("OK"または在庫不足の"ERROR")を返す
+def sale_stocks_batch_v1():
+
+    items, lines = validation.validate_items(
+        validation.SALE, validation.json_body(),
+        current_app.config["SALES_BATCH_MAX_ITEMS"],
+    )
+    if sale_coalescer.enabled:
+        results = sale_coalescer.submit(lines)
+    else:
+        # シャーディングしている場合はシャードごとにまとめて販売する
+        names = [name for name, _, _ in lines]
+        results = [False] * len(lines)
+        for session, indexes in shard_router.group(names):
+            shard_results = sale_engine.sell_batch([lines[i] for i in indexes], session)
+            for i, ok in zip(indexes, shard_results):
+                results[i] = ok
+        stock_cache.invalidate(*set(names))
+
+    # 明細ごとにリクエストの内容と結果を返す
+    response_data = []
+    for item, ok in zip(items, results):
+        line = dict(item)
+        line["result"] = "OK" if ok else "ERROR"
+        response_data.append(line)
+    return jsonify(
+        {"items": response_data}
+    ), 200
+
 # 売上チェック
+# クエリパラメータを指定しない場合は売上の合計を返す
+#  - by=product: 商品ごとの販売数と売上を返す (nameで商品を指定可)
+#  - bucket=minute|hour|day: 時間単位ごとの販売数と売上を返す
+#    (nameで商品、from/toでISO 8601形式の期間、limitで件数を指定可)
+# いずれも販売のたびに更新している集計テーブルから返すため、販売の履歴は読み込まない
 def check_sales_v1():
-    
+    if "by" in request.args:
+        return check_product_sales_v1()
+    if "bucket" in request.args:
+        return check_sales_rollups_v1()
+
+    return cached_json_response("sales", build_sales_v1)
+
+# 売上の合計のレスポンスを作成する
+def build_sales_v1():
     # salesテーブルのname="sales"行データを取得
-    sales = Sales.query.filter_by(name="sales").first()
-    
-    # データがない場合は"sales"行データを作成する
-    if sales is None:
-        sales = Sales(name="sales")
-        db.session.add(sales)
-        db.session.commit()
+    # シャーディングしている場合は各シャードの"sales"行の合計を売上とする
+    # データがない場合は売上を0とする
+    # (参照だけで書き込まない。"sales"行は最初の売上の加算で作成される)
+    total = Sales(name="sales", cents=0)
+    for session in shard_router.sessions():
+        total.cents += queries.get_total(session)
     
-    # "sales"行のデータを JSON 化して返す
+    # "sales"行のデータを JSON 化する
+    return jsonify(
+        total.format()
+    )
+
+# クエリパラメータのnameの値チェック
+# 指定されていない場合はNone、ERRORとなる場合は400エラーとする
+def name_arg():
+    name = request.args.get("name")
+    if name is not None and (not name.isalpha() or len(name) > 8):
+        abort(400)
+    return name
+
+# クエリパラメータの日時(ISO 8601形式)をUNIX時間の秒に変換する
+# タイムゾーンの指定がない場合はUTCとする
+def datetime_arg(key):
+    value = request.args.get(key)
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+# 商品ごとの売上チェック
+def check_product_sales_v1():
+    if request.args.get("by") != "product":
+        abort(400)
+    name = name_arg()
+
+    query = select(ProductSales).order_by(ProductSales.name)
+    if name is not None:
+        query = query.filter_by(name=name)
+
+    # 商品ごとの集計は商品と同じシャードにあるため、各シャードの結果をまとめるだけでよい
+    response_data = {}
+    for session in shard_router.sessions():
+        for product in session.scalars(query):
+            response_data.update(product.format())
+    return jsonify(response_data), 200
+
+# 時間単位ごとの売上チェック
+# 新しい方からlimit件の集計期間を、古い順に並べて返す
+def check_sales_rollups_v1():
+    granularity = request.args.get("bucket")
+    if granularity not in sale_engine.GRANULARITIES:
+        abort(400)
+    name = name_arg()
+    start = datetime_arg("from")
+    end = datetime_arg("to")
+
+    max_limit = current_app.config["SALES_ROLLUP_MAX_BUCKETS"]
+    limit = request.args.get("limit", str(max_limit))
+    if not limit.isdigit() or not 0 < int(limit) <= max_limit:
+        abort(400)
+
+    query = select(SalesRollup.bucket, SalesRollup.amount, SalesRollup.cents).where(
+        SalesRollup.granularity == granularity,
+        SalesRollup.name == (name or ""),
+    )
+    if start is not None:
+        query = query.where(SalesRollup.bucket >= start)
+    if end is not None:
+        query = query.where(SalesRollup.bucket < end)
+    query = query.order_by(SalesRollup.bucket.desc()).limit(int(limit))
+
+    # シャーディングしている場合は、各シャードの新しい方からlimit件の集計を
+    # 集計期間ごとに合計し、その中から新しい方のlimit件を返す
+    totals = {}
+    for session in shard_router.sessions():
+        for bucket, amount, cents in session.execute(query):
+            total = totals.setdefault(bucket, [0, 0])
+            total[0] += amount
+            total[1] += cents
+    rows = sorted(
+        ((bucket, amount, cents) for bucket, (amount, cents) in totals.items()),
+        reverse=True,
+    )[:int(limit)]
+
+    buckets = [
+        {
+            "start": datetime.fromtimestamp(bucket, timezone.utc).isoformat(),
+            "amount": amount,
+            "sales": cents / 100,
+        }
+        for bucket, amount, cents in reversed(rows)
+    ]
+    response_data = {"bucket": granularity, "sales": buckets}
+    if name is not None:
+        response_data["name"] = name
+    return jsonify(response_data), 200
+
+# 変更履歴 (在庫と売上の変更の差分)
+#  - since: 前回受け取った最後のseq (このseqより後の変更を古い順に返す)
+#           省略した場合は変更を返さず、現在の最新のseqを"next"で返す
+#  - wait: 変更がない場合に変更があるまで待つ秒数 (ロングポーリング、CHANGES_MAX_WAIT以下)
+#  - limit: 1回に返す件数 (CHANGES_PAGE_MAX_LIMIT以下)
+# 次回は"next"の値をsinceに指定する
+# Acceptヘッダーがtext/event-streamの場合はServer-Sent Eventsで変更を送り続ける
+# 変更の内容についてはchange_feed.pyを参照
+# (シャーディングしている場合は変更履歴がシャードごとに分かれるため使えない)
+def changes_v1():
+    if shard_router.enabled:
+        abort(404)
+
+    since = request.args.get("since")
+    wait = request.args.get("wait", "0")
+    max_limit = current_app.config["CHANGES_PAGE_MAX_LIMIT"]
+    limit = request.args.get("limit", str(max_limit))
+
+    # sinceは0以上の整数であること
+    # Server-Sent Eventsで再接続した場合はLast-Event-IDヘッダーを使う
+    since = request.headers.get("Last-Event-ID", since)
+    if since is not None and not since.isdigit():
+        abort(400)
+    if not wait.isdigit() or int(wait) > current_app.config["CHANGES_MAX_WAIT"]:
+        abort(400)
+    if not limit.isdigit() or not 0 < int(limit) <= max_limit:
+        abort(400)
+
+    if since is None:
+        since = change_feed.latest_seq()
+        if request.accept_mimetypes.best == "text/event-stream":
+            return stream_changes_v1(since, int(limit))
+        return jsonify(
+            {"changes": [], "next": since}
+        ), 200
+    since = int(since)
+    if request.accept_mimetypes.best == "text/event-stream":
+        return stream_changes_v1(since, int(limit))
+
+    # 変更がない場合は、通知があるかCHANGES_POLL_INTERVAL秒ごとにDBを確認する
+    # 待っている間はDBのコネクションをコネクションプールに返す
+    # 待つ場合は同時に待つリクエストの枠を確保し、空いていない場合は503とする
+    changes = change_feed.fetch_changes(since, int(limit))
+    if not changes and int(wait) > 0:
+        change_notifier.open_stream()
+        try:
+            deadline = time.monotonic() + int(wait)
+            while True:
+                version = change_notifier.version
+                changes = change_feed.fetch_changes(since, int(limit))
+                remaining = deadline - time.monotonic()
+                if changes or remaining <= 0:
+                    break
+                db.session.remove()
+                change_notifier.wait(
+                    version, min(remaining, current_app.config["CHANGES_POLL_INTERVAL"])
+                )
+        finally:
+            change_notifier.close_stream()
+
     return jsonify(
-        sales.format()
+        {
+            "changes": [change.format() for change in changes],
+            "next": changes[-1].seq if changes else since,
+        }
     ), 200
 
+# 変更履歴 (Server-Sent Events)
+# 変更ごとに "id: <seq>" と "data: <変更のJSON>" のイベントを送る
+# 変更がない間はCHANGES_HEARTBEAT秒ごとにコメント行を送って接続を維持し、
+# CHANGES_STREAM_SECONDS秒たったら終了する (クライアントはLast-Event-IDで再接続する)
+# 接続している間は同時に待つリクエストの枠を1つ使い、空いていない場合は503とする
+# (枠はレスポンスを閉じたときに空ける)
+# Server-Sent Eventsについては下記ページなどを参照
+# https://developer.mozilla.org/ja/docs/Web/API/Server-sent_events/Using_server-sent_events
+def stream_changes_v1(since, limit):
+    config = current_app.config
+    poll_interval = config["CHANGES_POLL_INTERVAL"]
+    heartbeat = config["CHANGES_HEARTBEAT"]
+    dumps = json.dumps
+
+    def generate():
+        last = since
+        now = time.monotonic()
+        deadline = now + config["CHANGES_STREAM_SECONDS"]
+        heartbeat_at = now + heartbeat
+        # 再接続までの待ち時間(ミリ秒)
+        yield "retry: 1000\n\n"
+        while time.monotonic() < deadline:
+            version = change_notifier.version
+            changes = change_feed.fetch_changes(last, limit)
+            events = [
+                "id: {}\nevent: change\ndata: {}\n\n".format(change.seq, dumps(change.format()))
+                for change in changes
+            ]
+            db.session.remove()
+            if events:
+                last = changes[-1].seq
+                heartbeat_at = time.monotonic() + heartbeat
+                yield "".join(events)
+                continue
+            if time.monotonic() >= heartbeat_at:
+                heartbeat_at = time.monotonic() + heartbeat
+                yield ": keepalive\n\n"
+            change_notifier.wait(version, poll_interval)
+
+    change_notifier.open_stream()
+    response = current_app.response_class(
+        stream_with_context(generate()), mimetype="text/event-stream"
+    )
+    response.call_on_close(change_notifier.close_stream)
+    response.headers["Cache-Control"] = "no-cache"
+    # リバースプロキシでバッファリングさせない
+    response.headers["X-Accel-Buffering"] = "no"
+    return response, 200
+
 # 全削除
 def remove_stocks_v1():
-    # stocks テーブルのデータを全削除
-    Stock.query.delete()
-    db.session.commit()
-    
-    # sales テーブルのデータを全削除
-    Sales.query.delete()
-    db.session.commit()
+    # 遅延書き込み中の販売を先にDBに反映し、全削除が終わるまで販売を受け付けない
+    # 在庫、売上、販売の履歴と集計のデータを1つのトランザクションで全削除
+    # 全削除を変更履歴に記録し、それより前の変更履歴を削除する
+    # (シャーディングしている場合はシャードごとのトランザクションで全削除する)
+    with sale_coalescer.exclusive():
+        for session in shard_router.sessions():
+            reset_engine.reset(session)
+            session.commit()
+
+    # キャッシュと販売可能数を全て破棄する
+    stock_cache.clear()
+    sale_coalescer.forget_all()
     
     # 空の JSON データを返す
     return jsonify(
         {}
     ), 200
 
+# スナップショットの保存 (SNAPSHOT_API_ENABLEDがTrueの場合のみ)
+# 現在の在庫と売上のデータを<name>として保存する
+def snapshot_stocks_v1(name):
+    if not current_app.config["SNAPSHOT_API_ENABLED"]:
+        abort(404)
+
+    # 遅延書き込み中の販売もスナップショットに含める
+    sale_coalescer.flush()
+    try:
+        size = reset_engine.snapshot(name)
+    except reset_engine.SnapshotError:
+        abort(400)
+
+    return jsonify(
+        {"name": name, "bytes": size}
+    ), 201
+
+# スナップショットから戻す (SNAPSHOT_API_ENABLEDがTrueの場合のみ)
+def restore_stocks_v1(name):
+    if not current_app.config["SNAPSHOT_API_ENABLED"]:
+        abort(404)
+
+    # 遅延書き込み中の販売を先にDBに反映し、戻し終わるまで販売を受け付けない
+    try:
+        with sale_coalescer.exclusive():
+            reset_engine.restore(name)
+    except FileNotFoundError:
+        abort(404)
+    except reset_engine.SnapshotError:
+        abort(400)
+
+    # DBの内容が置き換わるため、キャッシュと販売可能数を全て破棄する
+    stock_cache.clear()
+    sale_coalescer.forget_all()
+    idempotency_store.clear()
+
+    return jsonify(
+        {"name": name}
+    ), 200
+
+# キャッシュの統計情報(ヒット数、ミス数など)
+def cache_stats_v1():
+    return jsonify(
+        stock_cache.stats()
+    ), 200
+
+# 計測結果 (Prometheus形式)
+def export_metrics():
+    return current_app.response_class(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    ), 200
+
 # クライアントからのリクエストが不正な場合
 def bad_request_v1(error):
     return jsonify({'message': "ERROR"}), 400
@@ -213,3 +697,18 @@ def not_found_v1(error):
 # 許可されていないメソッド
 def method_not_allowed_v1(error):
     return jsonify({'message': "ERROR"}), 405
+
+# 端末ごとの流量制限を超えた (admission.pyを参照)
+def too_many_requests_v1(error):
+    return jsonify({'message': "ERROR"}), 429, retry_after_headers(error)
+
+# 書き込みが混雑していて受け付けられない (admission.pyを参照)
+def service_unavailable_v1(error):
+    return jsonify({'message': "ERROR"}), 503, retry_after_headers(error)
+
+# 再送までの秒数を指定したエラーの場合はRetry-Afterヘッダーを付ける
+def retry_after_headers(error):
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        return {}
+    return {"Retry-After": str(retry_after)}
@@ -0,0 +1,275 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, current_app, g, request
+from sqlalchemy import delete, event, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import db, IdempotencyKey
+
+
+# ----------------Idempotency-Key (リクエストの重複排除)----------------
+# 端末はタイムアウトするとリクエストを再送するため、同じ販売が2回処理されることがある
+# POST /v1/stocks と POST /v1/sales は Idempotency-Key ヘッダーを指定した場合、
+# 同じキーのリクエストを2回目以降は処理せず、1回目のレスポンスをそのまま返す
+# (レスポンスには Idempotent-Replayed: true ヘッダーを付ける)
+#
+#  - 1回目のレスポンスは、在庫や売上の更新と同じトランザクションでidempotency_keysテーブルに
+#    保存する (更新がコミットされた場合のみ保存され、保存された場合は必ず更新も反映されている)
+#  - 同じキーのリクエストが同時に届いた場合、後からコミットした方は主キーの重複で
+#    ロールバックされ、先にコミットされたレスポンスを返す
+#  - 保存したレスポンスはプロセス内のLRU + TTLのキャッシュにも持ち、
+#    キャッシュにない場合は主キーで1回検索するだけで返す
+#  - 同じキーで内容(メソッド、パス、ボディ)の異なるリクエストは400エラーとする
+#  - 処理に失敗した(400エラーなど)リクエストは在庫も売上も更新しないため保存せず、
+#    再送された場合はもう一度処理する
+#  - IDEMPOTENCY_TTL秒より古いキーは無効とし、保存したレスポンスは一定件数ごとに削除する
+#
+# シャーディング(sharding.py)している場合も、キーは全て元のDB(db.session)に保存する
+# (商品のシャードに保存すると、同じキーで別の商品のリクエストが別のシャードで処理され、
+#  400エラーにならずに2回処理されるため)
+# 元のDBへのINSERTは商品のシャードのコミットの直前に実行し、シャードのコミット後に元のDBをコミットする
+#  - INSERTが主キーの重複で失敗した場合は、シャードの更新もロールバックする
+#    (同じキーのリクエストが別のワーカーで同時に処理された場合、後の方はINSERTで先の方の
+#     コミットを待ってから失敗するため、2回処理されない)
+#  - シャードのコミット後、元のDBのコミット前にプロセスが終了した場合はレスポンスが保存されず、
+#    再送された場合はもう一度処理する
+#
+# 販売の遅延書き込み(write_behind.py)が有効な場合は、ジャーナルへの書き込み後に
+# 別のトランザクションでレスポンスを保存する (その間にプロセスが終了した場合は重複排除されない)
+
+# キーの最大文字数
+MAX_KEY_LENGTH = 255
+
+# 同じキーのリクエストが処理中の場合に完了を待つ最大秒数
+INFLIGHT_WAIT_SECONDS = 10
+
+
+class IdempotencyStore:
+
+    def __init__(self, maxsize=10000, ttl=86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.prune_every = 1000
+        self._lock = threading.Lock()
+        # キー → ((リクエストのハッシュ値, ステータス, ボディ, Location), 期限)
+        self._entries = OrderedDict()
+        # 処理中のキー → 完了時にsetするEvent
+        self._inflight = {}
+        self._saved = 0
+        self.replays = 0
+
+    # Flaskアプリケーションの設定を読み込み、レスポンスを保存するイベントを登録する
+    def init_app(self, app):
+        app.config.setdefault("IDEMPOTENCY_CACHE_SIZE", 10000)
+        app.config.setdefault("IDEMPOTENCY_TTL", 86400)
+        app.config.setdefault("IDEMPOTENCY_PRUNE_EVERY", 1000)
+        self.maxsize = app.config["IDEMPOTENCY_CACHE_SIZE"]
+        self.ttl = app.config["IDEMPOTENCY_TTL"]
+        self.prune_every = app.config["IDEMPOTENCY_PRUNE_EVERY"]
+        with self._lock:
+            self._entries.clear()
+
+        app.teardown_request(self._teardown_request)
+        app.register_error_handler(IntegrityError, self._handle_integrity_error)
+        if not event.contains(Session, "before_commit", _before_commit):
+            event.listen(Session, "before_commit", _before_commit)
+            event.listen(Session, "after_commit", _after_commit)
+            event.listen(Session, "after_rollback", _after_rollback)
+
+    # リクエストのIdempotency-Keyを確認する
+    # responseは処理が成功した場合に返すレスポンス
+    #  - キーがない場合はNoneを返す (通常どおり処理する)
+    #  - 処理済みのキーの場合は保存したレスポンスを返す
+    #  - 未処理のキーの場合はNoneを返し、次のコミットでresponseを保存する
+    # sessionは更新に使うセッション (シャーディングしている場合は商品のシャードのセッション)
+    # レスポンスはsessionのコミットに合わせてdb.sessionに保存する
+    def begin(self, response, session=None):
+        if session is None:
+            session = db.session
+        if session is not db.session:
+            session.info["idempotency_partner"] = db.session()
+
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return None
+        if not key or len(key) > MAX_KEY_LENGTH or not key.isascii() or not key.isprintable():
+            abort(400)
+
+        fingerprint = hashlib.blake2b(
+            request.method.encode() + b" " + request.path.encode() + b"\n" + request.get_data(),
+            digest_size=16,
+        ).hexdigest()
+
+        # 同じキーのリクエストを処理中の場合は完了を待つ
+        while True:
+            with self._lock:
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    self._inflight[key] = threading.Event()
+                    g.idempotency_key = key
+                    g.idempotency_fingerprint = fingerprint
+                    g.idempotency_session = session
+                    break
+            waiting.wait(INFLIGHT_WAIT_SECONDS)
+
+        record = self.lookup(key)
+        if record is not None:
+            return self._replay(record, fingerprint)
+
+        db.session.info["idempotency"] = {
+            "key": key,
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "body": response.get_data(),
+            "location": response.headers.get("Location"),
+            "created_at": int(time.time()),
+        }
+        return None
+
+    # 遅延書き込みなど、DBの更新をコミットしない場合にレスポンスだけを保存する
+    def commit(self):
+        if "idempotency" in db.session.info:
+            db.session.commit()
+
+    # キャッシュしたレスポンスを全て破棄する (スナップショットからDBを戻した場合など)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # キーに対応する保存済みのレスポンスを
+    # (リクエストのハッシュ値, ステータス, ボディ, Location) で返す
+    # キャッシュにない場合は主キーでDBを1回検索する
+    def lookup(self, key, session=None):
+        if session is None:
+            session = db.session
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        row = session.execute(
+            select(
+                IdempotencyKey.fingerprint, IdempotencyKey.status,
+                IdempotencyKey.body, IdempotencyKey.location, IdempotencyKey.created_at,
+            ).where(IdempotencyKey.key == key)
+        ).first()
+        if row is None:
+            return None
+        if row.created_at < time.time() - self.ttl:
+            # 期限切れのキーは、このリクエストのレスポンスを保存するコミットで一緒に削除する
+            session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+            return None
+        record = (row.fingerprint, row.status, row.body, row.location)
+        self._remember(key, record, row.created_at)
+        return record
+
+    def _remember(self, key, record, created_at):
+        remaining = created_at + self.ttl - time.time()
+        if remaining <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (record, time.monotonic() + remaining)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _replay(self, record, fingerprint):
+        if record[0] != fingerprint:
+            abort(400)
+        with self._lock:
+            self.replays += 1
+        response = current_app.response_class(
+            record[2], status=record[1], mimetype="application/json"
+        )
+        if record[3] is not None:
+            response.headers["Location"] = record[3]
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    # 同じキーのリクエストが同時にコミットされ、主キーが重複した場合は
+    # 先にコミットされたレスポンスを返す
+    def _handle_integrity_error(self, error):
+        key = g.get("idempotency_key")
+        session = g.get("idempotency_session", db.session)
+        session.rollback()
+        db.session.rollback()
+        record = self.lookup(key) if key is not None else None
+        if record is None:
+            raise error
+        return self._replay(record, g.idempotency_fingerprint)
+
+    # 処理中のキーを解放し、完了を待っているリクエストを再開する
+    def _teardown_request(self, error):
+        key = g.pop("idempotency_key", None)
+        g.pop("idempotency_fingerprint", None)
+        g.pop("idempotency_session", None)
+        if key is None:
+            return
+        with self._lock:
+            waiting = self._inflight.pop(key, None)
+        if waiting is not None:
+            waiting.set()
+
+    # 保存するレスポンスをコミットの直前にINSERTする
+    # 一定件数ごとに期限切れのキーも削除する
+    def _save(self, session, row):
+        session.execute(insert(IdempotencyKey), [row])
+        with self._lock:
+            self._saved += 1
+            prune = self._saved % self.prune_every == 0
+        if prune:
+            session.execute(
+                delete(IdempotencyKey).where(IdempotencyKey.created_at < int(time.time()) - self.ttl)
+            )
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        with self._lock:
+            return [
+                ("idempotency_replays_total", "counter",
+                 "Requests answered with a stored Idempotency-Key response.", [
+                    ({}, self.replays),
+                ]),
+                ("idempotency_cache_entries", "gauge", "Cached Idempotency-Key responses.", [
+                    ({}, len(self._entries)),
+                ]),
+            ]
+
+
+# ----------------SQLAlchemyのイベント----------------
+
+# シャードのセッションの場合は、レスポンスを保存する元のDBのセッション(partner)に先にINSERTする
+def _before_commit(session):
+    partner = session.info.get("idempotency_partner")
+    if partner is not None:
+        _before_commit(partner)
+    row = session.info.pop("idempotency", None)
+    if row is not None:
+        idempotency_store._save(session, row)
+        session.info["idempotency_saved"] = row
+
+def _after_commit(session):
+    row = session.info.pop("idempotency_saved", None)
+    if row is not None:
+        idempotency_store._remember(
+            row["key"], (row["fingerprint"], row["status"], row["body"], row["location"]),
+            row["created_at"],
+        )
+    partner = session.info.pop("idempotency_partner", None)
+    if partner is not None:
+        partner.commit()
+
+def _after_rollback(session):
+    session.info.pop("idempotency", None)
+    session.info.pop("idempotency_saved", None)
+    partner = session.info.pop("idempotency_partner", None)
+    if partner is not None:
+        partner.rollback()
+
+
+# IdempotencyStoreインスタンスの作成
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,252 @@
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from models import db, Stock, StockThreshold, upsert_insert
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------発注点(在庫の下限)の通知----------------
+# 商品ごとに発注点(threshold)を設定し、在庫数が発注点を下回っている商品を
+# stock_thresholdsテーブルのlow列で管理する
+#  - 在庫数が変わる処理(在庫の追加、一括登録、販売)は、変更履歴(change_feed.py)の記録で
+#    変更後の在庫数を読み込むため、同じ場所で発注点を確認し、
+#    発注点をまたいだ商品だけlow列を更新する (在庫数が変わらない商品は読み込まない)
+#  - GET /v1/stocks?low=1 は (low, name) のインデックスで下回っている商品だけを読み込むため、
+#    在庫の全件を読み込まずに、下回っている商品の数に比例した時間で返す
+#  - LOW_STOCK_WEBHOOK_URLを指定した場合は、発注点を下回ったとき(low)と
+#    発注点以上に戻ったとき(restocked)に、そのURLにJSONをPOSTする
+#    通知はコミット後にキューに入れ、バックグラウンドのスレッドが送信するため、
+#    販売のレスポンスは通知の送信を待たない
+#    送信に失敗した場合はLOW_STOCK_WEBHOOK_RETRIES回まで間隔を空けて送り直す
+#    (キューがいっぱいの場合とプロセスが終了した場合、送信していない通知は失われる)
+#  - 全削除では発注点の設定は削除せず、全ての商品を在庫数0として low列を更新する
+#    (全削除は負荷試験の準備で行うため、通知は送らない)
+
+
+# 在庫数が発注点を下回っているかどうか
+def is_low(amount, threshold):
+    return amount < threshold
+
+# 在庫数が変わった商品の発注点を確認し、発注点をまたいだ商品のlow列を更新する
+# amountsは {name: 変更後の在庫数}
+# 通知する場合は、コミット後に送信する通知をsession.infoに追加する
+def track(amounts, session=None):
+    if session is None:
+        session = db.session
+    if not amounts:
+        return
+
+    rows = session.execute(
+        select(StockThreshold.name, StockThreshold.threshold, StockThreshold.low)
+        .where(StockThreshold.name.in_(amounts))
+    ).all()
+
+    changed = []
+    for name, threshold, low in rows:
+        amount = amounts[name]
+        if is_low(amount, threshold) != low:
+            changed.append((name, amount, threshold, not low))
+    if not changed:
+        return
+
+    session.execute(
+        update(StockThreshold),
+        [{"name": name, "low": low} for name, _, _, low in changed],
+    )
+    if low_stock_notifier.enabled:
+        session.info.setdefault("low_stock_events", []).extend(
+            make_event(name, amount, threshold, low) for name, amount, threshold, low in changed
+        )
+
+# 全削除の後、全ての商品の在庫数を0としてlow列を更新する (コミットは呼び出し側で行う)
+def reset_all(session=None):
+    if session is None:
+        session = db.session
+    session.execute(update(StockThreshold).values(low=StockThreshold.threshold > 0))
+
+# 発注点を設定する (コミットは呼び出し側で行う)
+# 設定した時点の在庫数で発注点を下回っているかどうかを判定する
+def set_threshold(name, threshold, session=None):
+    if session is None:
+        session = db.session
+
+    amount = session.scalar(select(Stock.amount).where(Stock.name == name)) or 0
+    previous = session.scalar(select(StockThreshold.low).where(StockThreshold.name == name))
+    low = is_low(amount, threshold)
+
+    stmt = upsert_insert(StockThreshold.__table__, session)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[StockThreshold.name],
+            set_={"threshold": stmt.excluded.threshold, "low": stmt.excluded.low},
+        ),
+        [{"name": name, "threshold": threshold, "low": low}],
+    )
+    if low_stock_notifier.enabled and low != bool(previous):
+        session.info.setdefault("low_stock_events", []).append(
+            make_event(name, amount, threshold, low)
+        )
+    return amount, low
+
+# 発注点の設定を削除する (設定がなかった場合はFalseを返す)
+def delete_threshold(name, session=None):
+    if session is None:
+        session = db.session
+    threshold = session.get(StockThreshold, name)
+    if threshold is None:
+        return False
+    session.delete(threshold)
+    return True
+
+# 発注点を下回っている商品を (name, 在庫数, 発注点) でnameの昇順に返す
+def low_stocks(session=None):
+    if session is None:
+        session = db.session
+    return session.execute(
+        select(StockThreshold.name, Stock.amount, StockThreshold.threshold)
+        .outerjoin(Stock, Stock.name == StockThreshold.name)
+        .where(StockThreshold.low.is_(True))
+        .order_by(StockThreshold.name)
+    ).all()
+
+# 通知の内容
+def make_event(name, amount, threshold, low):
+    return {
+        "type": "low" if low else "restocked",
+        "name": name,
+        "amount": amount,
+        "threshold": threshold,
+        "time": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+class LowStockNotifier:
+
+    def __init__(self):
+        self.url = None
+        self.timeout = 5.0
+        self.retries = 3
+        self.retry_interval = 1.0
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    # Flaskアプリケーションの設定を読み込み、コミット後に通知をキューに入れるイベントを登録する
+    def init_app(self, app):
+        app.config.setdefault("LOW_STOCK_WEBHOOK_URL", None)
+        app.config.setdefault("LOW_STOCK_WEBHOOK_TIMEOUT", 5.0)
+        app.config.setdefault("LOW_STOCK_WEBHOOK_RETRIES", 3)
+        app.config.setdefault("LOW_STOCK_WEBHOOK_RETRY_INTERVAL", 1.0)
+        app.config.setdefault("LOW_STOCK_QUEUE_SIZE", 10000)
+        self.url = app.config["LOW_STOCK_WEBHOOK_URL"]
+        self.timeout = app.config["LOW_STOCK_WEBHOOK_TIMEOUT"]
+        self.retries = app.config["LOW_STOCK_WEBHOOK_RETRIES"]
+        self.retry_interval = app.config["LOW_STOCK_WEBHOOK_RETRY_INTERVAL"]
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=app.config["LOW_STOCK_QUEUE_SIZE"])
+
+        if not event.contains(Session, "after_commit", _after_commit):
+            event.listen(Session, "after_commit", _after_commit)
+            event.listen(Session, "after_rollback", _after_rollback)
+
+    # 通知するかどうか (LOW_STOCK_WEBHOOK_URLを指定した場合)
+    @property
+    def enabled(self):
+        return bool(self.url)
+
+    # 通知をキューに入れる
+    # キューがいっぱいの場合は通知を破棄する (販売の処理を止めないため)
+    def enqueue(self, events):
+        self.start()
+        for item in events:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+
+    # 送信するスレッドを起動する (最初の通知のときに1回だけ)
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="low-stock-webhook", daemon=True)
+                thread.start()
+                self._thread = thread
+
+    # キューに入っている通知を全て送信し終えるまで最大timeout秒待つ
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._deliver(item)
+            finally:
+                self._queue.task_done()
+
+    # 1件の通知を送信する (失敗した場合は送り直す)
+    def _deliver(self, item):
+        body = json.dumps(item).encode("utf-8")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_interval * attempt)
+            try:
+                req = urllib.request.Request(
+                    self.url, data=body, method="POST",
+                    headers={"Content-Type": "application/json"},
+                )
+                with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                    response.read()
+                self.sent += 1
+                return
+            except Exception as e:
+                error = e
+        self.failed += 1
+        logger.warning("low stock webhook failed: %s %s: %s", item["type"], item["name"], error)
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        return [
+            ("low_stock_webhooks_total", "counter", "Low stock notifications by result.", [
+                ({"result": "sent"}, self.sent),
+                ({"result": "failed"}, self.failed),
+                ({"result": "dropped"}, self.dropped),
+            ]),
+            ("low_stock_webhook_queue", "gauge", "Low stock notifications waiting to be sent.", [
+                ({}, self._queue.qsize()),
+            ]),
+        ]
+
+
+# ----------------SQLAlchemyのイベント----------------
+
+def _after_commit(session):
+    events = session.info.pop("low_stock_events", None)
+    if events:
+        low_stock_notifier.enqueue(events)
+
+def _after_rollback(session):
+    session.info.pop("low_stock_events", None)
+
+
+# LowStockNotifierインスタンスの作成
+low_stock_notifier = LowStockNotifier()
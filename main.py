@@ -3,5 +3,7 @@ from app import create_app
 # create_app関数を呼び出してFlaskアプリケーションインスタンスを作成する
 app = create_app()
 
+# app.run()はWerkzeugの開発用サーバー(1プロセス)で起動する
+# 本番では複数のワーカープロセスで動かす serve.py を使う
 if __name__ == '__main__':
     app.run(host="54.65.196.247", port=80)
@@ -0,0 +1,229 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# ----------------リクエストの計測----------------
+# エンドポイントごとに以下を集計し、Prometheus形式で /metrics から返す
+#  - リクエスト数と処理時間 (ヒストグラム)
+#  - 実行したSQL文の数とSQLの実行時間
+#  - コミットにかかった時間
+#  - レスポンスのサイズ
+# SLOW_REQUEST_SECONDSを指定した場合は、処理時間がそれを超えたリクエストを
+# 実行したSQL文と合わせてログに出力する
+#
+# SQLAlchemyのイベントについては下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents
+# Prometheusの形式については下記ページなどを参照
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+# 処理時間のヒストグラムの区切り(秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 処理中のリクエストの計測データ
+# リクエストはスレッドごとに処理されるため、ContextVarでリクエストごとに持つ
+_current = ContextVar("metrics_request", default=None)
+
+
+class RequestState:
+    __slots__ = ("start", "sql_count", "sql_seconds", "sql_start",
+                 "commit_seconds", "commit_start", "statements")
+
+    def __init__(self, record_statements):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.sql_start = 0.0
+        self.commit_seconds = 0.0
+        self.commit_start = None
+        # 遅いリクエストのログ出力が有効な場合のみSQL文を記録する
+        self.statements = [] if record_statements else None
+
+
+class EndpointStats:
+    __slots__ = ("count", "seconds", "buckets", "sql_count", "sql_seconds",
+                 "commit_seconds", "response_bytes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.commit_seconds = 0.0
+        self.response_bytes = 0
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._collectors = []
+        self.slow_request_seconds = None
+
+    # Flaskアプリケーションにリクエスト前後の処理を、
+    # SQLAlchemyにSQL実行前後とコミットのイベントを登録する
+    # enginesにはFlask-SQLAlchemyの管理外のエンジン(シャードなど)を指定する
+    def init_app(self, app, db, engines=()):
+        app.config.setdefault("METRICS_ENABLED", True)
+        app.config.setdefault("SLOW_REQUEST_SECONDS", None)
+        if not app.config["METRICS_ENABLED"]:
+            return
+        self.slow_request_seconds = app.config["SLOW_REQUEST_SECONDS"]
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        # 参照用のDB(replicas.py)とシャード(sharding.py)のエンジンのSQLも計測する
+        with app.app_context():
+            engines = list(db.engines.values()) + list(engines)
+        for engine in engines:
+            if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+                event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+                event.listen(engine, "commit", _before_commit)
+        if not event.contains(Session, "after_commit", _after_commit):
+            event.listen(Session, "after_commit", _after_commit)
+
+    # /metrics に出力する値を追加する
+    # collectorは (名前, タイプ, 説明, [(ラベルのdict, 値), ...]) のリストを返す関数
+    def add_collector(self, collector):
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def _before_request(self):
+        _current.set(RequestState(self.slow_request_seconds is not None))
+
+    def _after_request(self, response):
+        state = _current.get()
+        if state is None:
+            return response
+        _current.set(None)
+
+        seconds = time.perf_counter() - state.start
+        endpoint = request.endpoint or "unknown"
+        size = response.content_length or 0
+
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.count += 1
+            stats.seconds += seconds
+            stats.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+            stats.sql_count += state.sql_count
+            stats.sql_seconds += state.sql_seconds
+            stats.commit_seconds += state.commit_seconds
+            stats.response_bytes += size
+
+        if self.slow_request_seconds is not None and\
+           seconds >= self.slow_request_seconds:
+            self._log_slow_request(endpoint, seconds, state)
+        return response
+
+    # 例外などでafter_requestが呼ばれなかった場合も計測データを破棄する
+    def _teardown_request(self, error):
+        _current.set(None)
+
+    def _log_slow_request(self, endpoint, seconds, state):
+        lines = [
+            "slow request: {} {} endpoint={} total={:.1f}ms sql={} sql_time={:.1f}ms commit={:.1f}ms".format(
+                request.method, request.path, endpoint, seconds * 1000,
+                state.sql_count, state.sql_seconds * 1000, state.commit_seconds * 1000,
+            )
+        ]
+        for statement, parameters, duration in state.statements:
+            lines.append("  {:.1f}ms {} {!r}".format(duration * 1000, statement, parameters))
+        current_app.logger.warning("\n".join(lines))
+
+    # Prometheus形式のテキストを作成する
+    def render(self):
+        with self._lock:
+            endpoints = sorted(
+                (name, (stats.count, stats.seconds, list(stats.buckets),
+                        stats.sql_count, stats.sql_seconds,
+                        stats.commit_seconds, stats.response_bytes))
+                for name, stats in self._endpoints.items()
+            )
+
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        header("http_request_duration_seconds", "histogram",
+               "Request wall time per endpoint.")
+        for name, (count, seconds, buckets, *_rest) in endpoints:
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float("inf"),), buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('http_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(name, le, cumulative))
+            lines.append('http_request_duration_seconds_sum{{endpoint="{}"}} {!r}'.format(name, seconds))
+            lines.append('http_request_duration_seconds_count{{endpoint="{}"}} {}'.format(name, count))
+
+        for index, metric, kind, help_text in (
+            (3, "db_statements_total", "counter", "SQL statements executed per endpoint."),
+            (4, "db_statement_seconds_total", "counter", "Time spent executing SQL statements per endpoint."),
+            (5, "db_commit_seconds_total", "counter", "Time spent in COMMIT per endpoint."),
+            (6, "http_response_bytes_total", "counter", "Response body bytes per endpoint."),
+        ):
+            header(metric, kind, help_text)
+            for name, values in endpoints:
+                lines.append('{}{{endpoint="{}"}} {!r}'.format(metric, name, values[index]))
+
+        for collector in self._collectors:
+            for metric, kind, help_text, samples in collector():
+                header(metric, kind, help_text)
+                for labels, value in samples:
+                    label_text = ",".join(
+                        '{}="{}"'.format(key, val) for key, val in sorted(labels.items())
+                    )
+                    if label_text:
+                        lines.append("{}{{{}}} {!r}".format(metric, label_text, value))
+                    else:
+                        lines.append("{} {!r}".format(metric, value))
+
+        return "\n".join(lines) + "\n"
+
+
+# ----------------SQLAlchemyのイベント----------------
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _current.get()
+    if state is not None:
+        state.sql_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _current.get()
+    if state is not None:
+        duration = time.perf_counter() - state.sql_start
+        state.sql_count += 1
+        state.sql_seconds += duration
+        if state.statements is not None:
+            state.statements.append((statement, parameters, duration))
+
+# DBAPIのcommit()の直前に呼ばれる
+def _before_commit(conn):
+    state = _current.get()
+    if state is not None:
+        state.commit_start = time.perf_counter()
+
+# Sessionのコミットの完了後に呼ばれる
+def _after_commit(session):
+    state = _current.get()
+    if state is not None and state.commit_start is not None:
+        state.commit_seconds += time.perf_counter() - state.commit_start
+        state.commit_start = None
+
+
+# Metricsインスタンスの作成
+metrics = Metrics()
@@ -0,0 +1,37 @@
+"""initial schema (stocks, sales)
+
+既存のDB (db.create_all() などで作成済みのもの) は
+flask db stamp 3f1c2a9d7b10 を実行してからアップグレードする
+
+Revision ID: 3f1c2a9d7b10
+Revises: 
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stocks',
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('sales',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('sales', sa.REAL(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('sales')
+    op.drop_table('stocks')
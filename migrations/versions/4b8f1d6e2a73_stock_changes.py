@@ -0,0 +1,35 @@
+"""stock and sales change log
+
+Revision ID: 4b8f1d6e2a73
+Revises: e2d5a8c3f619
+Create Date: 2026-10-18 12:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8f1d6e2a73'
+down_revision = 'e2d5a8c3f619'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLiteでは削除したseqを再利用しないようにAUTOINCREMENTを指定する
+    op.create_table('stock_changes',
+    sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(length=8), nullable=False),
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=True),
+    sa.Column('stock', sa.Integer(), nullable=True),
+    sa.Column('cents', sa.Integer(), nullable=True),
+    sa.Column('changed_at', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+
+def downgrade():
+    op.drop_table('stock_changes')
@@ -0,0 +1,34 @@
+"""stock thresholds
+
+Revision ID: 5c2f9a7e3b61
+Revises: 9d3e7b5a1c84
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f9a7e3b61'
+down_revision = '9d3e7b5a1c84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stock_thresholds',
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('threshold', sa.Integer(), nullable=False),
+    sa.Column('low', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    with op.batch_alter_table('stock_thresholds', schema=None) as batch_op:
+        batch_op.create_index('ix_stock_thresholds_low_name', ['low', 'name'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('stock_thresholds', schema=None) as batch_op:
+        batch_op.drop_index('ix_stock_thresholds_low_name')
+
+    op.drop_table('stock_thresholds')
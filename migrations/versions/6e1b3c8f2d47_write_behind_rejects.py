@@ -0,0 +1,34 @@
+"""write-behind sales rejected at flush
+
+Revision ID: 6e1b3c8f2d47
+Revises: 5c2f9a7e3b61
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e1b3c8f2d47'
+down_revision = '5c2f9a7e3b61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('write_behind_rejects',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('price', sa.REAL(), nullable=True),
+    sa.Column('cents', sa.Integer(), nullable=True),
+    sa.Column('sold_at', sa.Integer(), nullable=False),
+    sa.Column('rejected_at', sa.Integer(), nullable=False),
+    sa.Column('segment', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('write_behind_rejects')
@@ -0,0 +1,54 @@
+"""sales ledger and rollups
+
+Revision ID: 8a4e6d21c5f3
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 11:31:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d21c5f3'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sales_ledger',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.Column('price', sa.REAL(), nullable=True),
+    sa.Column('sales', sa.REAL(), nullable=True),
+    sa.Column('sold_at', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('sales_ledger', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_sales_ledger_sold_at'), ['sold_at'], unique=False)
+
+    op.create_table('product_sales',
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=True),
+    sa.Column('sales', sa.REAL(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('sales_rollups',
+    sa.Column('granularity', sa.String(length=6), nullable=False),
+    sa.Column('bucket', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=8), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=True),
+    sa.Column('sales', sa.REAL(), nullable=True),
+    sa.PrimaryKeyConstraint('granularity', 'bucket', 'name')
+    )
+
+
+def downgrade():
+    op.drop_table('sales_rollups')
+    op.drop_table('product_sales')
+    with op.batch_alter_table('sales_ledger', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_sales_ledger_sold_at'))
+
+    op.drop_table('sales_ledger')
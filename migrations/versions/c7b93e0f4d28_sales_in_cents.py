@@ -0,0 +1,40 @@
+"""store sales amounts as integer cents
+
+REALで保存していた売上を、セント単位(金額 x 100)の整数のcentsカラムに移行する
+
+Revision ID: c7b93e0f4d28
+Revises: 8a4e6d21c5f3
+Create Date: 2026-10-18 11:32:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7b93e0f4d28'
+down_revision = '8a4e6d21c5f3'
+branch_labels = None
+depends_on = None
+
+TABLES = ['sales', 'sales_ledger', 'product_sales', 'sales_rollups']
+
+
+def upgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('cents', sa.Integer(), nullable=True))
+        op.execute(
+            'UPDATE {} SET cents = CAST(ROUND(COALESCE(sales, 0) * 100) AS INTEGER)'.format(table)
+        )
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('sales')
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('sales', sa.REAL(), nullable=True))
+        op.execute('UPDATE {} SET sales = cents / 100.0'.format(table))
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('cents')
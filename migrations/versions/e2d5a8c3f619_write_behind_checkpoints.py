@@ -0,0 +1,28 @@
+"""write-behind sale journal checkpoints
+
+Revision ID: e2d5a8c3f619
+Revises: c7b93e0f4d28
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2d5a8c3f619'
+down_revision = 'c7b93e0f4d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('write_behind_checkpoints',
+    sa.Column('name', sa.String(length=16), nullable=False),
+    sa.Column('segment', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('write_behind_checkpoints')
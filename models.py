@@ -1,11 +1,32 @@
+from datetime import datetime, timezone
+
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql.dml import UpdateBase
 # DB接続にはflask_sqlalchemyを使用する
 # Flask SQLAlchemyについては下記ページを参照
 # https://pypi.org/project/Flask-SQLAlchemy/
 # https://flask-sqlalchemy.palletsprojects.com/en/3.1.x/
 
+
+# 参照をレプリカ(SQLALCHEMY_BINDSの"replica")に振り分けるセッション
+# session.info["replica"]がTrueの間(GETリクエストの処理中、replicas.pyを参照)は
+# SELECTをレプリカのエンジンで実行する
+# INSERT/UPDATE/DELETEとflush()による書き込みは、常に書き込み用のDB(プライマリ)で実行する
+# セッションのエンジンの振り分けについては下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/orm/persistence_techniques.html#custom-vertical-partitioning
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("replica") and\
+           not self._flushing and not isinstance(clause, UpdateBase):
+            return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
 # SQLAlchemyインスタンスの作成
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # ----------------DBモデルの定義----------------
 # stocksテーブルとsalesテーブルを定義する
@@ -26,10 +47,134 @@ class Stock(db.Model):
 class Sales(db.Model):
     __tablename__ = 'sales'
     name = db.Column(db.String, primary_key=True)
-    sales = db.Column(db.REAL, default=0)
+    # 売上はセント単位(金額 x 100)の整数で保存する
+    cents = db.Column(db.Integer, default=0)
     
     def format(self):
         return {
-            # "sales"行のデータを小数点第2位までの表示にフォーマットする(四捨五入する)
-            "sales": float("{:.2f}".format(self.sales)),
+            # セント単位の売上を小数点第2位までの金額にする
+            "sales": self.cents / 100,
+        }
+
+
+# 販売の履歴 (1回の販売ごとに1行追加する)
+class SalesLedger(db.Model):
+    __tablename__ = 'sales_ledger'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(8), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.REAL)
+    cents = db.Column(db.Integer, default=0)
+    # 販売日時 (UNIX時間の秒)
+    sold_at = db.Column(db.Integer, nullable=False, index=True)
+
+# 商品ごとの販売数と売上の集計
+class ProductSales(db.Model):
+    __tablename__ = 'product_sales'
+    name = db.Column(db.String(8), primary_key=True)
+    amount = db.Column(db.Integer, default=0)
+    cents = db.Column(db.Integer, default=0)
+
+    def format(self):
+        return {
+            self.name: {
+                "amount": self.amount,
+                "sales": self.cents / 100,
+            },
+        }
+
+# 時間単位(分、時、日)ごとの販売数と売上の集計
+# nameが空文字の行は全商品の合計
+class SalesRollup(db.Model):
+    __tablename__ = 'sales_rollups'
+    granularity = db.Column(db.String(6), primary_key=True)
+    # 集計期間の開始日時 (UNIX時間の秒)
+    bucket = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(8), primary_key=True)
+    amount = db.Column(db.Integer, default=0)
+    cents = db.Column(db.Integer, default=0)
+
+
+# 販売の遅延書き込み(write_behind.py)でDBに反映済みのジャーナルのセグメント番号
+class WriteBehindCheckpoint(db.Model):
+    __tablename__ = 'write_behind_checkpoints'
+    name = db.Column(db.String(16), primary_key=True)
+    segment = db.Column(db.Integer, nullable=False)
+
+# 販売の遅延書き込みで、レスポンスを返した後にDBの在庫が足りず反映できなかった販売
+class WriteBehindReject(db.Model):
+    __tablename__ = 'write_behind_rejects'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(8), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.REAL)
+    cents = db.Column(db.Integer, default=0)
+    # 販売日時と反映できなかった日時 (UNIX時間の秒)
+    sold_at = db.Column(db.Integer, nullable=False)
+    rejected_at = db.Column(db.Integer, nullable=False)
+    # 販売を書き込んだジャーナルのセグメント番号
+    segment = db.Column(db.Integer, nullable=False)
+
+
+# 在庫と売上の変更履歴 (変更のたびに同じトランザクションで1行追加する)
+# seqは削除した番号も再利用しない連番 (GET /v1/changes?since=<seq>)
+class StockChange(db.Model):
+    __tablename__ = 'stock_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # stock (在庫の追加)、sale (販売)、reset (全削除)
+    kind = db.Column(db.String(8), nullable=False)
+    name = db.Column(db.String(8), nullable=False, default='')
+    # 在庫数の増減と変更後の在庫数
+    amount = db.Column(db.Integer, default=0)
+    stock = db.Column(db.Integer, default=0)
+    # 売上の増減 (セント単位)
+    cents = db.Column(db.Integer, default=0)
+    # 変更日時 (UNIX時間の秒)
+    changed_at = db.Column(db.Integer, nullable=False)
+
+    def format(self):
+        return {
+            "seq": self.seq,
+            "type": self.kind,
+            "name": self.name or None,
+            "amount": self.amount,
+            "stock": self.stock,
+            "sales": self.cents / 100,
+            "time": datetime.fromtimestamp(self.changed_at, timezone.utc).isoformat(),
         }
+
+
+# 商品ごとの発注点 (low_stock.pyを参照)
+# lowは在庫数が発注点を下回っているかどうかで、在庫数が発注点をまたいだときに更新する
+# (low, name)のインデックスで、下回っている商品だけをnameの順に読み込む
+class StockThreshold(db.Model):
+    __tablename__ = 'stock_thresholds'
+    __table_args__ = (
+        db.Index('ix_stock_thresholds_low_name', 'low', 'name'),
+    )
+    name = db.Column(db.String(8), primary_key=True)
+    threshold = db.Column(db.Integer, nullable=False)
+    low = db.Column(db.Boolean, nullable=False, default=False)
+
+
+# Idempotency-Keyごとに保存した1回目のレスポンス (idempotency.pyを参照)
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    key = db.Column(db.String(255), primary_key=True)
+    # リクエストのメソッド、パス、ボディのハッシュ値
+    fingerprint = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.LargeBinary, nullable=False)
+    location = db.Column(db.String)
+    # 保存日時 (UNIX時間の秒)
+    created_at = db.Column(db.Integer, nullable=False, index=True)
+
+
+# DBに合わせたINSERT文 (ON CONFLICTによるUPSERTに対応したもの) を作成する
+def upsert_insert(table, session=None):
+    if session is None:
+        session = db.session
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
@@ -0,0 +1,389 @@
+import argparse
+import base64
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    from pdf2image import convert_from_path
+except ImportError:
+    convert_from_path = None
+
+
+# ----------------PDFのページ画像の検索 (ColQwen2×GPT)----------------
+# ColQwen2×GPTのノートブックの索引作成と検索、検索結果の表示をモジュールにしたもの
+# ノートブックでは実行のたびにPDFを overwrite=True で索引し直し、
+# 検索結果の表示でページ全体の画像をbase64からデコード、縮小、PNGに再エンコードしていたため、
+# ここでは次のようにする
+#  - 索引はroot以下のディレクトリに保存し、文書はファイルの内容のハッシュ値(SHA-256)で管理する
+#    内容が変わっていないファイルは再度埋め込み(embedding)を計算しない
+#    (ファイル名を変えたり移動したりしても同じ文書とみなす)
+#  - 縮小画像(サムネイル)は索引を作成するときに1回だけ、プロセスプールで並列に作成して保存する
+#    検索結果の表示は保存したサムネイルを読み込むだけのため、ページ画像の大きさに関係なく速い
+#  - ページの画像も保存し、GPTに渡す画像(page_base64())として使う
+#
+# ディレクトリの構成
+#   root/manifest.json                 文書の一覧 (ハッシュ値 → doc_id、パス、ページ数)
+#   root/<ハッシュ値>/embeddings.npz   ページごとの埋め込み (トークン数 x 次元の配列)
+#   root/<ハッシュ値>/pages/<n>.png    ページの画像 (nは1から始まるページ番号)
+#   root/<ハッシュ値>/thumbs/<n>.png   ページのサムネイル (幅はthumbnail_width)
+#
+# 埋め込みを計算するクラス(embedder)は次の属性とメソッドを持つ
+#   name                   モデルの名前 (別のモデルで作成した索引は使えないため記録する)
+#   embed_pages(images)    PILの画像のリストから、ページごとの (トークン数 x 次元) の配列のリストを返す
+#   embed_query(query)     検索文から (トークン数 x 次元) の配列を返す
+# ColQwenEmbedderはbyaldiのColQwen2を使う (byaldi、pdf2image、poppler-utilsのインストールが必要)
+# StubEmbedderはモデルを使わない動作確認用のもの (検索結果に意味はない)
+# 検索のスコアはColPali/ColQwen2と同じく、検索文のトークンごとに最も近いページのトークンとの
+# 内積を合計したもの (MaxSim)
+#
+# 実行例 (numpyとPillowのインストールが必要)
+# $ python page_index.py index "/content/Named Clinical Entity Recognition Benchmark/"
+# $ python page_index.py search "本研究の提案手法は?" -k 5
+# $ python page_index.py --embedder stub --root /tmp/index index samples/
+#
+# ノートブックからは次のように使う
+#   index = PageIndex(".page_index", ColQwenEmbedder())
+#   index.index(["/content/docs/"])
+#   results = index.search("本研究の提案手法は?", k=5)
+#   display.display(display.HTML(index.thumbnail_html(results)))
+#
+# byaldiについては下記ページなどを参照
+# https://github.com/AnswerDotAI/byaldi
+# https://huggingface.co/vidore/colqwen2-v0.1
+
+# 索引に追加するファイルの拡張子
+PDF_EXTENSIONS = (".pdf",)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
+# 検索結果
+#  doc_id: 索引に追加した順の文書の番号、page_num: 1から始まるページ番号
+#  digest: 文書のハッシュ値、path: 索引に追加したときのファイルのパス
+SearchResult = namedtuple("SearchResult", ["doc_id", "page_num", "score", "digest", "path"])
+
+
+# ファイルの内容のハッシュ値
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# pathsに含まれるPDFと画像のファイルをパスの順に返す (ディレクトリは中のファイルを返す)
+def iter_files(paths):
+    for path in paths:
+        path = os.fspath(path)
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for parent, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(PDF_EXTENSIONS + IMAGE_EXTENSIONS):
+                    yield os.path.join(parent, name)
+
+# ファイルをpages_dirに1ページ1枚のPNGで保存し、ページ数を返す
+# PDFはpdf2image (poppler) でページごとの画像にする
+def save_pages(path, pages_dir, workers=1):
+    os.makedirs(pages_dir, exist_ok=True)
+    if not path.lower().endswith(PDF_EXTENSIONS):
+        if path.lower().endswith(".png"):
+            shutil.copyfile(path, os.path.join(pages_dir, "1.png"))
+        else:
+            with Image.open(path) as image:
+                image.save(os.path.join(pages_dir, "1.png"), format="PNG")
+        return 1
+
+    if convert_from_path is None:
+        raise RuntimeError("indexing PDF files requires the pdf2image package")
+    page_paths = convert_from_path(
+        path, output_folder=pages_dir, fmt="png", paths_only=True, thread_count=workers,
+    )
+    for page_num, page_path in enumerate(page_paths, 1):
+        os.replace(page_path, os.path.join(pages_dir, "{}.png".format(page_num)))
+    return len(page_paths)
+
+# ページの画像を縮小してサムネイルを保存する (プロセスプールで実行する)
+# ノートブックと同じく、幅をwidthにして縦横比を保つ
+def make_thumbnail(job):
+    page_path, thumb_path, width = job
+    with Image.open(page_path) as image:
+        height = max(1, int(width * image.height / image.width))
+        thumbnail = image.resize((width, height), reducing_gap=3.0)
+    partial = thumb_path + ".partial"
+    thumbnail.save(partial, format="PNG")
+    os.replace(partial, thumb_path)
+    return thumb_path
+
+# MaxSimのスコア
+# 検索文のトークンごとに、ページのトークンとの内積の最大値を求めて合計する
+def max_sim(query, page):
+    return float((query @ page.T).max(axis=1).sum())
+
+def read_base64(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+
+class PageIndex:
+
+    def __init__(self, root, embedder, thumbnail_width=300, workers=None):
+        if np is None or Image is None:
+            raise RuntimeError("PageIndex requires the numpy and Pillow packages")
+        self.root = os.fspath(root)
+        self.embedder = embedder
+        self.thumbnail_width = thumbnail_width
+        # サムネイルを作成するプロセス数 (Noneの場合はCPU数、0の場合はプロセスプールを使わない)
+        self.workers = workers
+        # 読み込んだ埋め込み (ハッシュ値 → ページごとの配列のリスト)
+        self._embeddings = {}
+        self.manifest = self._load_manifest()
+
+    def _manifest_path(self):
+        return os.path.join(self.root, "manifest.json")
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path(), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {
+                "embedder": self.embedder.name,
+                "thumbnail_width": self.thumbnail_width,
+                "next_doc_id": 0,
+                "documents": {},
+            }
+        if manifest["embedder"] != self.embedder.name:
+            raise ValueError("index {} was built with {}, not {}".format(
+                self.root, manifest["embedder"], self.embedder.name))
+        return manifest
+
+    # 一時ファイルに書き込んでから置き換え、途中で中断しても壊れないようにする
+    def _save_manifest(self):
+        os.makedirs(self.root, exist_ok=True)
+        partial = self._manifest_path() + ".partial"
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(partial, self._manifest_path())
+
+    def _document_dir(self, digest):
+        return os.path.join(self.root, digest)
+
+    def page_path(self, digest, page_num):
+        return os.path.join(self._document_dir(digest), "pages", "{}.png".format(page_num))
+
+    def thumbnail_path(self, digest, page_num):
+        return os.path.join(self._document_dir(digest), "thumbs", "{}.png".format(page_num))
+
+    # 文書の一覧 (ハッシュ値 → {"doc_id", "path", "pages"})
+    @property
+    def documents(self):
+        return self.manifest["documents"]
+
+    # ファイル(ディレクトリの場合は中のPDFと画像)を索引に追加する
+    # 既に索引にある内容のファイルは埋め込みを計算せずにスキップする
+    # 追加した文書とスキップした文書のdoc_idのリストを返す
+    def index(self, paths):
+        added = []
+        skipped = []
+        jobs = []
+
+        # サムネイルの幅を変えた場合は全ての文書のサムネイルを作り直す
+        if self.manifest["thumbnail_width"] != self.thumbnail_width:
+            for digest, entry in self.documents.items():
+                jobs.extend(self._thumbnail_jobs(digest, entry["pages"]))
+            self.manifest["thumbnail_width"] = self.thumbnail_width
+
+        for path in iter_files(paths):
+            digest = content_hash(path)
+            entry = self.documents.get(digest)
+            if entry is not None:
+                skipped.append(entry["doc_id"])
+                continue
+
+            document_dir = self._document_dir(digest)
+            pages = save_pages(path, os.path.join(document_dir, "pages"), self.workers or 1)
+            embeddings = self._embed(digest, pages)
+            np.savez(
+                os.path.join(document_dir, "embeddings.npz"),
+                *[np.asarray(page, dtype=np.float32) for page in embeddings],
+            )
+            self._embeddings[digest] = [np.asarray(page, dtype=np.float32) for page in embeddings]
+            jobs.extend(self._thumbnail_jobs(digest, pages))
+
+            entry = {"doc_id": self.manifest["next_doc_id"], "path": path, "pages": pages}
+            self.manifest["next_doc_id"] += 1
+            self.documents[digest] = entry
+            added.append(entry["doc_id"])
+
+        self._make_thumbnails(jobs)
+        self._save_manifest()
+        return added, skipped
+
+    # 保存したページの画像を読み込んで埋め込みを計算する
+    def _embed(self, digest, pages):
+        images = []
+        try:
+            for page_num in range(1, pages + 1):
+                with Image.open(self.page_path(digest, page_num)) as image:
+                    images.append(image.convert("RGB"))
+            return self.embedder.embed_pages(images)
+        finally:
+            for image in images:
+                image.close()
+
+    def _thumbnail_jobs(self, digest, pages):
+        os.makedirs(os.path.join(self._document_dir(digest), "thumbs"), exist_ok=True)
+        return [
+            (self.page_path(digest, page_num), self.thumbnail_path(digest, page_num),
+             self.thumbnail_width)
+            for page_num in range(1, pages + 1)
+        ]
+
+    # サムネイルをプロセスプールで並列に作成する
+    def _make_thumbnails(self, jobs):
+        if not jobs:
+            return
+        if self.workers == 0:
+            for job in jobs:
+                make_thumbnail(job)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(make_thumbnail, jobs, chunksize=max(1, len(jobs) // 32)))
+
+    # 文書のページごとの埋め込み (初回はファイルから読み込む)
+    def embeddings(self, digest):
+        pages = self._embeddings.get(digest)
+        if pages is None:
+            with np.load(os.path.join(self._document_dir(digest), "embeddings.npz")) as data:
+                pages = [data["arr_{}".format(i)] for i in range(len(data.files))]
+            self._embeddings[digest] = pages
+        return pages
+
+    # 検索文に近いページをスコアの高い順にk件返す
+    def search(self, query, k=5):
+        query = np.asarray(self.embedder.embed_query(query), dtype=np.float32)
+        scored = (
+            (max_sim(query, page), digest, page_num)
+            for digest in self.documents
+            for page_num, page in enumerate(self.embeddings(digest), 1)
+        )
+        return [
+            SearchResult(self.documents[digest]["doc_id"], page_num, score,
+                         digest, self.documents[digest]["path"])
+            for score, digest, page_num in heapq.nlargest(k, scored)
+        ]
+
+    # 検索結果のサムネイル (PNGのbase64)
+    def thumbnail_base64(self, result):
+        return read_base64(self.thumbnail_path(result.digest, result.page_num))
+
+    # 検索結果のページの画像 (PNGのbase64、GPTに渡す場合など)
+    def page_base64(self, result):
+        return read_base64(self.page_path(result.digest, result.page_num))
+
+    # 検索結果のサムネイルを横に並べて表示するHTML
+    def thumbnail_html(self, results):
+        images = "".join(
+            '<img src="data:image/png;base64,{}" '
+            'style="display:inline-block; margin-right: 10px;" />'.format(self.thumbnail_base64(result))
+            for result in results
+        )
+        return '<div style="white-space: nowrap;">{}</div>'.format(images)
+
+
+# ----------------埋め込みの計算----------------
+
+# byaldiのColQwen2 (ColPali系のモデル) で埋め込みを計算する
+class ColQwenEmbedder:
+
+    def __init__(self, model_name="vidore/colqwen2-v0.1", **kwargs):
+        from byaldi import RAGMultiModalModel
+        self.name = model_name
+        self.model = RAGMultiModalModel.from_pretrained(model_name, **kwargs).model
+
+    # ページごとにトークン数が異なるため、1ページずつ計算する
+    def embed_pages(self, images):
+        return [tensor_to_array(self.model.encode_image(image)) for image in images]
+
+    def embed_query(self, query):
+        return tensor_to_array(self.model.encode_query(query))
+
+# (1 x トークン数 x 次元) のtorchのテンソルを (トークン数 x 次元) のnumpyの配列にする
+def tensor_to_array(tensor):
+    array = tensor.float().cpu().numpy()
+    return array.reshape(-1, array.shape[-1])
+
+
+# モデルを使わない動作確認用の埋め込み
+# ページは縮小した画像の画素値、検索文は単語のハッシュ値から決まるベクトルにする
+class StubEmbedder:
+
+    name = "stub"
+    dim = 16
+
+    def embed_pages(self, images):
+        pages = []
+        for image in images:
+            pixels = np.asarray(image.convert("L").resize((self.dim, 4)), dtype=np.float32)
+            pages.append(pixels / 255.0 - 0.5)
+        return pages
+
+    def embed_query(self, query):
+        vectors = []
+        for word in query.split() or [""]:
+            seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:4], "big")
+            vectors.append(np.random.default_rng(seed).standard_normal(self.dim))
+        return np.asarray(vectors, dtype=np.float32)
+
+
+EMBEDDERS = {
+    "colqwen": ColQwenEmbedder,
+    "stub": StubEmbedder,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDFのページ画像の索引と検索")
+    parser.add_argument("--root", default=".page_index", help="索引を保存するディレクトリ")
+    parser.add_argument("--embedder", choices=sorted(EMBEDDERS), default="colqwen",
+                        help="埋め込みを計算するモデル")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="サムネイルを作成するプロセス数 (省略時はCPU数)")
+    parser.add_argument("--thumbnail-width", type=int, default=300, help="サムネイルの幅")
+    commands = parser.add_subparsers(dest="command", required=True)
+    index_parser = commands.add_parser("index", help="ファイルを索引に追加する")
+    index_parser.add_argument("paths", nargs="+", help="PDFや画像のファイルまたはディレクトリ")
+    search_parser = commands.add_parser("search", help="検索する")
+    search_parser.add_argument("query", help="検索文")
+    search_parser.add_argument("-k", type=int, default=5, help="返す件数")
+    args = parser.parse_args(argv)
+
+    index = PageIndex(args.root, EMBEDDERS[args.embedder](),
+                      thumbnail_width=args.thumbnail_width, workers=args.workers)
+    if args.command == "index":
+        added, skipped = index.index(args.paths)
+        report = {"added": added, "skipped": skipped}
+    else:
+        report = [result._asdict() for result in index.search(args.query, args.k)]
+    sys.stdout.write(json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
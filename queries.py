@@ -0,0 +1,100 @@
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Stock, Sales
+
+
+# ----------------在庫と売上の読み書き (Core)----------------
+# 在庫チェック、在庫の追加、販売は1商品の整数を読むか増減するだけだが、
+# ORM (Stock.query.filter_by(name=name).first() など) では毎回
+# クエリの組み立て、コンパイル済みSQLのキャッシュのキーの作成、identity mapへの登録、
+# Stockオブジェクトの作成を行い、SQLの実行よりもそちらに時間がかかる
+# ここではテーブルに対するSQL文(Core)をモジュールの読み込み時に1回だけ作成しておき、
+# 値はbindparamで渡して実行する
+#  - 同じSQL文を使い回すため、SQLAlchemyのコンパイル済みSQLのキャッシュに必ずヒットする
+#  - 結果はオブジェクトを作らずに値で返す
+#  - セッションのコネクションで直接実行する (ORMの実行処理を通らない)
+#    セッションと同じトランザクションで実行されるため、コミットとロールバックはセッションで行う
+# ORMとの1回あたりの時間の比較は benchmarks/queries.py を参照
+#
+# 各関数のsessionを省略した場合はFlask-SQLAlchemyのdb.sessionを使う
+#
+# コンパイル済みSQLのキャッシュについては下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/core/connections.html#sql-compilation-caching
+
+STOCKS = Stock.__table__
+SALES = Sales.__table__
+
+# 商品の在庫数
+SELECT_AMOUNT = select(STOCKS.c.amount).where(STOCKS.c.name == bindparam("name"))
+
+# 商品(product)の在庫数が販売数(sold)以上の場合のみ在庫を減らす
+# (UPDATE文では列名と同じ名前のbindparamは使えない)
+DECREMENT_AMOUNT = (
+    update(STOCKS)
+    .where(STOCKS.c.name == bindparam("product"), STOCKS.c.amount >= bindparam("sold"))
+    .values(amount=STOCKS.c.amount - bindparam("sold"))
+)
+
+# 売上の合計 (セント単位)
+SELECT_TOTAL = select(SALES.c.cents).where(SALES.c.name == "sales")
+
+
+# 行がない場合は追加し、ある場合はcolumnの値を加算するUPSERT文
+def increment_upsert(insert, table, column):
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={column: table.c[column] + stmt.excluded[column]},
+    )
+
+# DBごとのUPSERT文 (models.upsert_insert()と同じく、PostgreSQL以外はSQLiteの文を使う)
+# 在庫の追加
+UPSERT_AMOUNT = {
+    "postgresql": increment_upsert(postgresql.insert, STOCKS, "amount"),
+    "sqlite": increment_upsert(sqlite.insert, STOCKS, "amount"),
+}
+# 売上の加算
+UPSERT_TOTAL = {
+    "postgresql": increment_upsert(postgresql.insert, SALES, "cents"),
+    "sqlite": increment_upsert(sqlite.insert, SALES, "cents"),
+}
+
+
+# stmtを実行するセッションのコネクション
+# 参照用のDB(replicas.py)への振り分けはセッションと同じくstmtで判定する
+def connection(stmt, session=None):
+    if session is None:
+        session = db.session
+    return session.connection(bind_arguments={"clause": stmt})
+
+# DBに合わせたUPSERT文とコネクションを返す
+def upsert(statements, session=None):
+    conn = connection(statements["sqlite"], session)
+    return conn, statements.get(conn.dialect.name, statements["sqlite"])
+
+# 商品の在庫数 (商品がない場合はNone)
+def get_amount(name, session=None):
+    return connection(SELECT_AMOUNT, session).execute(SELECT_AMOUNT, {"name": name}).scalar()
+
+# 在庫を追加する (商品がない場合は作成する)
+def add_amount(name, amount, session=None):
+    conn, stmt = upsert(UPSERT_AMOUNT, session)
+    conn.execute(stmt, {"name": name, "amount": amount})
+
+# 在庫を減らす
+# 在庫数が販売数以上の場合のみ更新され、更新できた場合はTrueを返す
+def decrement_amount(name, amount, session=None):
+    result = connection(DECREMENT_AMOUNT, session).execute(
+        DECREMENT_AMOUNT, {"product": name, "sold": amount}
+    )
+    return result.rowcount == 1
+
+# 売上の合計 (セント単位、売上がない場合は0)
+def get_total(session=None):
+    return connection(SELECT_TOTAL, session).execute(SELECT_TOTAL).scalar() or 0
+
+# 売上を加算する (セント単位)
+# "sales"行がない場合は作成する
+def add_total(cents, session=None):
+    conn, stmt = upsert(UPSERT_TOTAL, session)
+    conn.execute(stmt, {"name": "sales", "cents": cents})
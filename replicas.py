@@ -0,0 +1,126 @@
+import threading
+import time
+
+from flask import request
+from sqlalchemy import text
+from models import db
+
+
+# ----------------参照用のDB (リードレプリカ)----------------
+# 在庫チェックや売上チェックなどのGETリクエストは、販売などの書き込みと同じ
+# コネクションプールを使うため、参照が多いと書き込みがコネクションを待たされる
+# READ_REPLICA_URIを指定した場合は、GET/HEADリクエストのSELECTを参照用のDBで実行する
+# (振り分けはmodels.pyのRoutingSessionで行い、書き込みは常に書き込み用のDBで実行する)
+#
+#  - SQLiteでは "primary" を指定すると、書き込み用と同じDBファイルに参照専用の
+#    コネクションプールを作る (PRAGMA query_only で書き込みを禁止する)
+#    WALモード(DB_PROFILE=sqlite-wal)では参照が書き込みの完了を待たず、
+#    コミット済みのデータを読むため遅れはない
+#  - PostgreSQLではストリーミングレプリケーションのスタンバイのURIを指定する
+#    レプリカの遅れをREPLICA_LAG_CHECK_INTERVAL秒ごとに確認し、
+#    REPLICA_MAX_LAG秒より遅れている間(確認できない場合も)は書き込み用のDBで参照する
+#    (GETで返すデータの古さの上限はREPLICA_MAX_LAG秒 + 在庫のキャッシュのSTOCK_CACHE_TTL秒)
+#  - シャーディング(sharding.py)しているシャードのセッションは振り分けない
+#
+# 実行例
+# $ DB_PROFILE=sqlite-wal READ_REPLICA_URI=primary python serve.py
+# $ DB_PROFILE=postgres DATABASE_URL=postgresql+psycopg2://...@primary/db \
+#   READ_REPLICA_URI=postgresql+psycopg2://...@standby/db python serve.py
+#
+# PostgreSQLのレプリケーションの状態を確認する関数については下記ページなどを参照
+# https://www.postgresql.org/docs/current/functions-admin.html#FUNCTIONS-RECOVERY-CONTROL
+
+# スタンバイの遅れ(秒)
+# 受信したWALを全て適用済みの場合は、最後の更新から時間が経っていても遅れはない
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery()"
+    " OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReadReplica:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._enabled = False
+        self._max_lag = 5.0
+        self._check_interval = 1.0
+        self._checked_at = None
+        self._usable = False
+        self.lag = None
+
+    # Flaskアプリケーションの設定を読み込み、参照用のDBをSQLALCHEMY_BINDSに追加する
+    # db.init_app()より前に呼び出す
+    def init_app(self, app):
+        app.config.setdefault("READ_REPLICA_URI", None)
+        app.config.setdefault("REPLICA_MAX_LAG", 5.0)
+        app.config.setdefault("REPLICA_LAG_CHECK_INTERVAL", 1.0)
+        self._max_lag = app.config["REPLICA_MAX_LAG"]
+        self._check_interval = app.config["REPLICA_LAG_CHECK_INTERVAL"]
+        self._checked_at = None
+        self.lag = None
+
+        uri = app.config["READ_REPLICA_URI"]
+        self._enabled = bool(uri)
+        if not uri:
+            return
+        if uri == "primary":
+            uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds["replica"] = uri
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+        app.before_request(self._route_reads)
+
+    # GET/HEADリクエストの参照をレプリカに振り分ける
+    def _route_reads(self):
+        if request.method in ("GET", "HEAD") and self.usable():
+            db.session.info["replica"] = True
+
+    # レプリカの遅れがREPLICA_MAX_LAG秒以下かどうか
+    # 確認はREPLICA_LAG_CHECK_INTERVAL秒ごとに1回だけ行い、結果を使い回す
+    def usable(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self._check_interval:
+                return self._usable
+            self._checked_at = now
+
+        lag = self.measure_lag()
+        with self._lock:
+            self.lag = lag
+            self._usable = lag is not None and lag <= self._max_lag
+            return self._usable
+
+    # レプリカの遅れ(秒)を返す (確認できない場合はNone)
+    # SQLiteは書き込み用と同じDBファイルを読むため常に0とする
+    def measure_lag(self):
+        engine = db.engines["replica"]
+        if engine.dialect.name != "postgresql":
+            return 0.0
+        try:
+            with engine.connect() as conn:
+                return float(conn.scalar(POSTGRES_LAG_QUERY) or 0)
+        except Exception:
+            return None
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        if not self._enabled:
+            return []
+        with self._lock:
+            return [
+                ("replica_lag_seconds", "gauge",
+                 "Last measured read replica lag (-1 if unknown).", [
+                    ({}, -1 if self.lag is None else self.lag),
+                ]),
+                ("replica_in_use", "gauge",
+                 "1 if GET requests are routed to the read replica.", [
+                    ({}, 1 if self._usable else 0),
+                ]),
+            ]
+
+
+# ReadReplicaインスタンスの作成
+read_replica = ReadReplica()
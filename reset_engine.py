@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+
+import click
+from flask import current_app
+from sqlalchemy import delete, insert, select, text
+from models import db, Stock, Sales, SalesLedger, ProductSales, SalesRollup,\
+    WriteBehindCheckpoint, WriteBehindReject
+import change_feed
+import low_stock
+from sharding import shard_router
+
+
+# ----------------全削除とスナップショット----------------
+# 負荷試験の環境では試験のたびに在庫と売上を全削除したり、決まった在庫データに戻したりする
+#
+# 全削除 (reset)
+#  - 在庫、売上、販売の履歴と集計のテーブルを1つのトランザクションで削除する
+#    (PostgreSQLはTRUNCATE、SQLiteは条件なしのDELETEで、どちらも行ごとの削除はしない)
+#  - 発注点の設定は削除しない (全ての商品の在庫数が0になるため、発注点を下回っている状態にする)
+#  - 変更履歴には全削除を記録する (それより前の変更履歴は削除される)
+#
+# スナップショット (snapshot / restore)
+#  - SQLiteのオンラインバックアップAPIで、DBファイル全体をページ単位でコピーする
+#    行ごとにSELECT/INSERTしないため、100万行の在庫データでもファイルのコピーと同程度の時間で済む
+#  - 戻すときもバックアップAPIで使用中のDBに上書きする (1つのトランザクションで置き換わるため、
+#    他のコネクションから途中の状態が見えることはない)
+#  - 戻した後は変更履歴のseqが戻る前より小さくならないようにしてから、全削除を記録する
+#    (参照側は全削除を受け取って全商品の在庫を取得し直す)
+#  - 販売の遅延書き込み(write_behind.py)の反映済みのセグメント番号と反映できなかった販売は、
+#    スナップショットの内容ではなく戻す前の内容を引き継ぐ
+#    (スナップショットのセグメント番号に戻ると、起動時に未反映のセグメントを反映済みとみなして
+#     読み飛ばしたり、反映済みのセグメントを二重に反映したりするため)
+#  - スナップショットはSNAPSHOT_DIRに<name>.dbとして保存する
+#  - SQLite以外のDBでは使えない (PostgreSQLはpg_dumpやテンプレートDBを使う)
+#    シャーディング(sharding.py)している場合も使えない
+#
+# 実行例
+# $ flask snapshot-stocks fixture
+# $ flask restore-stocks fixture
+# $ flask reset-stocks
+# (SNAPSHOT_API=1 の場合は POST /v1/snapshots/<name>、POST /v1/snapshots/<name>/restore でも実行できる)
+#
+# バックアップAPIについては下記ページなどを参照
+# https://www.sqlite.org/backup.html
+# https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.backup
+
+# 全削除の対象のテーブル
+# (発注点の設定、Idempotency-Keyのレスポンス、遅延書き込みの状態は削除しない)
+DATA_MODELS = (Stock, Sales, SalesLedger, ProductSales, SalesRollup)
+
+# 遅延書き込みの状態のテーブル (スナップショットから戻す場合も戻す前の内容を引き継ぐ)
+WRITE_BEHIND_MODELS = (WriteBehindCheckpoint, WriteBehindReject)
+
+# スナップショット名の最大文字数
+MAX_NAME_LENGTH = 64
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# 在庫と売上を全削除する (コミットは呼び出し側で行う)
+def reset(session=None):
+    if session is None:
+        session = db.session
+
+    tables = [model.__table__ for model in DATA_MODELS]
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("TRUNCATE TABLE {}".format(
+            ", ".join(table.name for table in tables)
+        )))
+    else:
+        for table in tables:
+            session.execute(delete(table))
+    low_stock.reset_all(session)
+    change_feed.record_reset(session)
+
+
+# ----------------スナップショット----------------
+
+# スナップショットのファイルのパス
+# 名前は英数字、"-"、"_"のみとする
+def snapshot_path(name):
+    if not name or len(name) > MAX_NAME_LENGTH or not name.isascii() or\
+       not name.replace("-", "").replace("_", "").isalnum():
+        raise SnapshotError("invalid snapshot name: {!r}".format(name))
+    return os.path.join(current_app.config["SNAPSHOT_DIR"], name + ".db")
+
+# 使用中のDBのsqlite3コネクションを取り出す
+def raw_connection(conn):
+    if shard_router.enabled:
+        raise SnapshotError("snapshots do not support DB_SHARDS")
+    if conn.dialect.name != "sqlite":
+        raise SnapshotError("snapshots require SQLite")
+    return conn.connection.dbapi_connection
+
+# テーブルとインデックスの定義 (スキーマが同じDBかどうかの確認に使う)
+def schema_of(connection):
+    return connection.execute(
+        "SELECT type, name, sql FROM sqlite_master "
+        "WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name"
+    ).fetchall()
+
+# 現在のDBの内容をスナップショットとして保存し、ファイルのサイズを返す
+# 同じ名前のスナップショットがある場合は置き換える
+def snapshot(name):
+    path = snapshot_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # 書きかけのファイルをスナップショットとして使わないように、別名で保存してから置き換える
+    partial = path + ".partial"
+    with db.engine.connect() as conn:
+        source = raw_connection(conn)
+        target = sqlite3.connect(partial)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    os.replace(partial, path)
+    return os.path.getsize(path)
+
+# スナップショットの内容に戻す
+# スキーマ(マイグレーションのリビジョン)が異なるスナップショットは戻さない
+def restore(name):
+    path = snapshot_path(name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    with db.engine.connect() as conn:
+        target = raw_connection(conn)
+        # 戻す前の変更履歴の最大のseq
+        last_seq = max(
+            conn.scalar(text(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'stock_changes'"
+            )) or 0,
+            change_feed.latest_seq(conn),
+        )
+        write_behind_rows = {
+            model: [dict(row._mapping) for row in conn.execute(select(model.__table__))]
+            for model in WRITE_BEHIND_MODELS
+        }
+        conn.commit()
+
+        source = sqlite3.connect(path)
+        try:
+            if schema_of(source) != schema_of(target):
+                raise SnapshotError("snapshot schema does not match the database")
+            source.backup(target)
+        finally:
+            source.close()
+
+    # 以降の変更履歴のseqを戻す前の最大値より大きくし、全削除を記録する
+    session = db.session
+    updated = session.execute(
+        text("UPDATE sqlite_sequence SET seq = :seq "
+             "WHERE name = 'stock_changes' AND seq < :seq"),
+        {"seq": last_seq},
+    ).rowcount
+    if not updated and not session.scalar(
+        text("SELECT 1 FROM sqlite_sequence WHERE name = 'stock_changes'")
+    ):
+        session.execute(
+            text("INSERT INTO sqlite_sequence (name, seq) VALUES ('stock_changes', :seq)"),
+            {"seq": last_seq},
+        )
+    for model, rows in write_behind_rows.items():
+        session.execute(delete(model.__table__))
+        if rows:
+            session.execute(insert(model.__table__), rows)
+    change_feed.record_reset(session)
+    session.commit()
+
+
+# ----------------CLIコマンド----------------
+# 別のプロセスで実行した場合、起動中のサーバーのキャッシュ(最大STOCK_CACHE_TTL秒)は
+# 破棄されないため、サーバーのキャッシュもすぐに破棄する場合はAPIを使う
+
+# flask reset-stocks で在庫と売上を全削除する
+@click.command("reset-stocks")
+def reset_stocks_command():
+    for session in shard_router.sessions():
+        reset(session)
+        session.commit()
+    click.echo(json.dumps({}))
+
+# flask snapshot-stocks NAME で現在のDBの内容をスナップショットとして保存する
+@click.command("snapshot-stocks")
+@click.argument("name")
+def snapshot_stocks_command(name):
+    try:
+        size = snapshot(name)
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps({"name": name, "bytes": size}))
+
+# flask restore-stocks NAME でスナップショットの内容に戻す
+@click.command("restore-stocks")
+@click.argument("name")
+def restore_stocks_command(name):
+    try:
+        restore(name)
+    except FileNotFoundError:
+        raise click.ClickException("snapshot not found: {}".format(name))
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps({"name": name}))
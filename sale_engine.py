@@ -0,0 +1,190 @@
+import time
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import insert, select
+from models import db, Stock, SalesLedger, ProductSales, SalesRollup, upsert_insert
+import change_feed
+import queries
+
+
+# ----------------販売処理----------------
+# 在庫のチェックと減算を1つの条件付きUPDATE文で行い、
+# 売上の加算と合わせて1トランザクション(1コミット)で処理する
+#
+# SELECTで在庫を読み込んでからPython側でチェックして書き込む方式だと、
+# 読み込みと書き込みの間に別のリクエストが割り込んだ場合に
+# 在庫を売り越してしまう(lost update)ため、チェックはDB側で行う
+# (在庫の減算と売上の加算のSQL文はqueries.pyで作成済みのものを使う)
+# UPDATE文については下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/tutorial/data_update.html
+
+# 販売の履歴(sales_ledger)と、商品ごと・時間単位ごとの集計(product_sales, sales_rollups)も
+# 同じトランザクションで更新する
+# 集計は販売のたびに加算していくため、集計結果の参照で履歴全体を読み込む必要はない
+# 変更履歴(stock_changes、change_feed.pyを参照)にも販売ごとに1行追加する
+
+# 売上は浮動小数点数の誤差が累積しないよう、整数の「セント」(金額 x 100) で扱う
+
+# 集計する時間単位と期間の長さ(秒)
+GRANULARITIES = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+
+# 販売価格 x 数量 をセント単位の整数で返す
+# priceが整数の場合は整数の計算のみで求め、小数の場合はDecimalで正確に計算して
+# 1セント未満を四捨五入する
+def revenue_cents(price, amount):
+    if price is None:
+        return 0
+    if isinstance(price, int):
+        return price * amount * 100
+    cents = Decimal(repr(price)) * amount * 100
+    return int(cents.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+# 販売の履歴と集計を更新する
+# linesは販売できた (name, amount, price, 売上(セント)) のリスト
+def record_sales(lines, sold_at=None, session=None):
+    if session is None:
+        session = db.session
+
+    if sold_at is None:
+        sold_at = int(time.time())
+
+    # 履歴を追加する
+    session.execute(
+        insert(SalesLedger),
+        [
+            {"name": name, "amount": amount, "price": price,
+             "cents": cents, "sold_at": sold_at}
+            for name, amount, price, cents in lines
+        ],
+    )
+
+    # 商品ごとの販売数と売上を合計する
+    products = {}
+    for name, amount, price, cents in lines:
+        total = products.setdefault(name, [0, 0])
+        total[0] += amount
+        total[1] += cents
+
+    stmt = upsert_insert(ProductSales.__table__, session)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ProductSales.name],
+            set_={
+                "amount": ProductSales.amount + stmt.excluded.amount,
+                "cents": ProductSales.cents + stmt.excluded.cents,
+            },
+        ),
+        [{"name": name, "amount": amount, "cents": cents}
+         for name, (amount, cents) in products.items()],
+    )
+
+    # 時間単位ごとに、商品別と全商品(nameが空文字)の集計を加算する
+    all_amount = sum(amount for amount, _ in products.values())
+    all_cents = sum(cents for _, cents in products.values())
+    rows = []
+    for granularity, seconds in GRANULARITIES.items():
+        bucket = sold_at - sold_at % seconds
+        rows.append({"granularity": granularity, "bucket": bucket, "name": "",
+                     "amount": all_amount, "cents": all_cents})
+        for name, (amount, cents) in products.items():
+            rows.append({"granularity": granularity, "bucket": bucket, "name": name,
+                         "amount": amount, "cents": cents})
+
+    stmt = upsert_insert(SalesRollup.__table__, session)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[SalesRollup.granularity, SalesRollup.bucket, SalesRollup.name],
+            set_={
+                "amount": SalesRollup.amount + stmt.excluded.amount,
+                "cents": SalesRollup.cents + stmt.excluded.cents,
+            },
+        ),
+        rows,
+    )
+
+    # 変更履歴を追加する
+    change_feed.record_changes(
+        "sale",
+        [(name, -amount, cents) for name, amount, price, cents in lines],
+        session,
+    )
+
+# 販売
+# 在庫の減算と売上の加算を同じトランザクションで行いコミットする
+# 在庫が存在しない、または不足している場合はロールバックしてFalseを返す
+#
+# 各関数のsessionを省略した場合はFlask-SQLAlchemyのdb.sessionを使う
+# (ASGI版では非同期セッションのrun_sync()から同期セッションを渡す)
+def sell(name, amount, price=None, session=None):
+    if session is None:
+        session = db.session
+
+    if not queries.decrement_amount(name, amount, session):
+        session.rollback()
+        return False
+
+    # priceが指定されている場合のみ売上に 販売価格 x 数量 を加算
+    cents = revenue_cents(price, amount)
+    if cents:
+        queries.add_total(cents, session)
+    record_sales([(name, amount, price, cents)], session=session)
+
+    session.commit()
+    return True
+
+# まとめて販売
+# linesは (name, amount, price) のリスト
+# 明細ごとに販売できたかどうか(True/False)のリストを返す
+def sell_batch(lines, session=None):
+    if session is None:
+        session = db.session
+
+    # 明細に含まれる商品の在庫を1回のIN検索でまとめて取得する
+    names = {name for name, _, _ in lines}
+    remaining = dict(
+        session.execute(
+            select(Stock.name, Stock.amount).where(Stock.name.in_(names))
+        ).all()
+    )
+
+    # 取得した在庫数をもとに明細を先頭から順に割り当てる
+    # 在庫が存在しない、または不足している明細は販売しない
+    results = []
+    planned = {}
+    for i, (name, amount, price) in enumerate(lines):
+        if remaining.get(name, 0) < amount:
+            results.append(False)
+            continue
+        remaining[name] -= amount
+        planned.setdefault(name, []).append(i)
+        results.append(True)
+
+    # 商品ごとに割り当てた数量の合計を条件付きUPDATEで減算する
+    # 取得後に他のリクエストで在庫が減っていた場合は、
+    # その商品の明細だけ1件ずつ条件付きUPDATEで減算し直す
+    for name, indexes in planned.items():
+        total = sum(lines[i][1] for i in indexes)
+        if queries.decrement_amount(name, total, session):
+            continue
+        for i in indexes:
+            results[i] = queries.decrement_amount(name, lines[i][1], session)
+
+    # 販売できた明細のうちpriceが指定されているものを売上に加算
+    sold = [
+        (name, amount, price, revenue_cents(price, amount))
+        for (name, amount, price), ok in zip(lines, results)
+        if ok
+    ]
+    cents = sum(line[3] for line in sold)
+    if cents:
+        queries.add_total(cents, session)
+    if sold:
+        record_sales(sold, session=session)
+
+    session.commit()
+    return results
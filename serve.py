@@ -0,0 +1,107 @@
+import argparse
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+
+# ----------------本番用のサーバー起動----------------
+# gunicorn を使い、マスタープロセスから複数のワーカープロセスを起動(prefork)する
+# main.py の app.run() はWerkzeugの開発用サーバーで1プロセスでしか動かないため、
+# 本番ではこちらを使う
+#
+# 実行例 (gunicornのインストールが必要)
+# $ python serve.py --bind 0.0.0.0:80 --workers 4
+# $ python serve.py --asgi        # ASGI版 (asgi.py) をuvicornのワーカーで動かす
+#
+# 設定を変更せずにワーカーを入れ替える(graceful reload)場合は、
+# マスタープロセスにHUPシグナルを送る
+# $ kill -HUP $(cat serve.pid)
+# 新しいワーカーを起動してから、古いワーカーは処理中のリクエストを終えて終了する
+#
+# 各ワーカーはcreate_app()を呼び出して自分のアプリケーションとDBのコネクションプールを作る
+# (preload_appは使わない。fork前に作ったDBのコネクションを複数のプロセスで共有しないため)
+# 在庫のキャッシュや計測結果はワーカーごとに持つ
+# 販売の遅延書き込み (SALE_WRITE_BEHIND=1) を使う場合は --workers 1 で起動する
+# 在庫データのキャッシュ (STOCK_CACHE_TTL) はワーカーごとに持つため、
+# 複数のワーカーで有効にすると他のワーカーでの更新がTTL秒まで反映されない
+#
+# gunicorn の設定については下記ページなどを参照
+# https://docs.gunicorn.org/en/stable/settings.html
+
+
+class Server(BaseApplication):
+
+    def __init__(self, options, asgi=False):
+        self.options = options
+        self.asgi = asgi
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    # ワーカープロセスで呼び出される
+    def load(self):
+        if self.asgi:
+            from asgi import app
+            return app
+
+        from app import create_app
+        return create_app()
+
+
+def default_workers():
+    return int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="v1 APIの本番用サーバー")
+    parser.add_argument("--bind", default=os.environ.get("BIND", "0.0.0.0:80"),
+                        help="待ち受けるアドレスとポート")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="ワーカープロセス数 (省略時はCPU数 x 2 + 1)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="WSGIのワーカーごとのスレッド数")
+    parser.add_argument("--worker-connections", type=int, default=1000,
+                        help="ワーカーごとに保持する接続数の上限 (キープアライブ中の接続を含む)")
+    parser.add_argument("--keepalive", type=int, default=75,
+                        help="キープアライブの接続を保持する秒数 "
+                             "(ロードバランサーのアイドルタイムアウトより長くする)")
+    parser.add_argument("--timeout", type=int, default=30,
+                        help="応答のないワーカーを再起動するまでの秒数")
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="再起動時に処理中のリクエストの完了を待つ秒数")
+    parser.add_argument("--max-requests", type=int, default=10000,
+                        help="ワーカーを再起動するまでのリクエスト数 (0は無制限)")
+    parser.add_argument("--pidfile", default="serve.pid",
+                        help="マスタープロセスのPIDを書き込むファイル")
+    parser.add_argument("--asgi", action="store_true",
+                        help="ASGI版 (asgi.py) をuvicornのワーカーで動かす")
+    args = parser.parse_args(argv)
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_connections": args.worker_connections,
+        "keepalive": args.keepalive,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        # 全ワーカーが同時に再起動しないようにばらつかせる
+        "max_requests_jitter": args.max_requests // 10,
+        "pidfile": args.pidfile,
+        "preload_app": False,
+    }
+    if args.asgi:
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        # スレッドでリクエストを処理し、キープアライブ中の接続はスレッドを占有しない
+        options["worker_class"] = "gthread"
+        options["threads"] = args.threads
+
+    Server(options, asgi=args.asgi).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import heapq
+import os
+import zlib
+from operator import itemgetter
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from models import db
+import db_profiles
+
+
+# ----------------在庫データのシャーディング----------------
+# 1つのSQLiteファイルは書き込みのロックが1つしかないため、全ての書き込みが順番待ちになる
+# DB_SHARDSに2以上を指定した場合は、商品名(name)のハッシュ値で在庫データを
+# DB_SHARDS個のDBファイル(シャード)に分け、シャードごとにエンジンとセッションを持つ
+# 別のシャードの商品への書き込みは同時に進むため、書き込みのスループットがシャード数に応じて増える
+#
+#  - 1商品の処理(在庫チェック、在庫の追加、販売)は、その商品のシャードだけで行う
+#    在庫の減算と売上の加算、販売の履歴と集計は同じシャードの1トランザクションで更新する
+#  - 売上の合計は各シャードの"sales"行の合計とする
+#    (販売ごとにどれか1つのシャードの売上だけが増えるため、合計は常に販売と一致する)
+#  - 全商品の在庫一覧は各シャードからnameの昇順で読み込み、マージして返す
+#  - まとめて販売、一括登録、全削除はシャードごとのトランザクションで処理する
+#    (シャードをまたいだ1つのトランザクションにはならない)
+#  - シャードのテーブルはモデルの定義から作成する (マイグレーションは元のDBのみに適用される)
+#  - Idempotency-Keyのレスポンスは商品のシャードではなく元のDBに保存する (idempotency.pyを参照)
+#  - 変更履歴(/v1/changes)、販売の遅延書き込み、スナップショット、ASGI版は
+#    シャーディングに対応していない
+#
+# DB_SHARDSが0または1の場合はシャーディングせず、全ての処理でdb.sessionを使う
+#
+# 実行例
+# $ DB_SHARDS=4 python serve.py --workers 4
+# (シャードのファイルは data.shard0.db, data.shard1.db, ... のように元のDBファイルの隣に作成する
+#  SHARD_DATABASE_URIに "{}" をシャード番号に置き換えるURIを指定して変更できる)
+
+
+class ShardRouter:
+
+    def __init__(self):
+        self.engines = []
+        self._sessions = []
+
+    # Flaskアプリケーションの設定を読み込み、シャードのエンジンとセッションを作成する
+    def init_app(self, app):
+        app.config.setdefault("DB_SHARDS", 0)
+        app.config.setdefault("SHARD_DATABASE_URI", None)
+        self.close()
+
+        count = app.config["DB_SHARDS"]
+        if count < 2:
+            return
+        if app.config.get("SALE_WRITE_BEHIND"):
+            raise ValueError("DB_SHARDS cannot be used with SALE_WRITE_BEHIND")
+
+        template = app.config["SHARD_DATABASE_URI"]
+        if template is None:
+            template = default_shard_uri(app)
+
+        options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        pragmas = app.config.get("SQLITE_PRAGMAS")
+        for i in range(count):
+            engine = create_engine(template.format(i), **options)
+            if pragmas:
+                db_profiles.listen_sqlite_pragmas(engine, pragmas)
+            db.metadata.create_all(engine)
+            self.engines.append(engine)
+            self._sessions.append(scoped_session(sessionmaker(bind=engine)))
+
+        app.teardown_appcontext(self._remove_sessions)
+
+    # シャーディングしているかどうか
+    @property
+    def enabled(self):
+        return bool(self._sessions)
+
+    # 商品名に対応するシャードの番号
+    # プロセスごとに値が変わらないようにPythonのhash()ではなくCRC32を使う
+    def index(self, name):
+        return zlib.crc32(name.encode()) % len(self._sessions)
+
+    # 商品名に対応するシャードのセッション (シャーディングしていない場合はdb.session)
+    def session_for(self, name):
+        if not self._sessions:
+            return db.session
+        return self._sessions[self.index(name)]()
+
+    # 全てのシャードのセッション
+    def sessions(self):
+        if not self._sessions:
+            return [db.session]
+        return [session() for session in self._sessions]
+
+    # 商品名のリストをシャードごとに分け、(セッション, namesの添字のリスト) のリストを返す
+    def group(self, names):
+        if not self._sessions:
+            return [(db.session, list(range(len(names))))]
+        groups = {}
+        for i, name in enumerate(names):
+            groups.setdefault(self.index(name), []).append(i)
+        return [(self._sessions[index](), indexes) for index, indexes in groups.items()]
+
+    # 全てのシャードでqueryを実行し、各シャードの結果をkeyの昇順にマージして返す
+    # queryは各シャードでkeyの昇順に並べたものであること
+    def merged(self, query, key=itemgetter(0)):
+        if not self._sessions:
+            return db.session.execute(query)
+        return heapq.merge(
+            *(session.execute(query) for session in self.sessions()), key=key
+        )
+
+    def _remove_sessions(self, error):
+        for session in self._sessions:
+            session.remove()
+
+    # シャードのセッションとコネクションを全て閉じる
+    def close(self):
+        for session in self._sessions:
+            session.remove()
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+        self._sessions = []
+
+
+# 元のDBがSQLiteファイルの場合、その隣に<ファイル名>.shard<番号>.dbを作成するURI
+def default_shard_uri(app):
+    with app.app_context():
+        url = db.engine.url
+    if url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        raise ValueError("DB_SHARDS requires SHARD_DATABASE_URI unless the database is a SQLite file")
+    root, ext = os.path.splitext(url.database)
+    return "{}:///{}.shard{{}}{}".format(url.drivername, root, ext or ".db")
+
+
+# ShardRouterインスタンスの作成
+shard_router = ShardRouter()
@@ -0,0 +1,140 @@
+import csv
+import json
+
+import click
+import change_feed
+import queries
+from sharding import shard_router
+from validation import Invalid, STOCK
+
+
+# ----------------在庫の一括登録----------------
+# NDJSON (1行に1つのJSON) または CSV (name,amount) 形式のデータを
+# 1行ずつ読み込み、一定件数ごとにまとめてUPSERTする
+# データ全体をメモリに読み込まないため、件数が多くてもメモリ使用量は一定になる
+#
+# UPSERT (INSERT ... ON CONFLICT) については下記ページなどを参照
+# https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#insert-on-conflict-upsert
+# https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#insert-on-conflict-upsert
+
+
+# 1回のトランザクションでUPSERTする件数
+DEFAULT_CHUNK_SIZE = 5000
+
+
+# 在庫データ(name, amount)の値チェック
+# add_stocks_v1と同じ条件でチェックし、ERRORとなる場合はNoneを返す
+# (amountが指定されていない場合はamount = 1とする)
+def to_stock_row(name, amount):
+    try:
+        return STOCK.validate({"name": name, "amount": amount})
+    except Invalid:
+        return None
+
+# NDJSON形式の行を (name, amount) またはNoneに変換する
+def parse_ndjson(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if not isinstance(data, dict):
+            yield None
+            continue
+        yield to_stock_row(data.get("name"), data.get("amount"))
+
+# CSV形式の行を (name, amount) またはNoneに変換する
+# 1行目が "name,amount" の場合はヘッダーとして読み飛ばす
+def parse_csv(lines):
+    decoded = (
+        line.decode("utf-8") if isinstance(line, bytes) else line
+        for line in lines
+    )
+    for i, row in enumerate(csv.reader(decoded)):
+        if not row:
+            continue
+        if i == 0 and [col.strip() for col in row[:2]] == ["name", "amount"]:
+            continue
+        if len(row) > 2:
+            yield None
+            continue
+
+        name = row[0].strip()
+        amount = row[1].strip() if len(row) == 2 else ""
+        if amount == "":
+            amount = None
+        elif amount.isdigit():
+            amount = int(amount)
+        yield to_stock_row(name, amount)
+
+# 1チャンク分のデータをUPSERTしてコミットする
+# 同じ商品が複数行ある場合はamountを合計してから1行にまとめる
+# 既に存在する商品はamountを加算する (UPSERT文はqueries.pyで作成済みのものを使う)
+# 変更履歴も同じトランザクションで追加する
+# シャーディングしている場合はシャードごとにUPSERTしてコミットする
+def flush_chunk(chunk):
+    names = list(chunk)
+    for session, indexes in shard_router.group(names):
+        rows = [(names[i], chunk[names[i]]) for i in indexes]
+        conn, stmt = queries.upsert(queries.UPSERT_AMOUNT, session)
+        conn.execute(
+            stmt,
+            [{"name": name, "amount": amount} for name, amount in rows],
+        )
+        change_feed.record_changes(
+            "stock", [(name, amount, 0) for name, amount in rows], session
+        )
+        session.commit()
+
+# 在庫データを一括登録する
+# 登録した行数と値チェックでERRORとなった行数を返す
+def import_stocks(lines, fmt="ndjson", chunk_size=DEFAULT_CHUNK_SIZE):
+    parse = parse_csv if fmt == "csv" else parse_ndjson
+
+    imported = 0
+    rejected = 0
+    chunk = {}
+    rows = 0
+    for row in parse(lines):
+        if row is None:
+            rejected += 1
+            continue
+        name, amount = row
+        chunk[name] = chunk.get(name, 0) + amount
+        rows += 1
+        if rows >= chunk_size:
+            flush_chunk(chunk)
+            imported += rows
+            chunk = {}
+            rows = 0
+
+    if chunk:
+        flush_chunk(chunk)
+        imported += rows
+
+    return imported, rejected
+
+
+# ----------------CLIコマンド----------------
+# flask import-stocks FILE [--format csv] で在庫データを一括登録する
+# Flask のCLIコマンドについては下記ページなどを参照
+# https://flask.palletsprojects.com/en/3.0.x/cli/#custom-commands
+@click.command("import-stocks")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default=None,
+              help="ファイル形式 (省略時は拡張子から判定)")
+@click.option("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+              help="1回のトランザクションでUPSERTする件数")
+def import_stocks_command(path, fmt, chunk_size):
+    if fmt is None:
+        fmt = "csv" if path.lower().endswith(".csv") else "ndjson"
+
+    with open(path, "rb") as f:
+        imported, rejected = import_stocks(f, fmt, chunk_size)
+
+    click.echo(json.dumps({"imported": imported, "rejected": rejected}))
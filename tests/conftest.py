@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のモジュール(app.pyなど)を読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db
+from sharding import shard_router
+from write_behind import sale_coalescer
+
+
+# 一時ディレクトリのSQLiteファイルを使うアプリケーションを作成する関数
+# 引数の設定で既定の設定を上書きする
+# 書き込みの流量制御は、スレッドから同時にリクエストを送るテストのために無効にしておく
+@pytest.fixture
+def make_app(tmp_path):
+    apps = []
+
+    def make(**config):
+        settings = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+            "SALE_JOURNAL_DIR": str(tmp_path / "journal"),
+            "ADMISSION_ENABLED": False,
+        }
+        settings.update(config)
+        app = create_app(settings)
+        with app.app_context():
+            db.create_all()
+        apps.append(app)
+        return app
+
+    yield make
+
+    # 遅延書き込みのスレッドを止め、プロセス内に残る販売可能数を破棄する
+    sale_coalescer.close()
+    sale_coalescer.forget_all()
+    shard_router.close()
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,55 @@
+import threading
+
+import queries
+from admission import admission
+from sharding import shard_router
+
+
+# 別々のシャードに入る2つの商品名
+def names_on_different_shards():
+    first = "aaa"
+    for letter in "bcdefghijklmnopqrstuvwxyz":
+        name = letter * 3
+        if shard_router.index(name) != shard_router.index(first):
+            return first, name
+    raise AssertionError("no name on another shard")
+
+
+def test_writes_to_different_shards_run_concurrently(make_app, monkeypatch):
+    app = make_app(DB_SHARDS=2, ADMISSION_ENABLED=True)
+    assert admission.max_in_flight == 2
+
+    # 2件の書き込みが同時に処理されている場合だけ、両方がbarrierを通過できる
+    barrier = threading.Barrier(2, timeout=5)
+    add_amount = queries.add_amount
+
+    def wait_for_other(name, amount, session=None):
+        barrier.wait()
+        return add_amount(name, amount, session)
+
+    monkeypatch.setattr(queries, "add_amount", wait_for_other)
+
+    statuses = []
+
+    def post(name):
+        response = app.test_client().post("/v1/stocks", json={"name": name, "amount": 1})
+        statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=post, args=(name,)) for name in names_on_different_shards()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [200, 200]
+    assert admission.in_flight == 0
+
+
+def test_write_behind_is_not_limited(make_app):
+    make_app(SALE_WRITE_BEHIND=True, ADMISSION_ENABLED=True)
+    assert admission.max_in_flight == 0
+
+
+def test_explicit_limit_is_kept(make_app):
+    make_app(WRITE_MAX_IN_FLIGHT=3, ADMISSION_ENABLED=True)
+    assert admission.max_in_flight == 3
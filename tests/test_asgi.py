@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy.engine import make_url
+
+pytest.importorskip("aiosqlite")
+
+import asgi
+
+
+# ASGIアプリケーションにリクエストを1つ送り、(ステータス, ボディのJSON) を返す
+def call(app, method, path, data=None, headers=()):
+    body = json.dumps(data).encode() if data is not None else b""
+    if data is not None:
+        headers = [("Content-Type", "application/json")] + list(headers)
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {
+            "type": "http", "method": method, "path": path,
+            "headers": [(key.lower().encode(), value.encode()) for key, value in headers],
+        }
+        await app(scope, receive, send)
+        await app.shutdown()
+
+    asyncio.run(run())
+    return messages[0]["status"], json.loads(messages[1]["body"])
+
+
+# Idempotency-Keyを指定したリクエストは処理せずに501を返す
+def test_idempotency_key_is_rejected(app, tmp_path):
+    asgi_app = asgi.AsgiApp(url=make_url("sqlite+aiosqlite:///" + str(tmp_path / "test.db")))
+    assert call(asgi_app, "POST", "/v1/stocks", {"name": "aaa", "amount": 5}) == (200, {"name": "aaa", "amount": 5})
+
+    status, _ = call(asgi_app, "POST", "/v1/sales", {"name": "aaa", "amount": 2},
+                     headers=[("Idempotency-Key", "k1")])
+    assert status == 501
+    assert call(asgi_app, "GET", "/v1/stocks/aaa") == (200, {"aaa": 5})
+
+
+# Content-TypeがJSONでないリクエストは400を返す (WSGI版と同じ)
+def test_non_json_content_type_is_rejected(app, tmp_path):
+    asgi_app = asgi.AsgiApp(url=make_url("sqlite+aiosqlite:///" + str(tmp_path / "test.db")))
+    assert call(asgi_app, "POST", "/v1/stocks", {"name": "aaa", "amount": 5},
+                headers=[("Content-Type", "text/plain")]) == (400, {"message": "ERROR"})
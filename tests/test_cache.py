@@ -0,0 +1,35 @@
+from sqlalchemy import update
+
+from models import db, Stock
+
+
+# 他のワーカーによる在庫の変更 (このプロセスのキャッシュは無効化されない)
+def update_in_other_worker(app, name, amount):
+    with app.app_context():
+        db.session.execute(update(Stock).where(Stock.name == name).values(amount=amount))
+        db.session.commit()
+        db.session.remove()
+
+
+# 既定ではキャッシュしないため、他のワーカーの変更をすぐに返す
+def test_default_returns_changes_from_other_workers(app, client):
+    assert client.post("/v1/stocks", json={"name": "aaa", "amount": 5}).status_code == 200
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+
+    update_in_other_worker(app, "aaa", 7)
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 7}
+
+
+# STOCK_CACHE_TTLを指定した場合はTTLの間キャッシュした在庫数を返す
+# (同じプロセスでの変更はすぐに無効化する)
+def test_ttl_caches_until_local_write(make_app):
+    client = make_app(STOCK_CACHE_TTL=60).test_client()
+    app = client.application
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+
+    update_in_other_worker(app, "aaa", 7)
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 8}
@@ -0,0 +1,25 @@
+from change_feed import change_notifier
+
+
+# 同時に待つリクエストがCHANGES_MAX_STREAMSに達している間は、
+# ロングポーリングとServer-Sent Eventsを待たずに503で返す
+def test_waiting_requests_are_limited(make_app):
+    client = make_app(CHANGES_MAX_STREAMS=1).test_client()
+
+    stream = client.get("/v1/changes?since=0", headers={"Accept": "text/event-stream"})
+    assert stream.status_code == 200
+    assert change_notifier.streams == 1
+
+    response = client.get("/v1/changes?since=0&wait=1")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    response = client.get("/v1/changes?since=0", headers={"Accept": "text/event-stream"})
+    assert response.status_code == 503
+
+    # 待たないリクエストは制限しない
+    assert client.get("/v1/changes?since=0").status_code == 200
+
+    stream.close()
+    assert change_notifier.streams == 0
+    assert client.get("/v1/changes?since=0&wait=1").status_code == 200
+    assert change_notifier.streams == 0
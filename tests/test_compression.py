@@ -0,0 +1,111 @@
+import gzip
+import types
+
+import pytest
+
+import compression
+
+
+# COMPRESS_MIN_SIZE (1024バイト) 以上になる全商品の在庫一覧
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post("/v1/stocks/bulk", data="".join(
+        "{}{}{},{}\n".format(a, b, c, 10) for a in "abc" for b in "abcdefg" for c in "abcdefg"
+    ), content_type="text/csv")
+    return client
+
+
+# brotliがインストールされていなくても、選択の確認のために使える圧縮処理
+@pytest.fixture
+def fake_brotli(monkeypatch):
+    module = types.SimpleNamespace(compress=lambda data, quality: b"br:" + data)
+    monkeypatch.setattr(compression, "brotli", module)
+    return module
+
+
+def test_gzip(client):
+    plain = client.get("/v1/stocks")
+    assert len(plain.get_data()) >= 1024
+    assert "Content-Encoding" not in plain.headers
+    assert "Accept-Encoding" in plain.headers["Vary"]
+
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert len(response.get_data()) < len(plain.get_data())
+    assert response.headers["ETag"].startswith('W/"')
+
+
+# 両方を受け付ける場合はbrotliを優先し、q値が指定されている場合はq値に従う
+@pytest.mark.parametrize("accept, encoding", [
+    ("gzip, br", "br"),
+    ("br", "br"),
+    ("gzip;q=1.0, br;q=0.5", "gzip"),
+    ("gzip, br;q=0", "gzip"),
+    ("*", "br"),
+    ("identity", None),
+    ("deflate", None),
+])
+def test_negotiation(client, fake_brotli, accept, encoding):
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": accept})
+    assert response.headers.get("Content-Encoding") == encoding
+    if encoding == "br":
+        assert response.get_data().startswith(b"br:")
+
+
+# brotliがインストールされていない場合はbrを受け付けるリクエストにもgzipまたは無圧縮で返す
+def test_without_brotli(client, monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    assert client.get("/v1/stocks", headers={"Accept-Encoding": "br, gzip"}).headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in client.get("/v1/stocks", headers={"Accept-Encoding": "br"}).headers
+
+
+def test_brotli(client):
+    brotli = pytest.importorskip("brotli")
+    plain = client.get("/v1/stocks").get_data()
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(response.get_data()) == plain
+
+
+# COMPRESS_MIN_SIZE未満のレスポンスは圧縮しない
+def test_min_size(make_app):
+    client = make_app().test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.get_json() == {"aaa": 1}
+
+    client = make_app(COMPRESS_MIN_SIZE=5).test_client()
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == b'{"aaa":1}\n'
+
+
+# 圧縮したレスポンスのETagでも304を返す
+def test_not_modified_with_compressed_etag(client):
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"})
+    etag = response.headers["ETag"]
+    again = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+# ストリーミングのレスポンスとエラーのレスポンスは圧縮しない
+def test_streams_and_errors_are_not_compressed(client):
+    response = client.get("/v1/stocks?stream=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert len(response.get_json()) == 3 * 7 * 7
+
+    response = client.get("/v1/stocks?limit=x", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 400
+    assert "Content-Encoding" not in response.headers
+
+
+# COMPRESS_ENABLEDがFalseの場合は圧縮しない
+def test_disabled(make_app):
+    client = make_app(COMPRESS_ENABLED=False, COMPRESS_MIN_SIZE=1).test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    assert "Content-Encoding" not in client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"}).headers
@@ -0,0 +1,46 @@
+import change_feed
+import queries
+from models import db
+
+
+# 他のワーカーによる在庫の追加 (このプロセスのキャッシュは無効化されない)
+def add_stock_in_other_worker(app, name, amount):
+    with app.app_context():
+        queries.add_amount(name, amount)
+        change_feed.record_changes("stock", [(name, amount, 0)])
+        db.session.commit()
+        db.session.remove()
+
+
+# 他のワーカーで在庫が変わった場合は、このプロセスにキャッシュがあっても304を返さない
+def test_etag_changes_with_other_workers(make_app):
+    app = make_app(STOCK_CACHE_TTL=60)
+    client = app.test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+
+    first = client.get("/v1/stocks")
+    etag = first.headers["ETag"]
+    assert client.get("/v1/stocks", headers={"If-None-Match": etag}).status_code == 304
+
+    add_stock_in_other_worker(app, "bbb", 3)
+    response = client.get("/v1/stocks", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json() == {"aaa": 5, "bbb": 3}
+    assert response.headers["ETag"] != etag
+
+
+# 304のETagは圧縮した200のレスポンスのETag(弱いETag)と同じになる
+def test_not_modified_etag_matches_compressed_response(make_app):
+    client = make_app(COMPRESS_MIN_SIZE=1).test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+
+    response = client.get("/v1/stocks", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+
+    not_modified = client.get(
+        "/v1/stocks", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
@@ -0,0 +1,88 @@
+import threading
+
+from sqlalchemy import func, select
+
+from idempotency import idempotency_store
+from models import db, IdempotencyKey
+from sharding import shard_router
+
+
+def sell(client, key, data):
+    return client.post("/v1/sales", json=data, headers={"Idempotency-Key": key})
+
+
+# 同じキーの販売を同時に再送しても1回だけ処理し、他は1回目のレスポンスを返す
+def test_concurrent_retries_apply_once(app, client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    responses = []
+
+    def retry():
+        responses.append(sell(app.test_client(), "k1", {"name": "aaa", "amount": 2, "price": 3}))
+
+    threads = [threading.Thread(target=retry) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [200] * 8
+    assert len({response.get_data() for response in responses}) == 1
+    replayed = [response for response in responses if response.headers.get("Idempotent-Replayed")]
+    assert len(replayed) == 7
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 8}
+    assert client.get("/v1/sales").get_json() == {"sales": 6.0}
+
+
+# プロセス内のキャッシュにないキーは、DBに保存したレスポンスを返す (他のワーカーで処理した場合)
+def test_retry_is_replayed_from_db(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    first = sell(client, "k1", {"name": "aaa"})
+    idempotency_store.clear()
+
+    second = sell(client, "k1", {"name": "aaa"})
+    assert second.status_code == 200
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert second.headers["Location"] == first.headers["Location"]
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 9}
+
+
+# 同じキーで内容の異なるリクエストは400、失敗したリクエストは保存せずに再送時に処理し直す
+def test_mismatch_and_failed_requests(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    assert sell(client, "k1", {"name": "aaa"}).status_code == 200
+    assert sell(client, "k1", {"name": "aaa", "amount": 2}).status_code == 400
+
+    assert sell(client, "k2", {"name": "aaa"}).status_code == 400
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    response = sell(client, "k2", {"name": "aaa"})
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 0}
+
+
+# シャーディングしている場合もキーは元のDBに保存し、
+# 同じキーで別のシャードの商品を販売した場合は400にする
+def test_key_reused_across_shards(make_app):
+    app = make_app(DB_SHARDS=2)
+    client = app.test_client()
+    first, second = "aaa", next(
+        name for name in ("bbb", "ccc", "ddd", "eee")
+        if shard_router.index(name) != shard_router.index("aaa")
+    )
+    client.post("/v1/stocks", json={"name": first, "amount": 5})
+    client.post("/v1/stocks", json={"name": second, "amount": 5})
+
+    assert sell(client, "k1", {"name": first}).status_code == 200
+    assert sell(client, "k1", {"name": second}).status_code == 400
+    idempotency_store.clear()
+    assert sell(client, "k1", {"name": second}).status_code == 400
+    replayed = sell(client, "k1", {"name": first})
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+
+    assert client.get("/v1/stocks/" + first).get_json() == {first: 4}
+    assert client.get("/v1/stocks/" + second).get_json() == {second: 5}
+    with app.app_context():
+        assert db.session.scalars(select(IdempotencyKey.key)).all() == ["k1"]
+        for session in shard_router.sessions():
+            assert session.scalar(select(func.count()).select_from(IdempotencyKey)) == 0
+        db.session.remove()
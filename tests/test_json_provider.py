@@ -0,0 +1,79 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import json_provider
+
+pytest.importorskip("orjson")
+
+
+# 同じDBを使うFlask標準のJSONプロバイダとorjsonのアプリケーション
+@pytest.fixture
+def clients(make_app):
+    default = make_app(JSON_PROVIDER="default", STOCK_CACHE_TTL=0, COMPRESS_ENABLED=False)
+    orjson = make_app(JSON_PROVIDER="orjson", STOCK_CACHE_TTL=0, COMPRESS_ENABLED=False)
+    assert type(default.json) is not type(orjson.json)
+    return default.test_client(), orjson.test_client()
+
+
+# orjsonのレスポンスはFlask標準のJSONプロバイダと同じバイト列になる
+def test_orjson_responses_match_default(clients):
+    default, orjson = clients
+    for name, amount in (("bbb", 2), ("aaa", 5), ("ccc", 1)):
+        default.post("/v1/stocks", json={"name": name, "amount": amount})
+    default.post("/v1/sales", json={"name": "aaa", "amount": 2, "price": 0.1})
+    default.post("/v1/sales", json={"name": "bbb", "price": 3})
+
+    for path in (
+        "/v1/stocks",
+        "/v1/stocks/aaa",
+        "/v1/stocks?limit=2",
+        "/v1/stocks?stream=1",
+        "/v1/sales",
+        "/v1/sales?by=product",
+        "/v1/sales?bucket=day",
+        "/v1/changes?since=0",
+        "/v1/stocks/zzz",
+        "/v1/stocks?limit=x",
+    ):
+        expected = default.get(path)
+        response = orjson.get(path)
+        assert response.status_code == expected.status_code, path
+        assert response.get_data() == expected.get_data(), path
+        assert response.headers["Content-Type"] == expected.headers["Content-Type"], path
+
+    body = {"items": [{"name": "aaa", "amount": 1}, {"name": "ccc", "amount": 9}]}
+    assert orjson.post("/v1/sales/batch", json=body).get_data() ==\
+        default.post("/v1/sales/batch", json=body).get_data()
+
+
+# ASCII以外の文字はUTF-8のまま出力する (JSONとしては同じ値)
+def test_non_ascii_names(clients):
+    default, orjson = clients
+    default.post("/v1/stocks", json={"name": "äöü", "amount": 1})
+
+    expected = default.get("/v1/stocks")
+    response = orjson.get("/v1/stocks")
+    assert b"\\u00e4" in expected.get_data()
+    assert "äöü".encode("utf-8") in response.get_data()
+    assert response.get_json() == expected.get_json()
+
+
+# datetimeはFlask標準と同じHTTPの日付の形式にし、整形する場合は標準のjsonモジュールを使う
+# (dumps()は空白なしで出力するため、標準の空白なしの出力と比べる)
+def test_dumps_and_loads(clients):
+    default, orjson = (client.application.json for client in clients)
+    obj = {"b": 1, "a": [1.5, None, True], "time": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)}
+    assert orjson.dumps(obj) == default.dumps(obj, separators=(",", ":"))
+    assert orjson.dumps(obj, indent=2) == default.dumps(obj, indent=2)
+    text = default.dumps(obj)
+    assert orjson.loads(text) == default.loads(text)
+
+
+def test_unknown_or_missing_provider(make_app, monkeypatch):
+    with pytest.raises(ValueError):
+        make_app(JSON_PROVIDER="simplejson")
+    monkeypatch.setattr(json_provider, "orjson", None)
+    with pytest.raises(ValueError):
+        make_app(JSON_PROVIDER="orjson")
+    assert type(make_app().json) is json_provider.DefaultJSONProvider
@@ -0,0 +1,16 @@
+# 発注点を下回っている商品の一覧と、"low"という名前の商品の在庫チェックは別のURLで返す
+def test_low_stock_report_and_product_named_low(client):
+    client.post("/v1/stocks", json={"name": "low", "amount": 3})
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    assert client.put("/v1/stocks/low/threshold", json={"threshold": 5}).status_code == 200
+    assert client.put("/v1/stocks/aaa/threshold", json={"threshold": 5}).status_code == 200
+
+    assert client.get("/v1/stocks/low").get_json() == {"low": 3}
+    assert client.get("/v1/stocks?low=1").get_json() == {"low": {"amount": 3, "threshold": 5}}
+
+    client.post("/v1/sales", json={"name": "aaa", "amount": 6})
+    assert client.get("/v1/stocks?low=1").get_json() == {
+        "aaa": {"amount": 4, "threshold": 5},
+        "low": {"amount": 3, "threshold": 5},
+    }
+    assert client.get("/v1/stocks?low=yes").status_code == 400
@@ -0,0 +1,19 @@
+import re
+
+
+# エンドポイントのSQL文の実行数
+def statement_count(client, endpoint):
+    body = client.get("/metrics").get_data(as_text=True)
+    match = re.search(r'^db_statements_total\{{endpoint="{}"\}} (\d+)$'.format(re.escape(endpoint)),
+                      body, re.MULTILINE)
+    return int(match.group(1)) if match else 0
+
+
+# シャーディングしている場合もシャードのDBで実行したSQLを計測する
+def test_shard_statements_are_counted(make_app):
+    client = make_app(DB_SHARDS=2).test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    before = statement_count(client, "v1.retrieve_stock_v1")
+
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+    assert statement_count(client, "v1.retrieve_stock_v1") > before
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import page_index
+from page_index import PageIndex, StubEmbedder
+
+
+# ページの埋め込みを計算した回数を数え、検索文のベクトルを指定できる動作確認用の埋め込み
+class CountingEmbedder(StubEmbedder):
+
+    def __init__(self, query=None):
+        self.query = query
+        self.pages = 0
+
+    def embed_pages(self, images):
+        self.pages += len(images)
+        return super().embed_pages(images)
+
+    def embed_query(self, query):
+        if self.query is None:
+            return super().embed_query(query)
+        return np.asarray([self.query], dtype=np.float32)
+
+
+# 白、黒、左半分だけ白のページ画像を作成する
+@pytest.fixture
+def pages_dir(tmp_path):
+    directory = tmp_path / "pages"
+    directory.mkdir()
+    for name, color in (("white", 255), ("black", 0)):
+        Image.new("L", (64, 32), color).save(directory / (name + ".png"))
+    image = Image.new("L", (64, 32), 0)
+    image.paste(255, (0, 0, 32, 32))
+    image.save(directory / "left.png")
+    return directory
+
+
+# 内容が変わっていないファイルは、名前が変わっても埋め込みを計算し直さない
+def test_reindex_skips_unchanged_files(tmp_path, pages_dir):
+    embedder = CountingEmbedder()
+    index = PageIndex(tmp_path / "index", embedder, thumbnail_width=8, workers=0)
+    added, skipped = index.index([pages_dir])
+    assert sorted(added) == [0, 1, 2]
+    assert skipped == []
+    assert embedder.pages == 3
+
+    shutil.copyfile(pages_dir / "white.png", pages_dir / "renamed.png")
+    Image.new("L", (64, 32), 128).save(pages_dir / "black.png")
+    added, skipped = index.index([pages_dir])
+    assert added == [3]
+    assert len(skipped) == 3
+    assert embedder.pages == 4
+
+    digest = page_index.content_hash(pages_dir / "left.png")
+    with Image.open(index.thumbnail_path(digest, 1)) as thumbnail:
+        assert thumbnail.size == (8, 4)
+
+
+# 索引の一覧は一時ファイルから置き換えて保存し、別のインスタンスで読み込み直せる
+def test_manifest_is_replaced_atomically_and_reloads(tmp_path, pages_dir, monkeypatch):
+    root = tmp_path / "index"
+    index = PageIndex(root, CountingEmbedder(), workers=0)
+    index.index([pages_dir / "white.png"])
+    manifest_path = root / "manifest.json"
+    saved = manifest_path.read_text(encoding="utf-8")
+    assert not (root / "manifest.json.partial").exists()
+
+    # 書き込みの途中で失敗しても、保存済みの一覧は壊れない
+    def broken_dump(obj, f, **kwargs):
+        f.write('{"documents": ')
+        raise OSError("disk full")
+
+    monkeypatch.setattr(page_index.json, "dump", broken_dump)
+    with pytest.raises(OSError):
+        index.index([pages_dir / "black.png"])
+    monkeypatch.undo()
+    assert manifest_path.read_text(encoding="utf-8") == saved
+
+    embedder = CountingEmbedder()
+    reloaded = PageIndex(root, embedder, workers=0)
+    assert reloaded.documents == json.loads(saved)["documents"]
+    assert reloaded.index([pages_dir / "white.png"]) == ([], [0])
+    assert embedder.pages == 0
+    assert len(reloaded.search("white", k=5)) == 1
+
+    class OtherEmbedder(StubEmbedder):
+        name = "other"
+
+    with pytest.raises(ValueError):
+        PageIndex(root, OtherEmbedder(), workers=0)
+
+
+# MaxSimのスコアが最も高いページを先頭に返す
+def test_search_ranks_best_page_first(tmp_path, pages_dir):
+    # 左半分が正、右半分が負のベクトル (左半分だけ白のページと最も近い)
+    query = [1.0] * 8 + [-1.0] * 8
+    index = PageIndex(tmp_path / "index", CountingEmbedder(query), workers=0)
+    index.index([pages_dir])
+
+    results = index.search("left", k=3)
+    assert os.path.basename(results[0].path) == "left.png"
+    assert results[0].score > results[1].score
+    assert results[0].page_num == 1
+    assert index.thumbnail_base64(results[0])
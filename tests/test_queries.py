@@ -0,0 +1,59 @@
+import pytest
+
+import queries
+from models import db
+
+
+@pytest.fixture
+def session(app):
+    with app.app_context():
+        queries.add_amount("aaa", 3)
+        db.session.commit()
+        yield db.session
+        db.session.remove()
+
+
+# 在庫数が販売数に足りない場合はFalseを返し、在庫数は変わらない
+def test_decrement_with_insufficient_stock(session):
+    assert queries.decrement_amount("aaa", 4) is False
+    assert queries.get_amount("aaa") == 3
+    session.commit()
+    assert queries.get_amount("aaa") == 3
+
+
+# 在庫数と同じ数までは減らせる
+def test_decrement(session):
+    assert queries.decrement_amount("aaa", 2) is True
+    assert queries.decrement_amount("aaa", 1) is True
+    assert queries.decrement_amount("aaa", 1) is False
+    session.commit()
+    assert queries.get_amount("aaa") == 0
+
+
+# 商品がない場合はFalseを返し、行を作成しない
+def test_decrement_missing_product(session):
+    assert queries.decrement_amount("bbb", 1) is False
+    assert queries.get_amount("bbb") is None
+
+
+# コミットとロールバックはセッションで行う
+def test_rollback(session):
+    assert queries.decrement_amount("aaa", 3) is True
+    queries.add_amount("bbb", 1)
+    queries.add_total(150)
+    session.rollback()
+    assert queries.get_amount("aaa") == 3
+    assert queries.get_amount("bbb") is None
+    assert queries.get_total() == 0
+
+
+# 在庫の追加と売上の加算は、行がない場合は作成し、ある場合は加算する
+def test_upserts(session):
+    queries.add_amount("aaa", 2)
+    queries.add_amount("bbb", 5)
+    queries.add_total(150)
+    queries.add_total(25)
+    session.commit()
+    assert queries.get_amount("aaa") == 5
+    assert queries.get_amount("bbb") == 5
+    assert queries.get_total() == 175
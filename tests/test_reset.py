@@ -0,0 +1,126 @@
+import json
+
+import pytest
+from sqlalchemy import func, select
+
+from models import db, SalesLedger, SalesRollup
+
+
+@pytest.fixture
+def client(make_app, tmp_path):
+    app = make_app(SNAPSHOT_API_ENABLED=True, SNAPSHOT_DIR=str(tmp_path / "snapshots"))
+    return app.test_client()
+
+
+def count(app, model):
+    with app.app_context():
+        n = db.session.scalar(select(func.count()).select_from(model))
+        db.session.remove()
+        return n
+
+
+# flaskコマンドと同じくアプリケーションコンテキストの中でCLIコマンドを実行する
+def invoke(app, *args):
+    with app.app_context():
+        return app.test_cli_runner().invoke(args=list(args))
+
+
+# 全削除は在庫と売上、販売の履歴と集計を削除し、発注点の設定は残す
+# 在庫数が0になるため、発注点を設定した商品は全て発注点を下回っている状態になる
+def test_reset_keeps_thresholds(client):
+    app = client.application
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    client.post("/v1/stocks", json={"name": "bbb", "amount": 10})
+    client.put("/v1/stocks/aaa/threshold", json={"threshold": 3})
+    client.post("/v1/sales", json={"name": "bbb", "amount": 2, "price": 5})
+
+    assert client.delete("/v1/stocks").status_code == 200
+    assert client.get("/v1/stocks").get_json() == {}
+    assert client.get("/v1/sales").get_json() == {"sales": 0}
+    assert count(app, SalesLedger) == 0
+    assert count(app, SalesRollup) == 0
+    assert client.get("/v1/stocks?low=1").get_json() == {"aaa": {"amount": 0, "threshold": 3}}
+
+    # 在庫を追加すると発注点以上に戻る
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 3})
+    assert client.get("/v1/stocks?low=1").get_json() == {}
+
+
+# 全削除は変更履歴に記録する
+def test_reset_is_recorded_in_changes(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 1})
+    since = client.get("/v1/changes").get_json()["next"]
+    client.delete("/v1/stocks")
+
+    changes = client.get("/v1/changes?since={}".format(since)).get_json()["changes"]
+    assert [change["type"] for change in changes] == ["reset"]
+
+
+# flask reset-stocks でも発注点の設定は残す
+def test_reset_command(client):
+    app = client.application
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    client.put("/v1/stocks/aaa/threshold", json={"threshold": 3})
+
+    result = invoke(app, "reset-stocks")
+    assert result.exit_code == 0
+    assert client.get("/v1/stocks").get_json() == {}
+    assert client.get("/v1/stocks?low=1").get_json() == {"aaa": {"amount": 0, "threshold": 3}}
+
+
+# スナップショットに戻すと、保存した時点の在庫と売上に戻る
+# 変更履歴のseqは戻す前より大きくなり、全削除として記録する
+def test_snapshot_and_restore(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    client.post("/v1/sales", json={"name": "aaa", "amount": 2, "price": 3})
+    response = client.post("/v1/snapshots/fixture")
+    assert response.status_code == 201
+    assert response.get_json()["name"] == "fixture"
+
+    client.post("/v1/sales", json={"name": "aaa", "amount": 5, "price": 3})
+    client.post("/v1/stocks", json={"name": "bbb", "amount": 1})
+    since = client.get("/v1/changes").get_json()["next"]
+
+    assert client.post("/v1/snapshots/fixture/restore").get_json() == {"name": "fixture"}
+    assert client.get("/v1/stocks").get_json() == {"aaa": 8}
+    assert client.get("/v1/sales").get_json() == {"sales": 6.0}
+
+    changes = client.get("/v1/changes?since={}".format(since)).get_json()["changes"]
+    assert [change["type"] for change in changes] == ["reset"]
+    assert changes[0]["seq"] > since
+
+    # 全削除した後も戻せる
+    client.delete("/v1/stocks")
+    client.post("/v1/snapshots/fixture/restore")
+    assert client.get("/v1/stocks").get_json() == {"aaa": 8}
+
+
+# スナップショットの名前が不正な場合は400、存在しない場合は404
+def test_snapshot_errors(client):
+    assert client.post("/v1/snapshots/a.b").status_code == 400
+    assert client.post("/v1/snapshots/a.b/restore").status_code == 400
+    assert client.post("/v1/snapshots/nope/restore").status_code == 404
+
+
+# SNAPSHOT_API_ENABLEDがFalseの場合はAPIでは保存も復元もできない (404)
+def test_snapshot_api_disabled(make_app):
+    client = make_app().test_client()
+    assert client.post("/v1/snapshots/fixture").status_code == 404
+    assert client.post("/v1/snapshots/fixture/restore").status_code == 404
+
+
+# flask snapshot-stocks / restore-stocks
+def test_snapshot_commands(client):
+    app = client.application
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 4})
+
+    result = invoke(app, "snapshot-stocks", "fixture")
+    assert result.exit_code == 0
+    assert json.loads(result.output)["name"] == "fixture"
+
+    client.delete("/v1/stocks")
+    result = invoke(app, "restore-stocks", "fixture")
+    assert result.exit_code == 0
+    assert client.get("/v1/stocks").get_json() == {"aaa": 4}
+
+    assert invoke(app, "restore-stocks", "nope").exit_code != 0
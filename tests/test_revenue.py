@@ -0,0 +1,43 @@
+import pytest
+
+from models import db, Sales
+from sale_engine import revenue_cents
+
+
+# 整数の価格は整数の計算だけで、小数の価格は10進数で正確に計算する
+@pytest.mark.parametrize("price, amount, cents", [
+    (None, 3, 0),
+    (2, 3, 600),
+    (0.1, 3, 30),
+    (0.1, 1000000, 10000000),
+    (19.99, 7, 13993),
+    (1.1, 1, 110),
+])
+def test_revenue_cents(price, amount, cents):
+    assert revenue_cents(price, amount) == cents
+
+
+# 1セント未満は四捨五入する (偶数への丸めではない)
+@pytest.mark.parametrize("price, amount, cents", [
+    (0.005, 1, 1),
+    (0.015, 1, 2),
+    (0.025, 1, 3),
+    (0.125, 1, 13),
+    (1.005, 1, 101),
+    (0.004, 1, 0),
+    (0.0149, 1, 1),
+])
+def test_revenue_cents_rounds_half_up(price, amount, cents):
+    assert revenue_cents(price, amount) == cents
+
+
+# 小数の価格の販売を繰り返しても売上の合計に誤差が累積しない
+def test_sales_total_does_not_drift(app, client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 30})
+    for _ in range(10):
+        assert client.post("/v1/sales", json={"name": "aaa", "amount": 3, "price": 0.1}).status_code == 200
+
+    assert client.get("/v1/sales").get_json() == {"sales": 3.0}
+    with app.app_context():
+        assert db.session.get(Sales, "sales").cents == 300
+        db.session.remove()
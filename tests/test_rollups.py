@@ -0,0 +1,94 @@
+import pytest
+
+import sale_engine
+from models import db
+
+# 2023-11-14T22:13:20+00:00
+T = 1700000000
+
+
+# 販売日時を指定して販売の履歴と集計を追加する
+@pytest.fixture
+def client(app):
+    sales = [
+        (T, "aaa", 1, 100),
+        (T + 30, "bbb", 2, 300),
+        (T + 60, "aaa", 1, 100),
+        (T + 3600, "aaa", 2, 200),
+        (T + 86400, "bbb", 1, 150),
+    ]
+    with app.app_context():
+        for sold_at, name, amount, cents in sales:
+            sale_engine.record_sales([(name, amount, cents / amount / 100, cents)], sold_at=sold_at)
+        db.session.commit()
+        db.session.remove()
+    return app.test_client()
+
+
+def buckets(client, query):
+    response = client.get("/v1/sales?" + query)
+    assert response.status_code == 200
+    return [(bucket["start"], bucket["amount"], bucket["sales"]) for bucket in response.get_json()["sales"]]
+
+
+# 分、時、日の集計期間ごとに、期間の開始日時の古い順に返す
+def test_rollup_buckets(client):
+    assert buckets(client, "bucket=minute") == [
+        ("2023-11-14T22:13:00+00:00", 3, 4.0),
+        ("2023-11-14T22:14:00+00:00", 1, 1.0),
+        ("2023-11-14T23:13:00+00:00", 2, 2.0),
+        ("2023-11-15T22:13:00+00:00", 1, 1.5),
+    ]
+    assert buckets(client, "bucket=hour") == [
+        ("2023-11-14T22:00:00+00:00", 4, 5.0),
+        ("2023-11-14T23:00:00+00:00", 2, 2.0),
+        ("2023-11-15T22:00:00+00:00", 1, 1.5),
+    ]
+    assert buckets(client, "bucket=day") == [
+        ("2023-11-14T00:00:00+00:00", 6, 7.0),
+        ("2023-11-15T00:00:00+00:00", 1, 1.5),
+    ]
+
+
+# nameを指定した場合はその商品の集計だけを返す
+def test_rollup_by_name(client):
+    response = client.get("/v1/sales?bucket=day&name=aaa")
+    assert response.get_json()["name"] == "aaa"
+    assert buckets(client, "bucket=day&name=aaa") == [("2023-11-14T00:00:00+00:00", 4, 4.0)]
+    assert buckets(client, "bucket=day&name=ccc") == []
+
+
+# limitは新しい方からの件数、from/toは集計期間の開始日時の範囲 (toは含まない)
+def test_rollup_limit_and_range(client):
+    assert buckets(client, "bucket=minute&limit=2") == [
+        ("2023-11-14T23:13:00+00:00", 2, 2.0),
+        ("2023-11-15T22:13:00+00:00", 1, 1.5),
+    ]
+    assert buckets(client, "bucket=hour&from=2023-11-14T23:00:00&to=2023-11-15T00:00:00") == [
+        ("2023-11-14T23:00:00+00:00", 2, 2.0),
+    ]
+    # タイムゾーンを指定した場合はUTCに変換する
+    assert buckets(client, "bucket=hour&from=2023-11-15T08:00:00%2B09:00&to=2023-11-15T09:00:00%2B09:00") == [
+        ("2023-11-14T23:00:00+00:00", 2, 2.0),
+    ]
+
+
+# 商品ごとの集計は全期間の合計を返す
+def test_product_sales(client):
+    assert client.get("/v1/sales?by=product").get_json() == {
+        "aaa": {"amount": 4, "sales": 4.0},
+        "bbb": {"amount": 3, "sales": 4.5},
+    }
+    assert client.get("/v1/sales?by=product&name=bbb").get_json() == {"bbb": {"amount": 3, "sales": 4.5}}
+
+
+@pytest.mark.parametrize("query", [
+    "bucket=week",
+    "bucket=minute&limit=0",
+    "bucket=minute&limit=x",
+    "bucket=minute&from=yesterday",
+    "bucket=minute&name=a1",
+    "by=name",
+])
+def test_invalid_rollup_arguments(client, query):
+    assert client.get("/v1/sales?" + query).status_code == 400
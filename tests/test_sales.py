@@ -0,0 +1,133 @@
+import threading
+
+from sqlalchemy import func, select, update
+
+import queries
+import sale_engine
+from models import db, Stock, Sales, SalesLedger
+
+
+# 複数のスレッドから同時に販売しても、在庫の数を超えて販売しない
+# 売上と販売の履歴は販売できた分だけ増える
+def test_concurrent_sales_do_not_oversell(app, client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 50})
+    statuses = []
+
+    def buyer():
+        test_client = app.test_client()
+        for _ in range(20):
+            response = test_client.post("/v1/sales", json={"name": "aaa", "price": 2})
+            statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=buyer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses.count(200) == 50
+    assert statuses.count(400) == 110
+    with app.app_context():
+        assert db.session.scalar(select(Stock.amount).where(Stock.name == "aaa")) == 0
+        assert db.session.get(Sales, "sales").cents == 50 * 200
+        assert db.session.scalar(select(func.sum(SalesLedger.amount))) == 50
+        db.session.remove()
+
+
+# 在庫が不足している販売は在庫も売上も変えない
+def test_sale_exceeding_stock_changes_nothing(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 3})
+
+    assert client.post("/v1/sales", json={"name": "aaa", "amount": 4, "price": 1}).status_code == 400
+    assert client.post("/v1/sales", json={"name": "bbb", "price": 1}).status_code == 400
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 3}
+    assert client.get("/v1/sales").get_json() == {"sales": 0.0}
+
+
+def sell_batch(client, *items):
+    response = client.post("/v1/sales/batch", json={"items": list(items)})
+    assert response.status_code == 200
+    return [item["result"] for item in response.get_json()["items"]]
+
+
+# まとめて販売は在庫の範囲で明細を先頭から順に割り当て、足りない明細だけERRORにする
+def test_batch_partial_fulfilment(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    client.post("/v1/stocks", json={"name": "bbb", "amount": 1})
+
+    assert sell_batch(
+        client,
+        {"name": "aaa", "amount": 3},
+        {"name": "aaa", "amount": 3},
+        {"name": "bbb", "amount": 1},
+        {"name": "aaa", "amount": 2},
+        {"name": "ccc", "amount": 1},
+        {"name": "bbb", "amount": 1},
+    ) == ["OK", "ERROR", "OK", "OK", "ERROR", "ERROR"]
+    assert client.get("/v1/stocks").get_json() == {"aaa": 0, "bbb": 0}
+
+
+# 在庫の取得後に他のリクエストで在庫が減っていた場合は、その商品の明細を1件ずつ減算し直す
+def test_batch_falls_back_when_stock_changed(app, monkeypatch):
+    with app.app_context():
+        db.session.add(Stock(name="aaa", amount=5))
+        db.session.add(Stock(name="bbb", amount=2))
+        db.session.commit()
+
+        decrement_amount = queries.decrement_amount
+        calls = []
+
+        # 最初の減算の前に、別のリクエストの販売で"aaa"の在庫を2つ減らす
+        def concurrent_sale(name, amount, session=None):
+            if not calls:
+                db.session.execute(
+                    update(Stock).where(Stock.name == "aaa").values(amount=Stock.amount - 2)
+                )
+            calls.append((name, amount))
+            return decrement_amount(name, amount, session)
+
+        monkeypatch.setattr(queries, "decrement_amount", concurrent_sale)
+        results = sale_engine.sell_batch(
+            [("aaa", 2, 1), ("aaa", 2, 1), ("bbb", 2, 1), ("aaa", 1, 1)]
+        )
+
+        assert results == [True, False, True, True]
+        assert calls == [("aaa", 5), ("aaa", 2), ("aaa", 2), ("aaa", 1), ("bbb", 2)]
+        assert db.session.scalar(select(Stock.amount).where(Stock.name == "aaa")) == 0
+        assert db.session.scalar(select(Stock.amount).where(Stock.name == "bbb")) == 0
+        assert db.session.scalar(select(func.sum(SalesLedger.amount))) == 5
+        assert db.session.get(Sales, "sales").cents == 500
+        db.session.remove()
+
+
+# まとめて販売した明細は、売上の合計、販売の履歴、商品ごとと時間単位ごとの集計に反映する
+def test_batch_updates_ledger_and_rollups(app, client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+    client.post("/v1/stocks", json={"name": "bbb", "amount": 10})
+
+    assert sell_batch(
+        client,
+        {"name": "aaa", "amount": 2, "price": 1.5},
+        {"name": "bbb", "amount": 3, "price": 2},
+        {"name": "aaa", "amount": 1},
+        {"name": "bbb", "amount": 20, "price": 2},
+    ) == ["OK", "OK", "OK", "ERROR"]
+
+    assert client.get("/v1/sales").get_json() == {"sales": 9.0}
+    assert client.get("/v1/sales?by=product").get_json() == {
+        "aaa": {"amount": 3, "sales": 3.0},
+        "bbb": {"amount": 3, "sales": 6.0},
+    }
+    for granularity in ("minute", "hour", "day"):
+        buckets = client.get("/v1/sales?bucket=" + granularity).get_json()["sales"]
+        assert sum(bucket["amount"] for bucket in buckets) == 6
+        assert sum(bucket["sales"] for bucket in buckets) == 9.0
+    buckets = client.get("/v1/sales?bucket=day&name=aaa").get_json()["sales"]
+    assert [(bucket["amount"], bucket["sales"]) for bucket in buckets] == [(3, 3.0)]
+
+    with app.app_context():
+        ledger = db.session.execute(
+            select(SalesLedger.name, SalesLedger.amount, SalesLedger.cents).order_by(SalesLedger.id)
+        ).all()
+        assert [tuple(row) for row in ledger] == [("aaa", 2, 300), ("bbb", 3, 600), ("aaa", 1, 0)]
+        db.session.remove()
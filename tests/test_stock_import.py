@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+
+def import_csv(client, data):
+    response = client.post("/v1/stocks/bulk", data=data, content_type="text/csv")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+# CSVの1行目の"name,amount"はヘッダーとして読み飛ばし、amountを省略した行は1とする
+def test_import_csv(client):
+    assert import_csv(client, "name,amount\naaa,3\nbbb,5\nccc\n") == {"imported": 3, "rejected": 0}
+    assert client.get("/v1/stocks").get_json() == {"aaa": 3, "bbb": 5, "ccc": 1}
+
+
+# 値チェックでERRORとなる行は登録せずに件数だけ数え、他の行は登録する
+def test_import_csv_rejects_bad_rows(client):
+    data = "\n".join([
+        "aaa,2",
+        "aaa1,2",
+        "bbb,0",
+        "bbb,-1",
+        "bbb,1.5",
+        "bbb,x",
+        "abcdefghi,1",
+        "ccc,1,2",
+        ",1",
+        "",
+        "ddd,4",
+    ])
+    assert import_csv(client, data) == {"imported": 2, "rejected": 8}
+    assert client.get("/v1/stocks").get_json() == {"aaa": 2, "ddd": 4}
+
+
+# 既に存在する商品はamountを加算し、同じ商品が複数行ある場合は合計する
+# (チャンクをまたいでも同じ結果になる)
+@pytest.mark.parametrize("chunk_size", [2, 5000])
+def test_import_upserts_existing_products(make_app, chunk_size):
+    client = make_app(STOCK_IMPORT_CHUNK_SIZE=chunk_size).test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 10})
+
+    assert import_csv(client, "aaa,1\nbbb,2\naaa,3\nbbb,4\nccc,5\n") == {"imported": 5, "rejected": 0}
+    assert client.get("/v1/stocks").get_json() == {"aaa": 14, "bbb": 6, "ccc": 5}
+
+
+# CSV以外のContent-TypeはNDJSONとして読み込む
+def test_import_ndjson(client):
+    data = "\n".join([
+        json.dumps({"name": "aaa", "amount": 2}),
+        json.dumps({"name": "bbb"}),
+        "",
+        "{",
+        json.dumps(["ccc", 1]),
+        json.dumps({"name": "ccc", "amount": True}),
+    ])
+    response = client.post("/v1/stocks/bulk", data=data, content_type="application/x-ndjson")
+    assert response.get_json() == {"imported": 2, "rejected": 3}
+    assert client.get("/v1/stocks").get_json() == {"aaa": 2, "bbb": 1}
+
+
+# 一括登録した在庫は変更履歴にも記録する
+def test_import_records_changes(client):
+    since = client.get("/v1/changes").get_json()["next"]
+    import_csv(client, "aaa,2\nbbb,3\n")
+
+    changes = client.get("/v1/changes?since={}".format(since)).get_json()["changes"]
+    assert sorted((change["name"], change["amount"]) for change in changes) == [("aaa", 2), ("bbb", 3)]
+
+
+# flask import-stocks FILE (形式は拡張子から判定する)
+def test_import_command(app, tmp_path):
+    path = tmp_path / "stocks.csv"
+    path.write_text("name,amount\naaa,3\nbad1,1\n")
+
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=["import-stocks", str(path)])
+    assert result.exit_code == 0
+    assert json.loads(result.output) == {"imported": 1, "rejected": 1}
+    assert app.test_client().get("/v1/stocks/aaa").get_json() == {"aaa": 3}
@@ -0,0 +1,92 @@
+import pytest
+
+
+# HEADリクエストはGETと同じヘッダーをボディなしで返す
+def test_head_requests(client):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+
+    for path in ("/v1/stocks", "/v1/stocks/aaa"):
+        get = client.get(path)
+        head = client.head(path)
+        assert head.status_code == 200
+        assert head.get_data() == b""
+        assert head.headers["Content-Type"] == get.headers["Content-Type"]
+
+
+NAMES = ["aaa", "bbb", "ccc", "ddd", "eee"]
+
+
+def add_stocks(client):
+    for i, name in enumerate(NAMES):
+        client.post("/v1/stocks", json={"name": name, "amount": i + 1})
+
+
+# limitを指定した場合はnameの昇順にlimit件ずつ返し、続きがある場合は
+# 次のafterの値をX-Next-CursorヘッダーとLinkヘッダーで返す
+@pytest.mark.parametrize("shards", [0, 2])
+def test_cursor_pagination(make_app, shards):
+    client = make_app(DB_SHARDS=shards).test_client()
+    add_stocks(client)
+
+    response = client.get("/v1/stocks?limit=2")
+    assert response.get_json() == {"aaa": 1, "bbb": 2}
+    assert response.headers["X-Next-Cursor"] == "bbb"
+    assert response.headers["Link"] == '<http://localhost/v1/stocks?limit=2&after=bbb>; rel="next"'
+
+    response = client.get("/v1/stocks?limit=2&after=bbb")
+    assert response.get_json() == {"ccc": 3, "ddd": 4}
+    assert response.headers["X-Next-Cursor"] == "ddd"
+
+    # 最後のページには続きのヘッダーを付けない
+    response = client.get("/v1/stocks?limit=2&after=ddd")
+    assert response.get_json() == {"eee": 5}
+    assert "X-Next-Cursor" not in response.headers
+    assert "Link" not in response.headers
+
+    # 件数がちょうどlimitの場合も続きはない
+    response = client.get("/v1/stocks?limit=5")
+    assert len(response.get_json()) == 5
+    assert "X-Next-Cursor" not in response.headers
+
+
+# limitを省略した場合はSTOCKS_PAGE_MAX_LIMIT件までを返す
+def test_after_without_limit(make_app):
+    client = make_app(STOCKS_PAGE_MAX_LIMIT=2).test_client()
+    add_stocks(client)
+
+    response = client.get("/v1/stocks?after=aaa")
+    assert response.get_json() == {"bbb": 2, "ccc": 3}
+    assert response.headers["X-Next-Cursor"] == "ccc"
+    assert client.get("/v1/stocks?limit=3").status_code == 400
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=-1", "limit=x", "after=a1", "after=abcdefghi"])
+def test_invalid_page_arguments(client, query):
+    assert client.get("/v1/stocks?" + query).status_code == 400
+
+
+# stream=1は全件を少しずつ読み込みながら返し、limitなしと同じ内容になる
+@pytest.mark.parametrize("shards", [0, 2])
+def test_stream(make_app, shards):
+    client = make_app(DB_SHARDS=shards, STOCKS_STREAM_BATCH_SIZE=2).test_client()
+    add_stocks(client)
+
+    response = client.get("/v1/stocks?stream=1")
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == "application/json"
+    assert response.get_json() == client.get("/v1/stocks").get_json()
+
+    assert client.get("/v1/stocks?stream=1&after=ccc").get_json() == {"ddd": 4, "eee": 5}
+
+
+# 在庫がない場合も空のJSONを返す
+def test_stream_empty(client):
+    assert client.get("/v1/stocks?stream=1").get_json() == {}
+
+
+# stream=1とlimitは一緒に指定できない
+def test_stream_with_limit_is_rejected(client):
+    add_stocks(client)
+    assert client.get("/v1/stocks?stream=1&limit=2").status_code == 400
+    assert client.get("/v1/stocks?stream=1&limit=2&after=aaa").status_code == 400
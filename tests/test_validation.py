@@ -0,0 +1,109 @@
+import pytest
+
+
+ERROR = {"message": "ERROR"}
+
+
+# Content-TypeがJSONでないリクエストは、ボディがJSONでも400を返す
+@pytest.mark.parametrize("path", ["/v1/stocks", "/v1/sales", "/v1/sales/batch"])
+@pytest.mark.parametrize("content_type", [None, "text/plain", "application/x-www-form-urlencoded"])
+def test_non_json_content_type_is_rejected(client, path, content_type):
+    headers = {"Content-Type": content_type} if content_type else {}
+    response = client.post(path, data='{"name": "aaa", "amount": 1}', headers=headers)
+    assert response.status_code == 400
+    assert response.get_json() == ERROR
+
+
+# application/*+json もJSONとして受け付ける
+def test_json_suffix_content_type_is_accepted(client):
+    response = client.post("/v1/stocks", data='{"name": "aaa", "amount": 1}',
+                           content_type="application/merge-patch+json")
+    assert response.status_code == 200
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 1}
+
+
+# JSONとして解釈できないボディ、nullのボディ
+@pytest.mark.parametrize("data", ["", "{", "null", "[1, 2"])
+def test_malformed_json_is_rejected(client, data):
+    response = client.post("/v1/stocks", data=data, content_type="application/json")
+    assert response.status_code == 400
+    assert response.get_json() == ERROR
+
+
+# 在庫の追加の値チェック
+@pytest.mark.parametrize("body", [
+    [],
+    "aaa",
+    {},
+    {"amount": 1},
+    {"name": None},
+    {"name": ""},
+    {"name": "abcdefghi"},
+    {"name": "ab1"},
+    {"name": 1},
+    {"name": "aaa", "amount": 0},
+    {"name": "aaa", "amount": -1},
+    {"name": "aaa", "amount": 1.5},
+    {"name": "aaa", "amount": "1"},
+    {"name": "aaa", "amount": True},
+])
+def test_invalid_stock_is_rejected(client, body):
+    response = client.post("/v1/stocks", json=body)
+    assert response.status_code == 400
+    assert response.get_json() == ERROR
+    assert client.get("/v1/stocks").get_json() == {}
+
+
+# amountを省略した場合、nullの場合は1とする
+@pytest.mark.parametrize("body", [{"name": "aaa"}, {"name": "aaa", "amount": None}])
+def test_stock_amount_defaults_to_one(client, body):
+    assert client.post("/v1/stocks", json=body).status_code == 200
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 1}
+
+
+# 販売の値チェック
+@pytest.mark.parametrize("body", [
+    {"amount": 1},
+    {"name": "aaa", "amount": 0},
+    {"name": "aaa", "price": 0},
+    {"name": "aaa", "price": -1},
+    {"name": "aaa", "price": "1"},
+    {"name": "aaa", "price": False},
+])
+def test_invalid_sale_is_rejected(client, body):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    response = client.post("/v1/sales", json=body)
+    assert response.status_code == 400
+    assert response.get_json() == ERROR
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+
+
+# まとめて販売の明細のチェック (1件でも不正な明細がある場合は全体を400にする)
+@pytest.mark.parametrize("body", [
+    {},
+    {"items": {}},
+    {"items": []},
+    {"items": [{"name": "aaa"}, {"name": "aaa", "amount": 0}]},
+])
+def test_invalid_batch_is_rejected(client, body):
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    response = client.post("/v1/sales/batch", json=body)
+    assert response.status_code == 400
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 5}
+
+
+# 明細数がSALES_BATCH_MAX_ITEMSを超える場合は400
+def test_batch_over_max_items_is_rejected(make_app):
+    client = make_app(SALES_BATCH_MAX_ITEMS=2).test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    response = client.post("/v1/sales/batch", json={"items": [{"name": "aaa"}] * 3})
+    assert response.status_code == 400
+    assert client.post("/v1/sales/batch", json={"items": [{"name": "aaa"}] * 2}).status_code == 200
+
+
+# 発注点の値チェック
+@pytest.mark.parametrize("body", [{}, {"threshold": 0}, {"threshold": "3"}])
+def test_invalid_threshold_is_rejected(client, body):
+    response = client.put("/v1/stocks/aaa/threshold", json=body)
+    assert response.status_code == 400
+    assert response.get_json() == ERROR
@@ -0,0 +1,180 @@
+import threading
+import time
+
+from sqlalchemy import func, select, update
+
+from models import db, Stock, Sales, SalesLedger, WriteBehindCheckpoint, WriteBehindReject
+from write_behind import sale_coalescer
+
+
+# _flush_lockを置き換えるロック
+# arm()した後に最初に解放したとき、解放した直後(次の処理の前)に反映を1回実行する
+class FlushOnReleaseLock:
+
+    def __init__(self, coalescer):
+        self._lock = threading.Lock()
+        self._coalescer = coalescer
+        self._armed = False
+
+    def arm(self):
+        self._armed = True
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        if self._armed:
+            self._armed = False
+            self._coalescer.flush()
+
+
+def stock_amount(app, name):
+    with app.app_context():
+        amount = db.session.scalar(select(Stock.amount).where(Stock.name == name))
+        db.session.remove()
+        return amount
+
+def add_stock(app, name, amount):
+    with app.app_context():
+        db.session.add(Stock(name=name, amount=amount))
+        db.session.commit()
+        db.session.remove()
+
+
+# 販売可能数を読み込んだ直後に反映が割り込んでも、反映した販売を二重に数えない
+def test_load_with_concurrent_flush_does_not_oversell(make_app, monkeypatch):
+    app = make_app(SALE_WRITE_BEHIND=True, SALE_FLUSH_INTERVAL=3600)
+    add_stock(app, "aaa", 10)
+    lock = FlushOnReleaseLock(sale_coalescer)
+    monkeypatch.setattr(sale_coalescer, "_flush_lock", lock)
+
+    assert sale_coalescer.submit([("aaa", 3, None)]) == [True]
+    sale_coalescer.forget("aaa")
+    lock.arm()
+    assert sale_coalescer.submit([("aaa", 10, None)]) == [False]
+    assert sale_coalescer.submit([("aaa", 7, None)]) == [True]
+    sale_coalescer.flush()
+
+    assert stock_amount(app, "aaa") == 0
+    assert sale_coalescer.rejected == 0
+
+
+# 複数のスレッドで販売しながら反映とforget()を繰り返しても、在庫の数だけ販売できる
+def test_forget_during_flush_does_not_oversell(make_app):
+    app = make_app(SALE_WRITE_BEHIND=True, SALE_FLUSH_INTERVAL=0.001)
+    add_stock(app, "aaa", 300)
+    rejected = sale_coalescer.rejected
+
+    sold = []
+    done = threading.Event()
+
+    def buyer():
+        for _ in range(100):
+            if sale_coalescer.submit([("aaa", 1, 1)])[0]:
+                sold.append(1)
+
+    def forgetter():
+        while not done.is_set():
+            sale_coalescer.forget("aaa")
+            time.sleep(0.001)
+
+    buyers = [threading.Thread(target=buyer) for _ in range(8)]
+    thread = threading.Thread(target=forgetter)
+    thread.start()
+    for buyer_thread in buyers:
+        buyer_thread.start()
+    for buyer_thread in buyers:
+        buyer_thread.join()
+    done.set()
+    thread.join()
+    sale_coalescer.flush()
+
+    assert len(sold) == 300
+    assert stock_amount(app, "aaa") == 0
+    assert sale_coalescer.rejected == rejected
+    with app.app_context():
+        assert db.session.scalar(select(func.sum(SalesLedger.amount))) == 300
+        db.session.remove()
+
+
+# DBの在庫が他のプロセスで減らされていた場合、反映できない販売は売上と履歴に含めない
+def test_flush_drops_sales_rejected_by_db(make_app):
+    app = make_app(SALE_WRITE_BEHIND=True, SALE_FLUSH_INTERVAL=3600)
+    add_stock(app, "aaa", 5)
+    rejected = sale_coalescer.rejected
+
+    assert sale_coalescer.submit([("aaa", 3, 2)]) == [True]
+    assert sale_coalescer.submit([("aaa", 2, 2)]) == [True]
+    with app.app_context():
+        db.session.execute(update(Stock).where(Stock.name == "aaa").values(amount=4))
+        db.session.commit()
+        db.session.remove()
+    sale_coalescer.flush()
+
+    assert stock_amount(app, "aaa") == 1
+    assert sale_coalescer.rejected == rejected + 1
+    with app.app_context():
+        assert db.session.get(Sales, "sales").cents == 600
+        assert db.session.scalars(select(SalesLedger.amount)).all() == [3]
+        reject = db.session.scalars(select(WriteBehindReject)).one()
+        assert (reject.name, reject.amount, reject.cents) == ("aaa", 2, 400)
+        db.session.remove()
+
+    # 反映できなかった商品の販売可能数はDBから読み込み直す
+    assert sale_coalescer.submit([("aaa", 2, None)]) == [False]
+    assert sale_coalescer.submit([("aaa", 1, None)]) == [True]
+
+    body = app.test_client().get("/metrics").get_data(as_text=True)
+    assert "write_behind_rejected_total {}".format(rejected + 1) in body
+
+
+# 全削除の前に受け付けた販売は全削除の前に反映し、全削除の後は全削除後の在庫で判定する
+def test_reset_does_not_strand_acknowledged_sales(make_app):
+    app = make_app(SALE_WRITE_BEHIND=True, SALE_FLUSH_INTERVAL=3600)
+    client = app.test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    rejected = sale_coalescer.rejected
+
+    assert client.post("/v1/sales", json={"name": "aaa", "amount": 2}).status_code == 200
+    assert client.delete("/v1/stocks").status_code == 200
+    assert client.post("/v1/sales", json={"name": "aaa"}).status_code == 400
+    sale_coalescer.flush()
+
+    assert sale_coalescer.rejected == rejected
+    with app.app_context():
+        assert db.session.scalar(select(func.sum(SalesLedger.amount))) is None
+        assert db.session.scalars(select(WriteBehindReject)).all() == []
+        db.session.remove()
+
+
+# スナップショットから戻しても、反映済みのセグメント番号と反映できなかった販売は戻さない
+def test_restore_keeps_write_behind_state(make_app):
+    app = make_app(SALE_WRITE_BEHIND=True, SALE_FLUSH_INTERVAL=3600, SNAPSHOT_API_ENABLED=True)
+    client = app.test_client()
+    client.post("/v1/stocks", json={"name": "aaa", "amount": 5})
+    client.post("/v1/sales", json={"name": "aaa"})
+    assert client.post("/v1/snapshots/before").status_code == 201
+
+    assert sale_coalescer.submit([("aaa", 2, None)]) == [True]
+    with app.app_context():
+        db.session.execute(update(Stock).where(Stock.name == "aaa").values(amount=1))
+        db.session.commit()
+        db.session.remove()
+    sale_coalescer.flush()
+
+    def write_behind_state():
+        with app.app_context():
+            state = (
+                db.session.scalar(select(WriteBehindCheckpoint.segment)),
+                db.session.scalars(select(WriteBehindReject.amount)).all(),
+            )
+            db.session.remove()
+            return state
+
+    state = write_behind_state()
+    assert state[1] == [2]
+    assert client.post("/v1/snapshots/before/restore").status_code == 200
+    assert write_behind_state() == state
+    assert client.get("/v1/stocks/aaa").get_json() == {"aaa": 4}
@@ -0,0 +1,127 @@
+import math
+
+from flask import abort, request
+
+
+# ----------------リクエストボディの値チェック----------------
+# v1 APIのリクエストボディ(JSON)のスキーマを定義し、各エンドポイントで共通に使う
+#  - リクエストボディのJSONの解釈は1リクエストにつき1回だけ行う
+#  - スキーマは項目名、条件、省略時の値で定義し、作成時にチェック関数にコンパイルしておく
+#    リクエストごとのチェックは全ての項目を1回ずつ順に確かめるだけにする
+#  - ERRORとなる場合はabort(400)し、bad_request_v1の{"message": "ERROR"}を返す
+#    (JSONとして解釈できない場合、Content-TypeがJSONでない場合も同じ)
+
+# 省略できない項目の省略時の値
+REQUIRED = object()
+
+
+class Invalid(Exception):
+    pass
+
+
+# ----------------項目ごとの条件----------------
+# Pythonの式で書き、{v}の部分は項目の値に置き換える
+
+# 商品名: 8文字以内であること、アルファベット小文字または大文字のみを含むこと
+NAME = "type({v}) is str and len({v}) <= 8 and {v}.isalpha()"
+
+# 数量: 整数であること、0より大きいこと (true/falseは整数として扱わない)
+AMOUNT = "type({v}) is int and {v} > 0"
+
+# 販売価格: 整数または浮動小数点数であること、0より大きい有限の値であること
+# (NaNは比較が常にFalseになるため除かれる)
+PRICE = "(type({v}) is int and {v} > 0) or (type({v}) is float and 0 < {v} < INF)"
+
+
+class Schema:
+
+    # fieldsは (項目名, 条件, 省略時の値) のタプル
+    # 省略時の値がREQUIREDの項目は省略できない
+    # 項目がnullの場合も省略したものとして扱う
+    #
+    # 作成時に項目ごとの条件を並べたチェック関数のソースコードを組み立ててコンパイルしておき、
+    # リクエストごとのチェックではループや関数呼び出しをせずに1回で全ての項目をチェックする
+    def __init__(self, *fields):
+        self.fields = tuple(fields)
+
+        lines = [
+            "def validate(data):",
+            "    if type(data) is not dict:",
+            "        raise Invalid()",
+            "    get = data.get",
+        ]
+        defaults = {}
+        for i, (key, condition, default) in enumerate(self.fields):
+            v = "v{}".format(i)
+            lines.append("    {} = get({!r})".format(v, key))
+            if default is REQUIRED:
+                # 条件は型のチェックを含むため、Noneの場合もERRORになる
+                lines.append("    if not ({}):".format(condition.format(v=v)))
+            else:
+                defaults["d{}".format(i)] = default
+                lines.append("    if {} is None:".format(v))
+                lines.append("        {} = d{}".format(v, i))
+                lines.append("    elif not ({}):".format(condition.format(v=v)))
+            lines.append("        raise Invalid()")
+        lines.append("    return ({},)".format(
+            ", ".join("v{}".format(i) for i in range(len(self.fields)))
+        ))
+
+        namespace = {"Invalid": Invalid, "INF": math.inf}
+        namespace.update(defaults)
+        self.source = "\n".join(lines)
+        exec(compile(self.source, "<schema>", "exec"), namespace)
+        # dataの値をチェックし、項目の順に値のタプルを返す
+        # ERRORの場合はInvalidを送出する
+        self.validate = namespace["validate"]
+
+
+# 在庫の追加 (name, amount)
+STOCK = Schema(
+    ("name", NAME, REQUIRED),
+    ("amount", AMOUNT, 1),
+)
+
+# 発注点の設定 (threshold)
+THRESHOLD = Schema(
+    ("threshold", AMOUNT, REQUIRED),
+)
+
+# 販売 (name, amount, price)
+SALE = Schema(
+    ("name", NAME, REQUIRED),
+    ("amount", AMOUNT, 1),
+    ("price", PRICE, None),
+)
+
+
+# リクエストボディのJSONを取得する
+# Content-TypeがJSON(application/jsonまたはapplication/*+json)でない場合は400エラーとする
+# Flaskは解釈したJSONをリクエストごとに保持するため、2回目以降は解釈し直さない
+def json_body():
+    if not request.is_json:
+        abort(400)
+    data = request.get_json(silent=True)
+    if data is None:
+        abort(400)
+    return data
+
+# dataの値をスキーマでチェックして値のタプルを返す
+# ERRORとなる場合は400エラーとする
+def validate(schema, data):
+    try:
+        return schema.validate(data)
+    except Invalid:
+        abort(400)
+
+# まとめて処理する明細 ({"items": [...]}) をチェックし、(明細のリスト, 値のタプルのリスト) を返す
+# 明細が1件以上max_items件以下でない場合、1つでも不正な明細がある場合は400エラーとする
+def validate_items(schema, data, max_items):
+    items = data.get("items") if type(data) is dict else None
+    if type(items) is not list or not 0 < len(items) <= max_items:
+        abort(400)
+    validate_item = schema.validate
+    try:
+        return items, [validate_item(item) for item in items]
+    except Invalid:
+        abort(400)
@@ -0,0 +1,420 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import insert, select
+
+import queries
+import sale_engine
+from cache import stock_cache
+from models import db, Stock, WriteBehindCheckpoint, WriteBehindReject, upsert_insert
+
+
+# ----------------販売の遅延書き込み (write-behind)----------------
+# セール時など同じ商品への販売が集中すると、販売のたびにDBの書き込みロックを待つことになる
+# SALE_WRITE_BEHIND = True の場合は販売を次のように処理する
+#  1. 商品ごとの販売可能数(DBの在庫数 - 未反映の販売数)をメモリに持ち、
+#     その場で販売できるかどうかを判定する
+#  2. 販売できた場合はジャーナルファイルに追記してfsyncしてからレスポンスを返す
+#     (同時に待っているリクエストはまとめて1回のfsyncで済ませる)
+#  3. バックグラウンドのスレッドがSALE_FLUSH_INTERVAL秒ごとに、溜まった販売を
+#     商品ごとにまとめて1トランザクションでDBに反映する
+#
+# ジャーナルは反映のたびに新しいセグメントファイルに切り替え、反映済みのセグメント番号を
+# 同じトランザクションでwrite_behind_checkpointsテーブルに記録する
+# プロセスが異常終了した場合は、起動時に未反映のセグメントをDBに反映し直す
+#
+# 全削除とスナップショットからの復元はexclusive()の中で実行し、その間は販売を受け付けない
+# それでも反映時にDBの在庫が足りない販売 (他のプロセスが在庫を減らした場合など) は、
+# 破棄せずにwrite_behind_rejectsテーブルに記録する (/metrics の write_behind_rejected_total)
+#
+# 販売可能数はプロセス内に持つため、このモードは1プロセスで動かすこと
+# (serve.py で起動する場合は --workers 1、ジャーナルのディレクトリはロックファイルで排他する)
+# 他のプロセス(flask import-stocks など)による在庫の変更は、このプロセスの販売可能数には
+# 反映されない
+# 在庫チェックのレスポンスには、DBに反映されるまで(SALE_FLUSH_INTERVAL秒程度)の販売は含まれない
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PREFIX = "sales.journal."
+JOURNAL_LOCK = "sales.journal.lock"
+
+
+class SaleCoalescer:
+
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lockfile = None
+        # 商品ごとの販売可能数
+        self._available = {}
+        # 未反映の販売 (name, amount, price, 売上(セント), 販売日時) のリスト
+        self._pending = []
+        # 未反映の販売数 (反映中のものを含む)
+        self._unflushed = {}
+        self._journal = None
+        self._segment = 0
+        # 反映に失敗し、次回の反映後に削除するセグメント番号
+        self._done_segments = []
+        self._written = 0
+        self._synced = 0
+        # DBの在庫が足りず反映できなかった販売の件数
+        self.rejected = 0
+
+    # Flaskアプリケーションの設定を読み込む
+    # 有効な場合は最初のリクエストの前に、未反映のジャーナルを反映してから
+    # バックグラウンドのスレッドを開始する
+    # (flask db upgrade などのCLIコマンドでは開始しない)
+    def init_app(self, app):
+        app.config.setdefault("SALE_WRITE_BEHIND", False)
+        app.config.setdefault("SALE_FLUSH_INTERVAL", 0.005)
+        app.config.setdefault("SALE_JOURNAL_DIR", app.instance_path)
+        self.enabled = app.config["SALE_WRITE_BEHIND"]
+        if not self.enabled:
+            return
+
+        self.app = app
+        self.interval = app.config["SALE_FLUSH_INTERVAL"]
+        self.directory = app.config["SALE_JOURNAL_DIR"]
+        app.before_request(self.start)
+        atexit.register(self.close)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._lockfile = open(os.path.join(self.directory, JOURNAL_LOCK), "w")
+            try:
+                fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lockfile.close()
+                self._lockfile = None
+                raise RuntimeError(
+                    "SALE_JOURNAL_DIR {} is used by another process".format(self.directory)
+                )
+
+            with self.app.app_context():
+                self._segment = self._recover()
+            self._open_segment()
+
+            self._stop.clear()
+            thread = threading.Thread(target=self._run, name="sale-flusher", daemon=True)
+            thread.start()
+            self._thread = thread
+
+    # ----------------販売----------------
+
+    # 販売する
+    # linesは (name, amount, price) のリストで、明細ごとに販売できたかどうかのリストを返す
+    # 販売できた明細はジャーナルに書き込んでから返す
+    def submit(self, lines):
+        self.start()
+        sold_at = int(time.time())
+        results = []
+        entries = []
+
+        # 販売可能数がまだ分からない商品はDBから読み込む
+        # (読み込んだ後にforget()で破棄された場合は読み込み直す)
+        names = {name for name, _, _ in lines}
+        while True:
+            missing = [name for name in names if name not in self._available]
+            if missing:
+                self._load(missing)
+            self._lock.acquire()
+            if all(name in self._available for name in names):
+                break
+            self._lock.release()
+
+        try:
+            for name, amount, price in lines:
+                available = self._available.get(name, 0)
+                if available < amount:
+                    results.append(False)
+                    continue
+                self._available[name] = available - amount
+                self._unflushed[name] = self._unflushed.get(name, 0) + amount
+                entry = (name, amount, price, sale_engine.revenue_cents(price, amount), sold_at)
+                self._pending.append(entry)
+                entries.append(entry)
+                results.append(True)
+
+            if entries:
+                for entry in entries:
+                    self._journal.write(json.dumps(entry) + "\n")
+                self._journal.flush()
+                self._written += 1
+                target = self._written
+                journal = self._journal
+        finally:
+            self._lock.release()
+
+        if entries:
+            self._sync(journal, target)
+        return results
+
+    # ジャーナルをfsyncする
+    # 他のスレッドが先にfsyncしていた場合は、その中に自分の書き込みも含まれるので待つだけでよい
+    def _sync(self, journal, target):
+        with self._sync_lock:
+            # 反映のためにセグメントを切り替えた場合は、閉じる前にfsync済み
+            if self._synced >= target or journal.closed:
+                return
+            with self._lock:
+                written = self._written
+            os.fsync(journal.fileno())
+            self._synced = max(self._synced, written)
+
+    # DBの在庫数から未反映の販売数を引いて販売可能数とする
+    # (反映中はDBの在庫数と未反映の販売数がずれるため、反映の完了を待ち、
+    #  次の反映が始まる前に同じ時点の未反映の販売数を引く)
+    def _load(self, names):
+        with self._flush_lock, self.app.app_context():
+            rows = dict(db.session.execute(
+                select(Stock.name, Stock.amount).where(Stock.name.in_(names))
+            ).all())
+            db.session.remove()
+            with self._lock:
+                for name in names:
+                    if name not in self._available:
+                        self._available[name] = rows.get(name, 0) - self._unflushed.get(name, 0)
+
+    # 在庫の追加などで在庫数が変わった商品の販売可能数を破棄し、次回DBから読み込み直す
+    def forget(self, *names):
+        if not self.enabled:
+            return
+        with self._lock:
+            for name in names:
+                self._available.pop(name, None)
+
+    # 全ての商品の販売可能数を破棄する
+    def forget_all(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._available.clear()
+
+    # ----------------DBへの反映----------------
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to flush write-behind sales")
+
+    # 溜まった販売を1トランザクションでDBに反映する
+    def flush(self):
+        if self._thread is None:
+            return
+        with self._flush_lock:
+            self._flush()
+
+    # 全削除やスナップショットからの復元など、DBの在庫数を置き換える処理をwithの中で実行する
+    # 溜まった販売をDBに反映し、全ての商品の販売可能数を破棄してから実行する
+    # 実行中の販売は販売可能数の読み込み(_load())で待ち、終了後のDBの在庫数で判定する
+    # (置き換える前の在庫数で販売を受け付け、反映できなくなることがないようにする)
+    @contextmanager
+    def exclusive(self):
+        if self._thread is None:
+            yield
+            return
+        with self._flush_lock:
+            with self._lock:
+                self._available.clear()
+            self._flush()
+            yield
+
+    def _flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            entries = self._pending
+            self._pending = []
+            segment = self._segment
+            journal = self._journal
+            written = self._written
+            self._segment += 1
+            self._open_segment()
+
+        # 切り替える前のセグメントの書き込みが全てfsyncされてから反映する
+        with self._sync_lock:
+            os.fsync(journal.fileno())
+            journal.close()
+            self._synced = max(self._synced, written)
+
+        try:
+            with self.app.app_context():
+                rejected = self._apply(entries, segment)
+        except Exception:
+            # 反映できなかった販売は次回の反映でまとめて反映する
+            # (このセグメントは次回のセグメント番号が記録された時点で不要になる)
+            with self._lock:
+                self._pending = entries + self._pending
+                self._done_segments.append(segment)
+            raise
+
+        with self._lock:
+            done = self._done_segments + [segment]
+            self._done_segments = []
+            for name, amount, _, _, _ in entries:
+                self._unflushed[name] -= amount
+                if not self._unflushed[name]:
+                    del self._unflushed[name]
+        for done_segment in done:
+            os.remove(self._segment_path(done_segment))
+        stock_cache.invalidate(*{entry[0] for entry in entries})
+        # 反映できなかった商品は販売可能数がDBとずれているため読み込み直す
+        if rejected:
+            self.forget(*{entry[0] for entry in rejected})
+
+    # 販売をDBに反映し、反映したセグメント番号を同じトランザクションで記録する
+    # DBの在庫が足りず反映できなかった販売のリストを返す
+    def _apply(self, entries, segment):
+        session = db.session
+
+        # 商品ごとに販売数の合計を条件付きUPDATEで減算する
+        # 他のプロセスで在庫が減らされていた場合などで減算できなかった商品は、
+        # sale_engine.sell_batch() と同じく販売を1件ずつ減算し直し、
+        # 減算できなかった販売は売上と履歴に含めず、write_behind_rejectsテーブルに記録する
+        # (レスポンスを返した販売のため、在庫を確認して後から突き合わせられるように残す)
+        planned = {}
+        for entry in entries:
+            planned.setdefault(entry[0], []).append(entry)
+        applied = []
+        rejected = []
+        for name, product_entries in planned.items():
+            total = sum(entry[1] for entry in product_entries)
+            if queries.decrement_amount(name, total, session):
+                applied.extend(product_entries)
+                continue
+            for entry in product_entries:
+                if queries.decrement_amount(name, entry[1], session):
+                    applied.append(entry)
+                else:
+                    rejected.append(entry)
+
+        cents = sum(entry[3] for entry in applied)
+        if cents:
+            queries.add_total(cents, session)
+
+        by_time = {}
+        for name, amount, price, line_cents, sold_at in applied:
+            by_time.setdefault(sold_at, []).append((name, amount, price, line_cents))
+        for sold_at, lines in by_time.items():
+            sale_engine.record_sales(lines, sold_at, session)
+
+        if rejected:
+            rejected_at = int(time.time())
+            session.execute(insert(WriteBehindReject), [
+                {"name": name, "amount": amount, "price": price, "cents": line_cents,
+                 "sold_at": sold_at, "segment": segment, "rejected_at": rejected_at}
+                for name, amount, price, line_cents, sold_at in rejected
+            ])
+
+        stmt = upsert_insert(WriteBehindCheckpoint.__table__, session)
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[WriteBehindCheckpoint.name],
+                set_={"segment": stmt.excluded.segment},
+            ),
+            [{"name": "sales", "segment": segment}],
+        )
+        try:
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+        for name, amount, _, _, _ in rejected:
+            logger.error("write-behind sale of %s x%d exceeds stock (recorded in write_behind_rejects)",
+                         name, amount)
+        self.rejected += len(rejected)
+        return rejected
+
+    # ----------------ジャーナル----------------
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, JOURNAL_PREFIX + str(segment))
+
+    def _open_segment(self):
+        self._journal = open(self._segment_path(self._segment), "a", encoding="utf-8")
+
+    # 起動時に未反映のセグメントをDBに反映し、次に使うセグメント番号を返す
+    def _recover(self):
+        segments = sorted(
+            int(filename[len(JOURNAL_PREFIX):])
+            for filename in os.listdir(self.directory)
+            if filename.startswith(JOURNAL_PREFIX) and filename[len(JOURNAL_PREFIX):].isdigit()
+        )
+        checkpoint = db.session.scalar(
+            select(WriteBehindCheckpoint.segment).where(WriteBehindCheckpoint.name == "sales")
+        )
+        if checkpoint is None:
+            checkpoint = -1
+
+        for segment in segments:
+            path = self._segment_path(segment)
+            if segment > checkpoint:
+                entries = []
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        # 書き込み途中で終了した最後の行はfsyncされておらず、
+                        # レスポンスも返していないため読み飛ばす
+                        try:
+                            entries.append(tuple(json.loads(line)))
+                        except ValueError:
+                            continue
+                if entries:
+                    logger.warning("replaying %d write-behind sales from %s", len(entries), path)
+                    self._apply(entries, segment)
+            os.remove(path)
+
+        db.session.remove()
+        return max(segments + [checkpoint]) + 1
+
+    # /metrics に出力する値
+    def collect_metrics(self):
+        with self._lock:
+            pending = len(self._pending)
+        return [
+            ("write_behind_pending", "gauge", "Write-behind sales waiting to be flushed.", [
+                ({}, pending),
+            ]),
+            ("write_behind_rejected_total", "counter",
+             "Write-behind sales recorded in write_behind_rejects because the stock was insufficient at flush.", [
+                ({}, self.rejected),
+            ]),
+        ]
+
+    # 溜まった販売を反映してからスレッドを停止する
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._thread = None
+        self._journal.close()
+        os.remove(self._segment_path(self._segment))
+        self._lockfile.close()
+        self._lockfile = None
+
+
+# SaleCoalescerインスタンスの作成
+sale_coalescer = SaleCoalescer()